@@ -1,28 +1,37 @@
 # app/__init__.py
 import os
+import copy
+import queue
 import atexit
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from flask import Flask, render_template, session
 from flask_session import Session  # type: ignore
+from .utils.sessions import StaticRequestFilteringSessionInterface
 
 # --- 导入配置类 ---
 try:
-    from .config import Config
+    from .config import Config, load_config
 except ImportError:
     class Config:
         def __init__(self, path=None): self.config = {}
         def as_dict(self): return self.config
         def get(self, key, default=None): return self.config.get(key, default)
+    load_config = Config
 
 
 # --- 导入数据库实例 ---
 try:
-    from .database import db
+    from .database import db, JSON_ENGINE_OPTIONS, sqlite_engine_options, pool_engine_options, upgrade_schema
 except ImportError:
     class MockDB:
         def init_app(self, app): pass
         def create_all(self): pass
     db = MockDB()
+    JSON_ENGINE_OPTIONS = {}
+    def sqlite_engine_options(database_uri): return {}
+    def pool_engine_options(database_uri): return {}
+    def upgrade_schema(engine, metadata, logger): pass
 
 # --- 导入 Celery 工具函数 ---
 try:
@@ -66,6 +75,19 @@ except ImportError as e:
     print(f"错误：无法导入 validate_bp，请确保 app/validate/__init__.py 和 app/validate/routes.py 文件存在且无误: {e}")
 
 
+class _DeferredFormatQueueHandler(QueueHandler):
+    """
+    只在调用线程中合并消息参数，异常堆栈的格式化与输出都留给 QueueListener 线程，
+    请求线程记录日志 (包括 exc_info=True) 的开销只是一次入队。
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
 server_session = Session()
 celery = None # 在 create_app 中初始化
 
@@ -80,7 +102,12 @@ def create_app(config_object=None):
         stream_handler.setFormatter(logging.Formatter(
             '%(asctime)s %(levelname)s %(name)s %(threadName)s : %(message)s'
         ))
-        app.logger.addHandler(stream_handler)
+        # 经队列交给后台线程输出，请求线程不做格式化和 I/O
+        log_queue = queue.SimpleQueue()
+        log_listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        log_listener.start()
+        atexit.register(log_listener.stop)
+        app.logger.addHandler(_DeferredFormatQueueHandler(log_queue))
         app.logger.setLevel(logging.INFO)
     else:
         app.logger.setLevel(logging.DEBUG)
@@ -92,7 +119,7 @@ def create_app(config_object=None):
         config_path = os.path.join(os.path.dirname(__file__), '..', 'config.yaml')
         app.logger.info(f"尝试从 {config_path} 加载配置...")
         try:
-            app_config = Config(config_path)
+            app_config = load_config(config_path)
         except FileNotFoundError:
             app.logger.error(f"配置文件 {config_path} 未找到！将使用默认配置。")
             app_config = Config(None) # 使用空的Config实例
@@ -113,6 +140,12 @@ def create_app(config_object=None):
         app.config.setdefault('USER_SESSION_TTL', 600)
         app.config.setdefault('SESSION_TYPE', 'filesystem')
         app.config.setdefault('SECRET_KEY', os.urandom(24))
+        # JSON 列使用 orjson 编解码 (如可用)，SQLite 允许跨线程使用连接，并配置连接池；显式配置的引擎选项优先
+        engine_options = dict(JSON_ENGINE_OPTIONS)
+        engine_options.update(pool_engine_options(app.config.get('SQLALCHEMY_DATABASE_URI')))
+        engine_options.update(sqlite_engine_options(app.config.get('SQLALCHEMY_DATABASE_URI')))
+        engine_options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
         # 为Celery确保配置存在
         app.config.setdefault('CELERY_BROKER_URL', 'redis://localhost:6379/0')
         app.config.setdefault('CELERY_RESULT_BACKEND', 'redis://localhost:6379/1')
@@ -134,6 +167,11 @@ def create_app(config_object=None):
     db.init_app(app)
     app.logger.info("数据库已初始化。")
     server_session.init_app(app)
+    # 静态资源等请求不读写会话存储 (filesystem 会话每个请求都要读写一次会话文件)
+    app.session_interface = StaticRequestFilteringSessionInterface(
+        app.session_interface,
+        app.config.get('SESSION_SKIP_PATH_PREFIXES') or (app.static_url_path + '/', '/favicon.ico', '/healthz')
+    )
     app.logger.info("服务器会话已初始化。")
 
     # --- 初始化 Celery ---
@@ -200,6 +238,8 @@ def create_app(config_object=None):
     with app.app_context():
         try:
             db.create_all()
+            # 旧数据库缺少的新列/索引 (create_all 不会修改已存在的表)
+            upgrade_schema(db.engine, db.metadata, app.logger)
             app.logger.info("数据库表已检查/创建。")
         except Exception as e:
             app.logger.error(f"创建数据库表时出错: {e}", exc_info=True)
@@ -207,6 +247,8 @@ def create_app(config_object=None):
     # ... (你的 shutdown_services 和 atexit.register，保持不变) ...
     def shutdown_services():
         app.logger.info("应用关闭，开始清理服务...")
+        if hasattr(app, 'inference_service') and app.inference_service is not None:
+            app.inference_service.shutdown_service()
         if hasattr(app, 'inference_executor') and app.inference_executor is not None:
             app.logger.info("正在关闭 InferenceExecutor...")
             app.inference_executor.shutdown(wait=True)
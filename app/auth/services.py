@@ -33,5 +33,12 @@ class AuthService:
 
         user = User.query.filter_by(username=username).first()
         if user and user.check_password(password):
+            # check_password 可能已将旧哈希升级为 Argon2id，提交以持久化
+            if db.session.is_modified(user):
+                try:
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"更新用户密码哈希失败: {e}")
             return user
         return None
\ No newline at end of file
@@ -1,6 +1,12 @@
 # app/celery_utils.py
 from celery import Celery
 
+# 可选依赖: msgpack 用于序列化任务结果和 PROGRESS 状态 (回调每隔几秒上报一次)，未安装时回退到 json
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 def make_celery(app):
     """
     为Flask应用创建一个配置好的Celery实例。
@@ -12,6 +18,9 @@ def make_celery(app):
         include=[] # 任务模块将由 celery_worker.py 导入
     )
     celery.conf.update(app.config)
+    if msgpack is None and app.config.get('CELERY_RESULT_SERIALIZER') == 'msgpack':
+        app.logger.warning("未安装 msgpack，Celery 结果序列化回退为 json。")
+        celery.conf.update(CELERY_RESULT_SERIALIZER='json')
 
     class ContextTask(celery.Task):
         abstract = True
@@ -1,6 +1,17 @@
+import functools
 import yaml
 import os
 
+try:
+    import redis  # 可选: 配置 REDIS_URL 时用作 Session 存储
+except ImportError:  # pragma: no cover
+    redis = None
+
+# 项目根目录 (config.yaml、main.py、celery_worker.py 所在目录)，导入时计算一次；
+# 相对路径配置 (USER_MODEL_BASE_DIR、PRESET_MODELS_DIR 等) 都相对于它解析
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CONFIG_PATH = os.path.join(PROJECT_ROOT, 'config.yaml')
+
 
 class Config:
     """加载并提供配置信息"""
@@ -22,31 +33,36 @@ class Config:
         self.SQLALCHEMY_DATABASE_URI = self.get('DATABASE_URI', 'sqlite:///./database.db')
         self.SQLALCHEMY_TRACK_MODIFICATIONS = False # 建议关闭以节省资源
 
+        # TLS 由反向代理终止 (见 main.py)，Python 进程内不创建任何 SSL 上下文；
+        # 证书是可选的，只在这里核对一次并按需生成 HAProxy 使用的合并 PEM (证书 + 私钥)
         self.CERT_FILE = self.get('CERT_FILE')
         self.KEY_FILE = self.get('KEY_FILE')
         self.SSL_PEM_FILE = self.get('SSL_PEM_FILE')
-        if not self.CERT_FILE or not self.KEY_FILE:
-            raise ValueError("请在 config.yaml 中配置 CERT_FILE 和 KEY_FILE")
-        if not os.path.exists(self.CERT_FILE) or not os.path.exists(self.KEY_FILE):
-             raise FileNotFoundError(f"证书或密钥文件未找到: {self.CERT_FILE}, {self.KEY_FILE}")
-
-        if not self.SSL_PEM_FILE:
-             raise ValueError("请在 config.yaml 中配置 SSL_PEM_FILE (合并的证书和密钥)")
-        if not os.path.exists(self.SSL_PEM_FILE):
-             if self.CERT_FILE and self.KEY_FILE and os.path.exists(self.CERT_FILE) and os.path.exists(self.KEY_FILE):
-                 print(f"警告: 合并的 PEM 文件 {self.SSL_PEM_FILE} 未找到。尝试从 {self.CERT_FILE} 和 {self.KEY_FILE} 创建...")
-                 try:
-                     with open(self.SSL_PEM_FILE, 'wb') as outfile, \
-                          open(self.CERT_FILE, 'rb') as certfile, \
-                          open(self.KEY_FILE, 'rb') as keyfile:
-                         outfile.write(certfile.read())
-                         outfile.write(b'\n')
-                         outfile.write(keyfile.read())
-                     print(f"成功创建合并的 PEM 文件: {self.SSL_PEM_FILE}")
-                 except Exception as e:
-                     raise FileNotFoundError(f"无法创建合并的 PEM 文件 {self.SSL_PEM_FILE}: {e}")
-             else:
-                raise FileNotFoundError(f"合并的 PEM 文件未找到: {self.SSL_PEM_FILE}")
+        if self.CERT_FILE or self.KEY_FILE:
+            if not self.CERT_FILE or not self.KEY_FILE:
+                raise ValueError("CERT_FILE 和 KEY_FILE 需要同时配置")
+            # 一次 stat 同时确认存在性并拿到大小，用于提示空文件
+            try:
+                st_cert = os.stat(self.CERT_FILE)
+                st_key = os.stat(self.KEY_FILE)
+            except FileNotFoundError:
+                raise FileNotFoundError(f"证书或密钥文件未找到: {self.CERT_FILE}, {self.KEY_FILE}")
+            if st_cert.st_size == 0 or st_key.st_size == 0:
+                print(f"警告: 证书或密钥文件为空: {self.CERT_FILE} ({st_cert.st_size} 字节), "
+                      f"{self.KEY_FILE} ({st_key.st_size} 字节)")
+
+            if self.SSL_PEM_FILE and not os.path.exists(self.SSL_PEM_FILE):
+                print(f"警告: 合并的 PEM 文件 {self.SSL_PEM_FILE} 未找到。尝试从 {self.CERT_FILE} 和 {self.KEY_FILE} 创建...")
+                try:
+                    with open(self.SSL_PEM_FILE, 'wb') as outfile, \
+                         open(self.CERT_FILE, 'rb') as certfile, \
+                         open(self.KEY_FILE, 'rb') as keyfile:
+                        outfile.write(certfile.read())
+                        outfile.write(b'\n')
+                        outfile.write(keyfile.read())
+                    print(f"成功创建合并的 PEM 文件: {self.SSL_PEM_FILE}")
+                except Exception as e:
+                    raise FileNotFoundError(f"无法创建合并的 PEM 文件 {self.SSL_PEM_FILE}: {e}")
 
         # --- Session 配置 ---
         self.SESSION_TYPE = self.get('SESSION_TYPE', 'filesystem')
@@ -55,6 +71,18 @@ class Config:
         self.SESSION_USE_SIGNER = self.get('SESSION_USE_SIGNER', True)
         self.SESSION_KEY_PREFIX = self.get('SESSION_KEY_PREFIX', 'session:')
 
+        # 配置了 REDIS_URL 时 Session 存入 Redis: 每次读写一次网络往返，多线程/多进程共享，
+        # 不再在 filesystem 后端的会话文件上串行读写；redis 客户端按需建立连接，这里不会连接服务器
+        self.REDIS_URL = self.get('REDIS_URL')
+        if self.REDIS_URL:
+            if redis is None:
+                print(f"警告: 已配置 REDIS_URL，但未安装 redis 包，Session 仍使用 {self.SESSION_TYPE} 存储。")
+            else:
+                self.SESSION_TYPE = 'redis'
+                self.SESSION_REDIS = redis.Redis.from_url(
+                    self.REDIS_URL, socket_keepalive=True, health_check_interval=30
+                )
+
         # 确保 session 目录存在
         if self.SESSION_TYPE == 'filesystem' and not os.path.exists(self.SESSION_FILE_DIR):
             os.makedirs(self.SESSION_FILE_DIR)
@@ -100,4 +128,23 @@ class Config:
 
 # 全局配置实例 (可以在应用的不同部分导入使用)
 # 在 app/__init__.py 中创建实例，避免循环导入问题
-# config = Config() # 不在这里实例化
\ No newline at end of file
+# config = Config() # 不在这里实例化
+
+
+@functools.lru_cache(maxsize=4)
+def _load_config_cached(config_path, mtime_ns):
+    return Config(config_path)
+
+
+def load_config(config_path='config.yaml'):
+    """
+    返回 config_path 对应的 Config 实例。按 (绝对路径, 修改时间) 缓存:
+    同一进程内多次加载不会重复解析 YAML、重复检查证书文件；文件被修改后自动重新加载。
+    调用方应把返回的实例视为只读。
+    """
+    config_path = os.path.abspath(config_path)
+    try:
+        mtime_ns = os.stat(config_path).st_mtime_ns
+    except FileNotFoundError:
+        raise FileNotFoundError(f"配置文件未找到: {config_path}")
+    return _load_config_cached(config_path, mtime_ns)
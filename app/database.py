@@ -1,5 +1,96 @@
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+# 可选依赖: orjson 用于 JSON 列的序列化/反序列化，未安装时使用 SQLAlchemy 默认的 json 模块
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # 创建 SQLAlchemy 实例，但不绑定具体 app
 # 会在 app 工厂函数中初始化
-db = SQLAlchemy()
\ No newline at end of file
+db = SQLAlchemy()
+
+
+def _orjson_dumps(obj):
+    # JSON 列在 SQLite 中以文本存储，需要返回 str
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()
+
+
+# 合并进 SQLALCHEMY_ENGINE_OPTIONS，使训练回调每个批次写入 metrics_json 时走 orjson
+JSON_ENGINE_OPTIONS = {'json_serializer': _orjson_dumps, 'json_deserializer': orjson.loads} if orjson else {}
+
+
+def sqlite_engine_options(database_uri):
+    """SQLite 专用的引擎选项: 允许回调的写库线程使用连接，并在锁冲突时等待而不是立即报错。"""
+    if not database_uri or not str(database_uri).startswith('sqlite'):
+        return {}
+    return {'connect_args': {'check_same_thread': False, 'timeout': 30}}
+
+
+def pool_engine_options(database_uri):
+    """
+    主引擎的连接池选项: 网页轮询 (任务列表/详情/日志) 并发时复用连接，签出前探活，定期回收长连接。
+    内存 SQLite 使用单连接池，不适用这些参数。
+    文件 SQLite 在 SQLAlchemy 1.4 中默认使用 NullPool，不接受 pool_size/max_overflow，因此显式指定 QueuePool。
+    """
+    if not database_uri:
+        return {}
+    uri = str(database_uri)
+    options = {'pool_size': 8, 'max_overflow': 16, 'pool_pre_ping': True, 'pool_recycle': 1800}
+    if uri.startswith('sqlite'):
+        if uri in ('sqlite://', 'sqlite:///:memory:') or 'mode=memory' in uri:
+            return {}
+        options['poolclass'] = QueuePool
+    return options
+
+
+@event.listens_for(Engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL 让训练回调写入与网页轮询读取互不阻塞；NORMAL 在 WAL 下仍然安全且减少 fsync
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+    finally:
+        cursor.close()
+
+
+# 在已有表上新增的列: (表名, 列名, DDL 类型)。项目没有迁移工具，db.create_all() 只创建缺失的表，
+# 不会给已存在的表加列，由 upgrade_schema 在启动时按需补齐
+_ADDED_COLUMNS = (
+    ('finetune_tasks', 'batch_progress_json', 'JSON'),
+)
+
+
+def _column_names(engine, table_name):
+    return {column['name'] for column in inspect(engine).get_columns(table_name)}
+
+
+def upgrade_schema(engine, metadata, logger):
+    """
+    幂等的结构升级，在 db.create_all() 之后调用: 为旧数据库补上 _ADDED_COLUMNS 中缺失的列，
+    并创建模型中声明但尚不存在的索引。Web 进程与 Celery worker 可能同时执行，另一方已加列时忽略该错误。
+    """
+    existing_tables = set(inspect(engine).get_table_names())
+    for table_name, column_name, ddl_type in _ADDED_COLUMNS:
+        if table_name not in existing_tables or column_name in _column_names(engine, table_name):
+            continue
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {column_name} {ddl_type}'))
+            logger.info(f"数据库升级: 已为表 {table_name} 添加列 {column_name}。")
+        except OperationalError:
+            if column_name not in _column_names(engine, table_name):
+                raise
+    for table in metadata.sorted_tables:
+        if table.name in existing_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
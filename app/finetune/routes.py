@@ -1,7 +1,7 @@
 import os
-import json
 from flask import request, jsonify, current_app, send_file
 from . import finetune_bp
+from ..utils import json_utils
 from ..utils.decorators import login_required
 
 ALLOWED_EXTENSIONS_MODEL = {'pt'}
@@ -53,10 +53,10 @@ def create_task_route(user_id):  # user_id 由 @login_required 注入
     task_name = request.form.get('task_name')
     training_params_str = request.form.get('training_params', '{}')
     try:
-        training_params = json.loads(training_params_str)
+        training_params = json_utils.loads(training_params_str)
         if not isinstance(training_params, dict):
             raise ValueError("'training_params' 必须是一个 JSON 对象。")
-    except json.JSONDecodeError:
+    except json_utils.JSONDecodeError:
         current_app.logger.error(f"用户ID '{user_id}' 的 training_params JSON无效: {training_params_str}")
         return jsonify({"error": "'training_params' 的 JSON 格式无效。"}), 400
     except ValueError as e:
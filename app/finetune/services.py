@@ -1,6 +1,6 @@
 import os
+import functools
 import uuid
-import json
 import shutil
 from werkzeug.utils import secure_filename
 from flask import current_app
@@ -8,7 +8,10 @@ import zipfile
 import yaml
 
 from ..models import FinetuneTask, User
+from ..config import PROJECT_ROOT
 from ..database import db
+from ..utils.cancel_flags import set_cancel_flag
+from ..utils.fileops import stage_file
 
 ALLOWED_EXTENSIONS_MODEL = {'pt'}
 ALLOWED_EXTENSIONS_DATASET = {'zip'}
@@ -20,12 +23,18 @@ def allowed_file(filename, allowed_extensions):
         filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
 
+@functools.lru_cache(maxsize=1024)
+def _train_task_base_dir(user_model_base_dir, user_id, task_id):
+    # 任务执行、详情、日志轮询都要算一遍任务目录，缓存 secure_filename 与 join 的结果
+    return os.path.join(user_model_base_dir, secure_filename(str(user_id)), 'train', secure_filename(str(task_id)))
+
+
 class FinetuneService:
     def __init__(self, app):
         self.app = app
         self.user_model_base_dir = app.config.get('USER_MODEL_BASE_DIR', 'user_models')
         if not os.path.isabs(self.user_model_base_dir):
-            self.user_model_base_dir = os.path.join(app.root_path, '..', self.user_model_base_dir)
+            self.user_model_base_dir = os.path.join(PROJECT_ROOT, self.user_model_base_dir)
 
         if not os.path.exists(self.user_model_base_dir):
             try:
@@ -39,9 +48,7 @@ class FinetuneService:
     def _get_user_task_base_dir(self, user_id, task_id):
         """获取特定用户特定任务的基础存储目录，基于 user_id。"""
         # 路径结构： USER_MODEL_BASE_DIR / str(user_id) / train / task_id /
-        safe_user_id_str = secure_filename(str(user_id))  # 确保 user_id 是安全的目录名组件
-        safe_task_id = secure_filename(str(task_id))
-        return os.path.join(self.user_model_base_dir, safe_user_id_str, 'train', safe_task_id)
+        return _train_task_base_dir(self.user_model_base_dir, user_id, task_id)
 
     def _get_task_input_dir(self, user_task_base_dir):
         return os.path.join(user_task_base_dir, 'input')
@@ -164,7 +171,7 @@ class FinetuneService:
             base_model_identifier=base_model_identifier_for_db,
             dataset_zip_name=original_dataset_zip_filename,
             dataset_yaml_name=original_dataset_yaml_filename, # 用户上传的yaml名
-            training_params_json=json.dumps(training_params) if training_params else '{}',
+            training_params_json=training_params if training_params else {},
             task_dir_name=task_id,
             input_base_model_name=saved_base_model_name,
             input_dataset_zip_name=original_dataset_zip_filename, # zip文件名
@@ -219,7 +226,7 @@ class FinetuneService:
             self.app.logger.warning("PRESET_MODELS_DIR 未配置。无法验证预设模型。")
             return False
         if not os.path.isabs(preset_models_dir):
-            preset_models_dir = os.path.join(self.app.root_path, '..', preset_models_dir)
+            preset_models_dir = os.path.join(PROJECT_ROOT, preset_models_dir)
 
         safe_name = secure_filename(preset_model_name)
         if safe_name != preset_model_name:  # 检查是否包含非法字符
@@ -235,16 +242,19 @@ class FinetuneService:
                 f"预设模型 '{preset_model_name}' (期望路径 '{expected_model_path}') 未找到。")
             return False
 
-    def _prepare_preset_model(self, preset_model_name, task_input_dir, target_model_name="base_model.pt"):
+    def _get_preset_model_path(self, preset_model_name):
         preset_models_dir = self.app.config.get('PRESET_MODELS_DIR')
         if not preset_models_dir: return None
         if not os.path.isabs(preset_models_dir):
-            preset_models_dir = os.path.join(self.app.root_path, '..', preset_models_dir)
+            preset_models_dir = os.path.join(PROJECT_ROOT, preset_models_dir)
+        return os.path.join(preset_models_dir, f"{secure_filename(preset_model_name)}.pt")
 
-        source_model_path = os.path.join(preset_models_dir, f"{secure_filename(preset_model_name)}.pt")
+    def _prepare_preset_model(self, preset_model_name, task_input_dir, target_model_name="base_model.pt"):
+        source_model_path = self._get_preset_model_path(preset_model_name)
+        if not source_model_path: return None
         destination_model_path = os.path.join(task_input_dir, secure_filename(target_model_name))
         try:
-            shutil.copy2(source_model_path, destination_model_path)
+            stage_file(source_model_path, destination_model_path)
             self.app.logger.info(f"已复制预设模型 '{preset_model_name}' 到 '{destination_model_path}'。")
             return destination_model_path
         except Exception as e:
@@ -260,13 +270,25 @@ class FinetuneService:
             except OSError as e:
                 self.app.logger.error(f"清理任务目录 {user_task_base_dir} 时出错: {e}")
 
+    def list_user_tasks(self, user_id, status=None, limit=50, offset=0):
+        """按 (user_id, status, created_at) 索引查询用户的微调任务，limit 为 None 时不分页。"""
+        query = FinetuneTask.query.filter_by(user_id=user_id)
+        if status:
+            query = query.filter_by(status=status)
+        query = query.order_by(FinetuneTask.created_at.desc())
+        if offset:
+            query = query.offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
     def get_user_tasks(self, user_id):
         user = User.query.get(user_id)
         if not user:
             self.app.logger.warning(f"尝试获取不存在的用户ID '{user_id}' 的任务列表。")
             return []
 
-        tasks = FinetuneTask.query.filter_by(user_id=user.id).order_by(FinetuneTask.created_at.desc()).all()
+        tasks = self.list_user_tasks(user.id, limit=None)
         tasks_list = []
         for task in tasks:
             tasks_list.append({
@@ -284,7 +306,10 @@ class FinetuneService:
             self.app.logger.warning(f"未找到用户ID '{user_id}' 的任务 '{task_id}'。")
             return None
 
-        metrics = json.loads(task.metrics_json) if task.metrics_json else {}
+        metrics = dict(task.metrics_json) if task.metrics_json else {}
+        if task.batch_progress_json:
+            # 轮次内的批次进度比上一轮结束时的 metrics_json 更新
+            metrics.update(task.batch_progress_json)
 
         details = {
             "task_id": task.id,
@@ -297,7 +322,7 @@ class FinetuneService:
             "base_model_identifier": task.base_model_identifier,
             "dataset_zip_name": task.dataset_zip_name,
             "dataset_yaml_name": task.dataset_yaml_name,
-            "training_params": json.loads(task.training_params_json) if task.training_params_json else {},
+            "training_params": dict(task.training_params_json) if task.training_params_json else {},
             "task_dir_name": task.task_dir_name,
             "input_base_model_name": task.input_base_model_name,
             "input_dataset_zip_name": task.input_dataset_zip_name,
@@ -356,8 +381,10 @@ class FinetuneService:
 
         return details
 
-    def get_task_log_path(self, user_id, task_id, ensure_exists=False):
-        task = FinetuneTask.query.filter_by(id=task_id, user_id=user_id).first()
+    def get_task_log_path(self, user_id, task_id, ensure_exists=False, task=None):
+        # 调用方 (如 Celery 任务) 已持有任务记录时传入 task，省去一次查询
+        if task is None:
+            task = FinetuneTask.query.filter_by(id=task_id, user_id=user_id).first()
         if not task:
             return None, "任务未找到或访问被拒绝。"
 
@@ -485,6 +512,9 @@ class FinetuneService:
             self.app.logger.info(
                 f"用户ID '{user_id}' 的任务 {task_id} 在数据库中标记为 '已取消' (原状态: {original_status})。")
             if original_status == 'running':
+                # Celery 任务轮询 Redis 取消标记并通知训练回调；信号文件保留，作为非 Redis 后端时的回退
+                if set_cancel_flag(current_app.celery, task_id):
+                    self.app.logger.info(f"已为任务 {task_id} 写入 Redis 取消标记")
                 # 为正在运行的任务创建取消信号文件，训练脚本应检查此文件
                 cancel_signal_path = os.path.join(self._get_user_task_base_dir(user_id, task_id),
                                                   ".cancel_signal")
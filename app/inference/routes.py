@@ -3,9 +3,9 @@ from flask import request, jsonify, current_app, send_from_directory
 from . import inference_bp
 # from .services import InferenceService # 不再需要从这里导入 InferenceService 类本身，除非你想做类型提示
 from typing import TYPE_CHECKING  # 用于类型提示
+from ..utils import json_utils
 from ..utils.decorators import login_required
 import os
-import json
 
 if TYPE_CHECKING:
     from .services import InferenceService  # 仅用于类型提示，避免循环导入
@@ -60,8 +60,8 @@ def handle_inference_command(user_id):
             payload_str = request.form.get('data') # 附加数据（可选，看前端是否发送）
             if payload_str:
                 try:
-                    payload = json.loads(payload_str)
-                except json.JSONDecodeError:
+                    payload = json_utils.loads(payload_str)
+                except json_utils.JSONDecodeError:
                     current_app.logger.warning(f"用户 {user_id} 表单中的 'data' 字段不是有效的 JSON: {payload_str}")
                     return jsonify({"error": "表单中的 'data' 字段不是有效的 JSON 字符串"}), 400
 
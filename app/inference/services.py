@@ -1,9 +1,12 @@
 # app/inference/services.py
 import uuid
+import traceback
 import shutil
 from concurrent.futures import ThreadPoolExecutor, TimeoutError
-from threading import Lock, Thread, Event
+from contextlib import contextmanager
+from threading import Lock, Thread, Event, Condition
 import math
+import re
 import os
 import time
 import base64
@@ -11,8 +14,19 @@ import cv2
 from ultralytics import YOLO
 from flask import current_app, Flask
 
+from ..utils.fileops import prefetch_file, remove_if_exists
+
 CV2_AVAILABLE = True
 
+# 上传文件保存参数
+UPLOAD_SAVE_BUFFER_SIZE = 1024 * 1024  # 1 MiB
+UPLOAD_PARALLEL_SAVE_THRESHOLD = 8  # 文件数达到该值时并行保存
+UPLOAD_PARALLEL_SAVE_WORKERS = 4
+
+# 模型文件名校验：不允许路径分隔符和 NUL，'..' 单独拒绝
+_SAFE_NAME_RE = re.compile(r'^[^/\\\x00]+$')
+_DOTDOT = '..'
+
 
 # --- YOLO 模型推理器 ---
 class YoloModel:
@@ -78,7 +92,13 @@ class YoloModel:
             # results 是一个列表，通常对于单张图片，只包含一个 Result 对象
             results = self.model.predict(source=image_path, **predict_kwargs)
         except Exception as e:
-            self.log_func(f" YOLO 模型预测时发生严重错误 (图像: {image_path}): {e}", exc_info=True)
+            # 异常在这里被转换为错误结果，调用方看不到堆栈，因此按错误级别记录完整堆栈
+            message = f"YOLO 模型预测时发生严重错误 (图像: {image_path}): {e}"
+            if current_app:
+                current_app.logger.error(message, exc_info=True)
+            else:
+                print(message)
+                traceback.print_exc()
             return {
                 "status": "error",
                 "error": f"YOLO 推理失败: {str(e)}",
@@ -132,7 +152,7 @@ class YoloModel:
                     base64_encoded = base64.b64encode(buffer).decode('utf-8')
                     annotated_image_base64 = f"data:image/jpeg;base64,{base64_encoded}"
                 except Exception as e_img:
-                    self.log_func(f"警告: 绘制或编码标注图像时出错 (图像: {image_path}): {e_img}", exc_info=True)
+                    self.log_func(f"警告: 绘制或编码标注图像时出错 (图像: {image_path}): {e_img}")
                     # 备用：如果标注失败，尝试编码原始图像
                     if os.path.exists(image_path):
                         try:
@@ -144,8 +164,7 @@ class YoloModel:
                             mime_type = f"image/{img_ext[1:]}" if img_ext in ['.jpg', '.jpeg', '.png'] else "image/jpeg"
                             annotated_image_base64 = f"data:{mime_type};base64,{base64_encoded}"
                         except Exception as e_orig_img:
-                            self.log_func(f"警告: 编码原始图像时也出错 (图像: {image_path}): {e_orig_img}",
-                                          exc_info=True)
+                            self.log_func(f"警告: 编码原始图像时也出错 (图像: {image_path}): {e_orig_img}")
                             annotated_image_base64 = None  # 彻底失败
             else:  # CV2 不可用
                 self.log_func(f"警告: CV2 不可用，跳过图像标注 for {image_path}")
@@ -159,8 +178,7 @@ class YoloModel:
                         mime_type = f"image/{img_ext[1:]}" if img_ext in ['.jpg', '.jpeg', '.png'] else "image/jpeg"
                         annotated_image_base64 = f"data:{mime_type};base64,{base64_encoded}"
                     except Exception as e_no_cv2_img:
-                        self.log_func(f"警告: CV2 不可用时编码原始图像出错 (图像: {image_path}): {e_no_cv2_img}",
-                                      exc_info=True)
+                        self.log_func(f"警告: CV2 不可用时编码原始图像出错 (图像: {image_path}): {e_no_cv2_img}")
                         annotated_image_base64 = None
 
         average_confidence = round(total_confidence / object_count, 4) if object_count > 0 else 0.0
@@ -247,19 +265,42 @@ class UserSessionManager:
             os.makedirs(user_dir)
         return user_dir
 
+    @staticmethod
+    def _save_one(file_storage, filepath):
+        """保存单个上传文件，使用较大的缓冲区减少 read/write 系统调用次数"""
+        file_storage.save(filepath, buffer_size=UPLOAD_SAVE_BUFFER_SIZE)
+
+    def _batch_save(self, paths_and_storages):
+        """
+        批量保存上传文件。文件数较少时顺序保存；
+        大量小文件（例如整个图集）时使用线程池并行写入，摊薄每个文件 open/write/close 的等待。
+        """
+        if len(paths_and_storages) < UPLOAD_PARALLEL_SAVE_THRESHOLD:
+            for filepath, file_storage in paths_and_storages:
+                self._save_one(file_storage, filepath)
+            return
+        max_workers = min(UPLOAD_PARALLEL_SAVE_WORKERS, len(paths_and_storages))
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='uploadsave') as pool:
+            futures = [pool.submit(self._save_one, file_storage, filepath)
+                       for filepath, file_storage in paths_and_storages]
+            for future in futures:
+                future.result()  # 传播第一个保存异常
+
     def store_uploaded_files(self, user_id, uploaded_files):
         """存储用户上传的文件，并清空旧文件"""
         self.clear_files(user_id) # 先清空旧的
         user_dir = self._get_user_dir(user_id)
         stored_file_info = []
         try:
+            paths_and_storages = []
             for file_storage in uploaded_files:
                 # 安全地处理文件名，防止路径遍历
                 original_filename = file_storage.filename
                 safe_filename = str(uuid.uuid4()) + "_" + os.path.basename(original_filename) # 使用UUID保证唯一性
                 filepath = os.path.join(user_dir, safe_filename)
-                file_storage.save(filepath)
+                paths_and_storages.append((filepath, file_storage))
                 stored_file_info.append({'path': filepath, 'original_name': original_filename})
+            self._batch_save(paths_and_storages)
 
             with self._lock:
                 self._ensure_user_entry(user_id)
@@ -270,8 +311,7 @@ class UserSessionManager:
             print(f"存储用户 {user_id} 的文件时出错: {e}")
             # 清理本次尝试中可能已保存的文件
             for info in stored_file_info:
-                if os.path.exists(info['path']):
-                    os.remove(info['path'])
+                remove_if_exists(info['path'])
             raise # 重新抛出异常
 
     def get_uploaded_files(self, user_id):
@@ -386,12 +426,17 @@ class InferenceExecutor:
             print(f"InferenceExecutor 初始化完成，最大工作线程数: {self.executor._max_workers}")
 
     def _run_inference_task(self, model_instance, image_path, config):
-        logger = current_app.logger if current_app else print
         try:
             prediction_output = model_instance.predict(image_path, config)
             return prediction_output
         except Exception as e:
-            logger.error(f"推理任务失败 (模型: {model_instance.model_path}, 图片: {image_path}): {e}", exc_info=True)
+            # 异常在这里被转换为错误结果、不会再向外传播，因此必须在此记录完整堆栈
+            message = f"推理任务失败 (模型: {model_instance.model_path}, 图片: {image_path}): {e}"
+            if current_app:
+                current_app.logger.error(message, exc_info=True)
+            else:
+                print(message)
+                traceback.print_exc()
             return { # 保持与成功返回类似的结构，但标记错误
                 "status": "error",
                 "error": f"推理失败: {str(e)}",
@@ -414,6 +459,50 @@ class InferenceExecutor:
         print("InferenceExecutor 已关闭。")
 
 
+# --- 读写锁 ---
+class ReadWriteLock:
+    """
+    简单的写优先读写锁。多个读者可以并行持有读锁；写者独占，且等待中的写者会阻止新的读者进入。
+    """
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._readers = 0
+        self._writer_active = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read_lock(self):
+        with self._cond:
+            while self._writer_active or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write_lock(self):
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                while self._writer_active or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer_active = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer_active = False
+                self._cond.notify_all()
+
+
 class InferenceService:
     def __init__(self, app: Flask, user_session_manager: UserSessionManager, inference_executor: InferenceExecutor):
         self.app = app
@@ -424,10 +513,22 @@ class InferenceService:
         if not os.path.exists(self.user_model_base_dir):
             os.makedirs(self.user_model_base_dir)
 
+        # 允许的模型后缀只在初始化时读取一次 (统一小写)
+        self._allowed_exts = frozenset(
+            ext.lower() for ext in self.app.config.get('ALLOWED_MODEL_EXTENSIONS', ['.pt', '.onnx']))
+        self._allowed_exts_tuple = tuple(self._allowed_exts)  # 供 str.endswith 使用
+        self._allowed_exts_display = ', '.join(sorted(self._allowed_exts))
+        # user_id -> 已创建的推理模型目录路径
+        self._user_inference_dir_cache = {}
+
         self.user_loaded_models = {}
         self.user_model_management_locks = {}
         self._main_model_management_lock = Lock()
 
+        # 模型加载专用线程池，限制同时加载的模型数量，多余的加载请求排队
+        self._load_pool = ThreadPoolExecutor(max_workers=self.app.config.get('LOAD_PARALLELISM', 2),
+                                             thread_name_prefix='modelload')
+
         self._user_model_last_access = {}
         self.model_max_idle_time_seconds = self.app.config.get('MODEL_MAX_IDLE_SECONDS', 15*60)
         self._cleanup_interval_seconds = self.app.config.get('MODEL_CLEANUP_INTERVAL_SECONDS', 60)
@@ -444,11 +545,12 @@ class InferenceService:
 
     def _get_user_model_management_lock(self, user_id):
         """
-        获取或创建用户特定的模型管理锁。
+        获取或创建用户特定的模型管理读写锁。
+        加载/弹出/删除模型使用写锁；start_inference 只读取模型状态，使用读锁。
         """
         with self._main_model_management_lock:
             if user_id not in self.user_model_management_locks:
-                self.user_model_management_locks[user_id] = Lock()
+                self.user_model_management_locks[user_id] = ReadWriteLock()
             return self.user_model_management_locks[user_id]
 
     def _model_cleanup_task(self):
@@ -476,7 +578,7 @@ class InferenceService:
 
                 for user_id_to_eject in users_to_eject:
                     user_lock = self._get_user_model_management_lock(user_id_to_eject)
-                    with user_lock:
+                    with user_lock.write_lock():
                         if user_id_to_eject in self.user_loaded_models:
                             current_last_access = self._user_model_last_access.get(user_id_to_eject, 0)
                             if now - current_last_access > self.model_max_idle_time_seconds:
@@ -511,6 +613,26 @@ class InferenceService:
             if self._cleanup_thread.is_alive():
                 self.app.logger.warning("InferenceService 清理线程未能及时停止。")
         self.app.logger.info("InferenceService 清理线程已处理停止请求。")
+        self._load_pool.shutdown(wait=False, cancel_futures=True)
+        self.app.logger.info("InferenceService 模型加载线程池已关闭。")
+
+    def preload_models(self, model_paths):
+        """
+        启动时 (Waitress 开始接受请求之前) 预读常用模型权重文件到页缓存，
+        首个加载该模型的请求不必再从磁盘读取数百 MB。返回成功预读的总字节数。
+        """
+        total = 0
+        for model_path in model_paths or ():
+            try:
+                size = prefetch_file(model_path)
+            except OSError as e:
+                self.app.logger.warning(f"预读模型权重 {model_path} 失败: {e}")
+                continue
+            total += size
+            self.app.logger.info(f"已预读模型权重: {model_path} ({size / (1024 * 1024):.1f} MB)")
+        if total:
+            self.app.logger.info(f"模型权重预读完成，共 {total / (1024 * 1024):.1f} MB")
+        return total
 
     def _load_model_task(self, user_id, model_name, model_path):
         # 在新线程中，必须使用 app_context
@@ -520,7 +642,7 @@ class InferenceService:
                 model_instance = YoloModel(model_path)
 
                 user_lock = self._get_user_model_management_lock(user_id)
-                with user_lock:
+                with user_lock.write_lock():
                     current_task_info = self.user_loaded_models.get(user_id)
                     if current_task_info and \
                             current_task_info['model_name'] == model_name and \
@@ -528,7 +650,7 @@ class InferenceService:
                         self.user_loaded_models[user_id].update({
                             'model_instance': model_instance,
                             'status': 'loaded',
-                            'load_thread': None,
+                            'load_future': None,
                             'error_message': None
                         })
                         self._update_model_last_access(user_id)
@@ -542,7 +664,7 @@ class InferenceService:
             except Exception as e:
                 self.app.logger.error(f"用户 {user_id} 模型加载线程：加载模型 {model_name} 失败: {e}", exc_info=True)
                 user_lock = self._get_user_model_management_lock(user_id)
-                with user_lock:
+                with user_lock.write_lock():
                     current_task_info = self.user_loaded_models.get(user_id)
                     if current_task_info and \
                             current_task_info['model_name'] == model_name and \
@@ -550,19 +672,22 @@ class InferenceService:
                         self.user_loaded_models[user_id].update({
                             'status': 'error',
                             'error_message': str(e),
-                            'load_thread': None,
+                            'load_future': None,
                             'model_instance': None
                         })
 
     def _get_user_inference_model_dir(self, user_id):
-        """获取指定用户用于推理的模型的存储目录路径"""
-        user_inference_dir = os.path.join(self.user_model_base_dir, str(user_id), "inference_models")
-        os.makedirs(user_inference_dir, exist_ok=True)
+        """获取指定用户用于推理的模型的存储目录路径 (首次调用时创建并缓存)"""
+        user_inference_dir = self._user_inference_dir_cache.get(user_id)
+        if user_inference_dir is None:
+            user_inference_dir = os.path.join(self.user_model_base_dir, str(user_id), "inference_models")
+            os.makedirs(user_inference_dir, exist_ok=True)
+            self._user_inference_dir_cache[user_id] = user_inference_dir
         return user_inference_dir
 
     def _get_safe_model_path(self, user_id, model_name):
         """获取用户模型文件的安全绝对路径，并执行安全检查"""
-        if not model_name or '..' in model_name or '/' in model_name or '\\' in model_name:
+        if not model_name or _DOTDOT in model_name or not _SAFE_NAME_RE.match(model_name):
             # 基本的文件名安全检查
             raise ValueError(f"无效的模型名称: {model_name}")
 
@@ -687,8 +812,7 @@ class InferenceService:
                 return [], 200  # 返回空列表和成功状态码
 
             for filename in os.listdir(user_model_dir):
-                allowed_extensions = tuple(self.app.config.get('ALLOWED_MODEL_EXTENSIONS', ['.pt', '.onnx']))
-                if filename.lower().endswith(allowed_extensions):
+                if filename.lower().endswith(self._allowed_exts_tuple):
                     filepath = os.path.join(user_model_dir, filename)
                     try:
                         stat = os.stat(filepath)
@@ -699,7 +823,7 @@ class InferenceService:
                             "bytesize": formatted_size
                         })
                     except OSError as e:
-                        self.app.logger.error(f"无法获取用户 {user_id} 的模型文件信息 {filepath}: {e}")
+                        self.app.logger.warning(f"无法获取用户 {user_id} 的模型文件信息 {filepath}: {e}")
                         # 跳过这个文件，继续处理下一个
             self.app.logger.info(f"为用户 {user_id} 获取到 {len(models)} 个模型 (大小已格式化)")
             return models, 200
@@ -710,7 +834,7 @@ class InferenceService:
 
     def load_model(self, user_id, model_name):
         user_lock = self._get_user_model_management_lock(user_id)
-        with user_lock:
+        with user_lock.write_lock():
             self.app.logger.info(f"用户 {user_id} 请求加载模型: {model_name}")
             try:
                 model_path = self._get_safe_model_path(user_id, model_name)
@@ -735,12 +859,13 @@ class InferenceService:
                     self._eject_model_internal(user_id, current_model_info)  # 内部弹出也会清理时间戳
 
             self.app.logger.info(f"用户 {user_id} 开始异步加载模型: {model_name} @ {model_path}")
-            load_thread = Thread(target=self._load_model_task, args=(user_id, model_name, model_path));
-            load_thread.daemon = True
+            # 先登记 'loading' 状态再提交，_load_model_task 完成时依赖该状态判断是否仍然有效
             self.user_loaded_models[user_id] = {'model_name': model_name, 'model_instance': None,
-                                                'load_thread': load_thread, 'status': 'loading', 'error_message': None}
+                                                'load_future': None, 'status': 'loading', 'error_message': None}
             # 注意：此时模型还未加载完成，不在 load_model 中直接更新时间戳，而是在 _load_model_task 成功后更新
-            load_thread.start()
+            load_future = self._load_pool.submit(self._load_model_task, user_id, model_name, model_path)
+            if self.user_loaded_models.get(user_id, {}).get('status') == 'loading':
+                self.user_loaded_models[user_id]['load_future'] = load_future
             self.user_session_manager.set_selected_model(user_id, model_name)
             return {"message": f"模型 '{model_name}' 开始加载。", "loadedModel": model_name}, 200
 
@@ -749,7 +874,11 @@ class InferenceService:
         self.app.logger.info(f"内部弹出用户 {user_id} 的模型: {model_name_to_eject}")
 
         if model_info_to_eject['status'] == 'loading':
-            self.app.logger.info(f"模型 {model_name_to_eject} (用户 {user_id}) 加载中，标记取消。")
+            load_future = model_info_to_eject.get('load_future')
+            if load_future is not None and load_future.cancel():
+                self.app.logger.info(f"模型 {model_name_to_eject} (用户 {user_id}) 仍在加载队列中，已取消。")
+            else:
+                self.app.logger.info(f"模型 {model_name_to_eject} (用户 {user_id}) 加载中，标记取消。")
         elif model_info_to_eject['status'] == 'loaded':
             instance = model_info_to_eject.get('model_instance')
             if instance: self.app.logger.info(f"释放用户 {user_id} 模型实例: {model_name_to_eject}"); del instance
@@ -764,7 +893,7 @@ class InferenceService:
 
     def eject_model(self, user_id):
         user_lock = self._get_user_model_management_lock(user_id)
-        with user_lock:
+        with user_lock.write_lock():
             self.app.logger.info(f"用户 {user_id} 请求弹出模型。")
             current_model_info = self.user_loaded_models.get(user_id)
             if not current_model_info:
@@ -784,8 +913,6 @@ class InferenceService:
         uploaded_model_names = []
         errors = []
 
-        allowed_extensions = self.app.config.get('ALLOWED_MODEL_EXTENSIONS', ['.pt', '.onnx'])
-
         for file_storage in files:
             original_filename = file_storage.filename
             if not original_filename:
@@ -794,12 +921,13 @@ class InferenceService:
 
             # 安全地获取文件名并检查后缀
             safe_filename = os.path.basename(original_filename)  # 移除路径部分
-            _, ext = os.path.splitext(safe_filename)
-            if ext.lower() not in allowed_extensions:
+            _, dot, ext_body = safe_filename.rpartition('.')
+            ext = dot + ext_body if dot else ''
+            if ext.lower() not in self._allowed_exts:
                 errors.append(
-                    f"文件 '{original_filename}' 的后缀 '{ext}' 不被允许。允许的后缀: {', '.join(allowed_extensions)}")
+                    f"文件 '{original_filename}' 的后缀 '{ext}' 不被允许。允许的后缀: {self._allowed_exts_display}")
                 continue
-            if '..' in safe_filename or '/' in safe_filename or '\\' in safe_filename:
+            if _DOTDOT in safe_filename or not _SAFE_NAME_RE.match(safe_filename):
                 errors.append(f"文件名 '{original_filename}' 包含不允许的字符。")
                 continue
 
@@ -815,15 +943,13 @@ class InferenceService:
                 uploaded_model_names.append(safe_filename)
                 self.app.logger.info(f"用户 {user_id} 成功上传模型: {dest_path}")
             except Exception as e:
-                self.app.logger.error(f"用户 {user_id} 上传模型 '{original_filename}' 到 {dest_path} 失败: {e}",
-                                         exc_info=True)
+                self.app.logger.warning(f"用户 {user_id} 上传模型 '{original_filename}' 到 {dest_path} 失败: {e}")
                 errors.append(f"上传文件 '{original_filename}' 失败: {e}")
                 # 如果保存失败，尝试清理可能已创建的文件
-                if os.path.exists(dest_path):
-                    try:
-                        os.remove(dest_path)
-                    except OSError:
-                        pass  # 忽略清理错误
+                try:
+                    remove_if_exists(dest_path)
+                except OSError:
+                    pass  # 忽略清理错误
 
         if errors:
             # 如果有错误，即使部分成功也可能返回失败状态
@@ -839,40 +965,55 @@ class InferenceService:
     def delete_model(self, user_id, model_name):
         """
         删除用户指定的模型文件。如果删除的是当前加载的模型，也需要将其从内存中弹出。
+        删除与当前活动模型无关的文件时不获取用户写锁，避免批量删除阻塞正在进行的推理。
         """
-        user_lock = self._get_user_model_management_lock(user_id)  # 获取锁以安全操作 user_loaded_models
-        with user_lock:
-            try:
-                model_path = self._get_safe_model_path(user_id, model_name)
-                if not os.path.isfile(model_path):
-                    raise FileNotFoundError(f"模型文件 '{model_name}' 未找到。")
+        try:
+            model_path = self._get_safe_model_path(user_id, model_name)
+            if not os.path.isfile(model_path):
+                raise FileNotFoundError(f"模型文件 '{model_name}' 未找到。")
 
-                # 检查是否是当前加载/正在加载的模型
-                current_model_info = self.user_loaded_models.get(user_id)
-                was_active_model = False
-                if current_model_info and current_model_info['model_name'] == model_name:
-                    self.app.logger.info(f"用户 {user_id} 删除的模型 {model_name} 是当前活动模型，将执行弹出。")
-                    self._eject_model_internal(user_id, current_model_info)  # 内部弹出
-                    was_active_model = True
+            user_lock = self._get_user_model_management_lock(user_id)
+            was_active_model = False
 
+            # 快速路径：乐观读取当前活动模型，不相关的文件直接删除
+            current_model_info = self.user_loaded_models.get(user_id)
+            if current_model_info is None or current_model_info['model_name'] != model_name:
                 os.remove(model_path)  # 物理删除文件
                 self.app.logger.info(f"用户 {user_id} 成功删除模型文件: {model_path}")
+                # 锁内复查：删除期间可能有并发请求开始加载同名模型
+                with user_lock.write_lock():
+                    current_model_info = self.user_loaded_models.get(user_id)
+                    if current_model_info and current_model_info['model_name'] == model_name:
+                        self.app.logger.info(f"用户 {user_id} 删除的模型 {model_name} 在删除期间被加载，执行弹出。")
+                        self._eject_model_internal(user_id, current_model_info)
+                        was_active_model = True
+            else:
+                with user_lock.write_lock():  # 获取锁以安全操作 user_loaded_models
+                    # 检查是否是当前加载/正在加载的模型
+                    current_model_info = self.user_loaded_models.get(user_id)
+                    if current_model_info and current_model_info['model_name'] == model_name:
+                        self.app.logger.info(f"用户 {user_id} 删除的模型 {model_name} 是当前活动模型，将执行弹出。")
+                        self._eject_model_internal(user_id, current_model_info)  # 内部弹出
+                        was_active_model = True
+
+                    os.remove(model_path)  # 物理删除文件
+                    self.app.logger.info(f"用户 {user_id} 成功删除模型文件: {model_path}")
+
+            # 如果删除的是会话中选择的模型，也清除该选择
+            if self.user_session_manager.get_selected_model(user_id) == model_name:
+                self.user_session_manager.clear_selected_model(user_id)
 
-                # 如果删除的是会话中选择的模型，也清除该选择
-                if self.user_session_manager.get_selected_model(user_id) == model_name:
-                    self.user_session_manager.clear_selected_model(user_id)
-
-                message = f"模型 '{model_name}' 已成功删除。"
-                if was_active_model:
-                    message += " 该模型也已从当前活动状态中卸载。"
-                return {"message": message}, 200
+            message = f"模型 '{model_name}' 已成功删除。"
+            if was_active_model:
+                message += " 该模型也已从当前活动状态中卸载。"
+            return {"message": message}, 200
 
-            except (FileNotFoundError, PermissionError, ValueError) as e:
-                raise e
-            except Exception as e:
-                self.app.logger.error(f"删除模型时发生意外错误 (用户 {user_id}, 模型 {model_name}): {e}",
-                                         exc_info=True)
-                raise RuntimeError("删除模型时发生内部错误")
+        except (FileNotFoundError, PermissionError, ValueError) as e:
+            raise e
+        except Exception as e:
+            self.app.logger.error(f"删除模型时发生意外错误 (用户 {user_id}, 模型 {model_name}): {e}",
+                                     exc_info=True)
+            raise RuntimeError("删除模型时发生内部错误")
 
     def clear(self, user_id):
         """清空用户上传的内容"""
@@ -899,7 +1040,7 @@ class InferenceService:
         selected_model_name = "未知"
 
         user_lock = self._get_user_model_management_lock(user_id)
-        with user_lock:
+        with user_lock.read_lock():
             user_model_data = self.user_loaded_models.get(user_id)
             if not user_model_data:
                 session_selected = self.user_session_manager.get_selected_model(user_id)
@@ -913,7 +1054,8 @@ class InferenceService:
             if user_model_data['status'] == 'loaded':
                 model_instance = user_model_data.get('model_instance')
                 if not model_instance: raise RuntimeError(f"模型 '{selected_model_name}' 状态异常，实例为空。")
-                self._update_model_last_access(user_id)  # --- 更新时间戳 ---
+                # --- 更新时间戳 --- (单次字典赋值，多个读者并发写同一键是安全的)
+                self._update_model_last_access(user_id)
                 self.app.logger.info(f"用户 {user_id} 推理：使用已加载模型 {selected_model_name}")
             else:
                 raise RuntimeError(f"模型 '{selected_model_name}' 状态未知 ({user_model_data['status']})。")
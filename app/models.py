@@ -1,8 +1,21 @@
 # app/models.py
 from .database import db
+from sqlalchemy.ext.mutable import MutableDict
 from werkzeug.security import generate_password_hash, check_password_hash
 import datetime
 
+# --- 密码哈希: 优先使用 Argon2id (argon2-cffi)，未安装时回退到 Werkzeug ---
+try:
+    from argon2 import PasswordHasher
+    from argon2.exceptions import VerifyMismatchError, VerificationError, InvalidHashError
+    # 参数按单次哈希约 100ms 校准 (time_cost=3, 64 MiB, 2 线程)
+    _ph = PasswordHasher(time_cost=3, memory_cost=65536, parallelism=2)
+except ImportError:
+    _ph = None
+
+# Werkzeug 生成的旧哈希前缀，登录成功后会被透明地重新哈希为 Argon2id
+_LEGACY_HASH_PREFIXES = ('pbkdf2:', 'scrypt:')
+
 
 class User(db.Model):
     """用户模型"""
@@ -10,21 +23,46 @@ class User(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
-    password_hash = db.Column(db.String(128), nullable=False)
+    password_hash = db.Column(db.String(256), nullable=False)
 
-    # 反向关系
-    finetune_tasks = db.relationship('FinetuneTask', backref='user', lazy='dynamic') # lazy='dynamic' 更适合大量关联对象
-    validate_tasks = db.relationship('ValidateTask', backref='user', lazy='dynamic') # 新增
+    # 反向关系: lazy='raise' 禁止隐式加载，任务列表请通过服务层的 list_user_tasks 显式查询
+    finetune_tasks = db.relationship('FinetuneTask', back_populates='user', lazy='raise', passive_deletes=True)
+    validate_tasks = db.relationship('ValidateTask', back_populates='user', lazy='raise', passive_deletes=True)
 
     def __init__(self, username, password):
         self.username = username
         self.set_password(password)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        if _ph is not None:
+            self.password_hash = _ph.hash(password)
+        else:
+            self.password_hash = generate_password_hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """
+        校验密码。旧的 PBKDF2/scrypt 哈希校验成功后会就地升级为 Argon2id，
+        调用方需要提交会话以持久化新的哈希。
+        """
+        if not self.password_hash:
+            return False
+
+        if self.password_hash.startswith(_LEGACY_HASH_PREFIXES):
+            if not check_password_hash(self.password_hash, password):
+                return False
+            if _ph is not None:
+                self.password_hash = _ph.hash(password)
+            return True
+
+        if _ph is None:
+            return False
+        try:
+            _ph.verify(self.password_hash, password)
+        except (VerifyMismatchError, VerificationError, InvalidHashError):
+            return False
+        if _ph.check_needs_rehash(self.password_hash):
+            self.password_hash = _ph.hash(password)
+        return True
 
     def __repr__(self):
         return f'<User {self.username}>'
@@ -36,6 +74,11 @@ class User(db.Model):
 class FinetuneTask(db.Model):
     """微调任务模型"""
     __tablename__ = 'finetune_tasks'
+    # 任务列表/轮询查询按 (user_id, status, created_at) 过滤排序；排队位置查询按 status 扫描
+    __table_args__ = (
+        db.Index('ix_ft_user_status_created', 'user_id', 'status', 'created_at'),
+        db.Index('ix_ft_status_started', 'status', 'started_at'),
+    )
 
     id = db.Column(db.String(36), primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -48,7 +91,7 @@ class FinetuneTask(db.Model):
     base_model_identifier = db.Column(db.String(255), nullable=True)
     dataset_zip_name = db.Column(db.String(255), nullable=True)
     dataset_yaml_name = db.Column(db.String(255), nullable=True)
-    training_params_json = db.Column(db.Text, nullable=True)
+    training_params_json = db.Column(MutableDict.as_mutable(db.JSON), nullable=True)
 
     task_dir_name = db.Column(db.String(255), nullable=True)
     input_base_model_name = db.Column(db.String(255), nullable=True)
@@ -71,7 +114,9 @@ class FinetuneTask(db.Model):
     current_speed = db.Column(db.String(50), nullable=True)
 
     # metrics_json 已经存在，可以用来存储每个epoch的详细指标，包括最终的 best_epoch
-    metrics_json = db.Column(db.Text, nullable=True)
+    metrics_json = db.Column(MutableDict.as_mutable(db.JSON), nullable=True)
+    # 轮次内的批次进度 (当前批次、速度、批次损失)，由回调高频写入；轮次结束时并入 metrics_json 并清空
+    batch_progress_json = db.Column(db.JSON, nullable=True)
     # (可选) 如果想把 best_epoch 单独提出来，而不是仅在 metrics_json 中
     # best_epoch_number = db.Column(db.Integer, nullable=True)
 
@@ -80,6 +125,8 @@ class FinetuneTask(db.Model):
     # 新增: 错误代码
     error_code = db.Column(db.String(50), nullable=True)
 
+    user = db.relationship('User', back_populates='finetune_tasks')
+
     def __repr__(self):
         return f'<FinetuneTask {self.id} (User: {self.user_id}, Status: {self.status})>'
 
@@ -90,6 +137,11 @@ class FinetuneTask(db.Model):
 class ValidateTask(db.Model):
     """验证任务模型"""
     __tablename__ = 'validate_tasks'
+    __table_args__ = (
+        db.Index('ix_val_user_status_created', 'user_id', 'status', 'created_at'),
+        db.Index('ix_val_status_started', 'status', 'started_at'),
+        db.Index('ix_val_status_created', 'status', 'created_at'),
+    )
 
     id = db.Column(db.String(36), primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -103,7 +155,7 @@ class ValidateTask(db.Model):
     dataset_identifier = db.Column(db.String(255), nullable=True)
     dataset_zip_name_val = db.Column(db.String(255), nullable=True)
     dataset_yaml_name_val = db.Column(db.String(255), nullable=True)
-    validation_params_json = db.Column(db.Text, nullable=True)
+    validation_params_json = db.Column(MutableDict.as_mutable(db.JSON), nullable=True)
 
     task_dir_name_val = db.Column(db.String(255), nullable=True)
     input_model_name_val = db.Column(db.String(255), nullable=True)
@@ -124,12 +176,14 @@ class ValidateTask(db.Model):
     current_speed_val = db.Column(db.String(50), nullable=True)  # 例如 "300 img/s"
 
     # results_json 已经存在，用于存储最终的验证指标
-    results_json = db.Column(db.Text, nullable=True)
+    results_json = db.Column(MutableDict.as_mutable(db.JSON), nullable=True)
 
     # --- 错误相关字段 ---
     error_message = db.Column(db.Text, nullable=True)
     # 新增: 错误代码
     error_code = db.Column(db.String(50), nullable=True)
 
+    user = db.relationship('User', back_populates='validate_tasks')
+
     def __repr__(self):
         return f'<ValidateTask {self.id} (User: {self.user_id}, Status: {self.status})>'
\ No newline at end of file
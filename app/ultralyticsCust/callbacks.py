@@ -1,12 +1,111 @@
 # app/ultralyticsCust/callbacks.py
 import os
-import json
 import logging
 import time
+import threading
+import queue
+import numpy as np
 from app.models import FinetuneTask
-from app.database import db
+from app.utils.json_utils import dumps_bytes, loads
+from sqlalchemy import func, select, update
 from sqlalchemy.orm import Session
 from math import ceil  # 导入ceil用于向上取整
+from operator import attrgetter
+
+# 可选依赖: watchfiles 或 inotify_simple (仅 Linux) 提供目录监听，都未安装时回退到目录 mtime 缓存
+try:
+    import watchfiles
+except ImportError:
+    watchfiles = None
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+# on_train_batch_end 每 N 个批次才读一次时钟做写库节流判断；N 的初始值，之后按实测批次耗时自动调整
+_INITIAL_BATCH_UPDATE_EVERY = 16
+# 没有目录监听线程时，每 32 个批次才检查一次取消信号文件；轮次结束时始终检查
+_CANCEL_CHECK_MASK = 0x1F
+
+# trainer.speed 中参与单批耗时求和的字段 (毫秒)
+_SPEED_KEYS = ('preprocess', 'inference', 'loss', 'postprocess', 'forward', 'backward')
+
+# 批次进度通过 Celery 上报的最小变化量 (百分点)
+CELERY_PROGRESS_MIN_DELTA = 0.5
+# 写库线程向 Celery 结果后端发送批次进度的最小时间间隔 (秒)；只保留最新的一条
+CELERY_UPDATE_MIN_INTERVAL = 1.0
+
+# 每轮结束时期望出现在 trainer.metrics 中的训练损失
+_REQUIRED_TRAIN_LOSS_KEYS = frozenset(('train/box_loss', 'train/cls_loss', 'train/dfl_loss'))
+
+
+# 批次进度只写入这些易变字段 (batch_progress_json 列)；完整的 metrics_json 只在轮次结束与训练结束时写入
+_BATCH_PROGRESS_FIELDS = (
+    'current_batch', 'total_batches_in_epoch', 'iterations_per_second_batch', 'batch_loss',
+    'train/box_loss', 'train/cls_loss', 'train/dfl_loss',
+)
+
+
+# 取消/完成时写库的固定字段模板；调用处只合并易变的 completed_at 等字段
+_CANCEL_UPDATES = {
+    "status": 'cancelled',
+    "error_message": "任务被用户通过回调中的信号文件检测取消。",
+}
+_COMPLETED_UPDATES = {
+    "status": 'completed',
+    "error_message": None,
+    "batch_progress_json": None,
+}
+
+
+# 视为数值指标的类型: trainer.metrics 中的 NumPy 标量 (如 np.float32) 也按数值处理，而不是转成字符串
+_NUMERIC_METRIC_TYPES = (float, int, np.floating, np.integer)
+
+
+def _round_metrics(metrics: dict, numeric_only: bool = False) -> dict:
+    """把指标字典中的数值统一保留 5 位小数 (一次向量化 np.round)；非数值转为字符串，或在 numeric_only 时丢弃。"""
+    numeric_keys = []
+    numeric_values = []
+    rounded = {}
+    for k, v in metrics.items():
+        if isinstance(v, _NUMERIC_METRIC_TYPES):
+            numeric_keys.append(k)
+            numeric_values.append(v)
+        elif not numeric_only:
+            rounded[k] = str(v)
+    if numeric_values:
+        values = np.fromiter(numeric_values, dtype=np.float64, count=len(numeric_values))
+        rounded.update(zip(numeric_keys, np.round(values, 5).tolist()))
+    return rounded
+
+
+def _to_host(tensor):
+    """
+    把损失张量拷回 CPU。CUDA 张量用 non_blocking 拷贝后只同步当前流，
+    不做整个设备的 synchronize，其他流上的工作不受影响。
+    """
+    import torch  # ultralytics 的依赖，延迟导入
+
+    with torch.no_grad():
+        detached = tensor.detach()
+        if not detached.is_cuda:
+            return detached
+        host = detached.to("cpu", non_blocking=True)
+        torch.cuda.current_stream(detached.device).synchronize()
+        return host
+
+
+class _Abbrev:
+    """日志参数包装: 只有在日志真正输出时才把对象转成字符串并截断到 limit 个字符。"""
+    __slots__ = ('obj', 'limit')
+
+    def __init__(self, obj, limit: int = 200):
+        self.obj = obj
+        self.limit = limit
+
+    def __str__(self):
+        text = str(self.obj)
+        return text if len(text) < self.limit else text[:self.limit] + '...'
 
 
 class FinetuneProgressCallback:
@@ -16,6 +115,17 @@ class FinetuneProgressCallback:
     大约每隔指定时间间隔更新一次数据库中的批次进度。
     """
 
+    # 注册到 Ultralytics 的事件，与同名方法一一对应
+    YOLO_HOOKS = (
+        'on_pretrain_routine_start',
+        'on_pretrain_routine_end',
+        'on_train_batch_start',
+        'on_fit_epoch_end',
+        'on_train_batch_end',
+        'on_model_save',
+        'on_train_end',
+    )
+
     def __init__(self,
                  task_id: str,
                  user_id: int,
@@ -24,84 +134,397 @@ class FinetuneProgressCallback:
                  logger: logging.Logger,
                  total_epochs_from_task: int = 0,
                  celery_task_update_state_func: callable = None,
-                 db_update_interval_seconds: int = 5):
+                 db_update_interval_seconds: int = 5,
+                 read_session_maker: callable = None,
+                 report_detailed_losses: bool = True,
+                 cancel_event: threading.Event = None):
         self.task_id = task_id
         self.user_id = user_id
         self.db_session_maker = db_session_maker
+        # 可选: 启动时一次性读取使用的会话工厂 (返回可用于 with 的会话)，不占用写库连接；未提供时复用写会话
+        self.read_session_maker = read_session_maker
         self.user_task_base_dir = user_task_base_dir
         self.logger = logger
         self.cancel_signal_file = os.path.join(self.user_task_base_dir, ".cancel_signal")
+        # 最近一次写库的指标快照，中断后重新开始训练时直接读取，省去一次查询
+        self._metrics_cache_path = os.path.join(self.user_task_base_dir, ".metrics_cache.json")
         self.initial_total_epochs = total_epochs_from_task
         self._trainer = None
         self.celery_task_update_state_func = celery_task_update_state_func
+        # 是否在批次进度中上报 box/cls/dfl 分项损失 (label_loss_items 需要一次设备同步)；
+        # 网页端从 batch_progress_json 读取这些损失，默认上报，只有调用方显式关闭时才跳过
+        self._report_detailed_losses = report_detailed_losses
+        # 上次通过 Celery 上报的总进度；批次进度变化不足阈值时不再发送
+        self._last_sent_percent = -1.0
+        # 整个训练过程复用同一个会话，避免每次更新都从连接池签出/归还连接
+        self._session: Session = None
 
         self.db_update_interval = db_update_interval_seconds
+        # 节流判断全部使用 time.monotonic_ns() 的整数纳秒
+        self._db_interval_ns = int(db_update_interval_seconds * 1_000_000_000)
         self.last_db_update_time_batch = 0
+        # 批次计数快速路径: 只有计数到 _batch_update_every 的倍数时才做后续工作
+        self._batch_counter = 0
+        self._batch_update_every = _INITIAL_BATCH_UPDATE_EVERY
+        self._last_emit_batch_counter = 0
         self.last_metrics_for_db = {}
+        # 批次进度字段的复用字典，与 last_metrics_for_db (上一轮指标快照) 分开，只在轮次结束时清空
+        self._batch_scratch = {}
 
         self.batch_start_time_manual = 0
         self.ema_batch_time_manual = None
         self.ema_alpha_manual = 0.1
+        # 速度来源在首次计算时探测一次，之后直接调用对应方法
+        self._itps_source = None
+        self._itps_fn = None
+        # 详细损失的提取方式，同样在首次上报时确定
+        self._extract_losses_fn = None
+        # trainer.epoch 的读取方式只探测一次: None 表示尚未探测，False 表示 trainer 没有该属性
+        self._epoch_getter = None
+        # trainer.metrics 规范化结果的缓存: 原始值未变的键直接复用上次的结果
+        self._raw_metrics_cache = {}
+        self._norm_metrics_cache = {}
 
         # 计数器
         self.manual_batch_counter_for_epoch = 0  # 1-indexed counter for batches within an epoch
         self.last_epoch_for_manual_counter = -1  # Tracks the epoch for resetting the counter
 
+        # 每轮缓存一次的训练规模，避免每个批次重复 len(train_loader) 等属性查找
+        self._total_batches_in_epoch = 0
+        self._total_epochs = 0
+
+        # 取消信号状态: 由后台监听线程置位，或在目录 mtime 变化时重新检查
+        self._cancel_flag = False
+        # _check_cancel_signal 处理过取消信号后置位 (信号文件届时已被删除)，供 on_train_end 判断训练是否因取消而结束
+        self._cancelled_by_signal = False
+        self._cancel_stop_evt = threading.Event()
+        self._cancel_watcher: threading.Thread = None
+        self._task_dir_mtime_ns = None
+        # 可选: 由外部 (如在另一线程轮询 Redis 取消标记的 Celery 任务) 置位的取消事件
+        self._cancel_event = cancel_event
+
+        # 后台写库线程: 队列容量为 1，新的批次更新会覆盖尚未写入的旧更新
+        self._db_queue = queue.Queue(maxsize=1)
+        self._db_submit_seq = 0  # 训练线程递增
+        # 写库线程缓冲的批次进度上报，按 CELERY_UPDATE_MIN_INTERVAL 限速发送
+        self._celery_lock = threading.Lock()
+        self._pending_celery_meta = None
+        self._last_celery_send_ns = 0
+        self._celery_interval_ns = int(CELERY_UPDATE_MIN_INTERVAL * 1_000_000_000)
+        self._db_written_seq = 0  # 写库线程记录已写入的最大序号
+        self._db_worker_thread = threading.Thread(target=self._db_worker, daemon=True,
+                                                  name=f"dbwriter-{self.task_id[:8]}")
+        self._db_worker_thread.start()
+
         self.logger.info(
             f"[Callback:{self.task_id}] Initialized. DB update interval: {self.db_update_interval}s. Cancel signal file: {self.cancel_signal_file}")
 
-    def _get_and_update_task(self, updates: dict, session: Session):
-        task_record = session.query(FinetuneTask).filter_by(id=self.task_id, user_id=self.user_id).first()
-        if task_record:
-            for key, value in updates.items():
-                setattr(task_record, key, value)
-        else:
+    def _get_session(self) -> Session:
+        """惰性创建长期会话；重复调用返回同一实例，不会重新绑定。"""
+        if self._session is None:
+            self._session = self.db_session_maker()
+        return self._session
+
+    def as_yolo_hooks(self):
+        """返回 [(事件名, 绑定方法), ...]，供 model.add_callback 逐个注册。"""
+        return [(hook, getattr(self, hook)) for hook in self.YOLO_HOOKS]
+
+    def close_db_session(self):
+        """写完排队中的更新、停止写库线程并关闭长期会话。可重复调用，on_train_end 和任务收尾处都会调用。"""
+        if self._db_worker_thread is not None:
+            self._flush_db_updates()
+            self._db_queue.put(None)  # 刚 join 过，队列为空，不会阻塞
+            self._db_worker_thread = None
+        if self._session is not None:
+            try:
+                self._session.close()
+            except Exception as e:
+                self.logger.warning(f"[Callback:{self.task_id}] Error closing DB session: {e}")
+            finally:
+                self._session = None
+
+    def _select_task_columns(self, *columns):
+        # 只查询需要的列，返回 Row 而非完整的 ORM 对象
+        return select(*columns).where(FinetuneTask.id == self.task_id, FinetuneTask.user_id == self.user_id)
+
+    def _fetch_task_row(self, session: Session, *columns):
+        # 读取放在独立的短事务里，读完立即结束，不让会话一直持有 SQLite 读快照
+        with session.begin():
+            return session.execute(self._select_task_columns(*columns)).first()
+
+    def _update_task_row(self, updates: dict, session: Session) -> bool:
+        # 直接发出 UPDATE ... WHERE，不先 SELECT 加载 ORM 对象
+        result = session.execute(
+            update(FinetuneTask)
+            .where(FinetuneTask.id == self.task_id, FinetuneTask.user_id == self.user_id)
+            .values(**updates)
+        )
+        if result.rowcount == 0:
             self.logger.error(f"[Callback:{self.task_id}] Task not found in DB for update.")
-        return task_record
+            return False
+        return True
+
+    def _celery_wait_timeout(self):
+        # 有待发送的进度时，最多等到下一个发送时刻；否则一直阻塞等待新的写库项
+        if self._pending_celery_meta is None:
+            return None
+        remaining_ns = self._celery_interval_ns - (time.monotonic_ns() - self._last_celery_send_ns)
+        return max(0.0, remaining_ns / 1_000_000_000)
+
+    def _flush_pending_celery(self, force: bool = False):
+        with self._celery_lock:
+            meta = self._pending_celery_meta
+            if meta is None:
+                return
+            now_ns = time.monotonic_ns()
+            if not force and now_ns - self._last_celery_send_ns < self._celery_interval_ns:
+                return
+            self._pending_celery_meta = None
+            self._last_celery_send_ns = now_ns
+        self._send_celery_state(meta)
+
+    def _discard_pending_celery(self):
+        """轮次/训练结束的上报直接发送，先丢弃缓冲中更旧的批次进度，避免它随后覆盖新状态。"""
+        with self._celery_lock:
+            self._pending_celery_meta = None
+            self._last_celery_send_ns = time.monotonic_ns()
+
+    def _db_worker(self):
+        while True:
+            try:
+                item = self._db_queue.get(timeout=self._celery_wait_timeout())
+            except queue.Empty:
+                self._flush_pending_celery()
+                continue
+            try:
+                if item is None:
+                    self._flush_pending_celery(force=True)
+                    return
+                seq, updates, progress_snapshot, celery_meta, force_update = item
+                if seq <= self._db_written_seq:
+                    continue  # 已有更新的数据写入，丢弃过期项
+                if progress_snapshot is not None:
+                    # JSON 编码在 execute 时由引擎的 json_serializer 完成，即在本线程进行
+                    updates["batch_progress_json"] = progress_snapshot
+                self._write_db_update(updates, force_update)
+                self._db_written_seq = seq
+                if celery_meta is not None:
+                    with self._celery_lock:
+                        self._pending_celery_meta = celery_meta
+                    self._flush_pending_celery()
+            finally:
+                self._db_queue.task_done()
+
+    def _flush_db_updates(self):
+        """等待写库线程处理完所有已提交的更新，之后可在当前线程安全使用会话。"""
+        if self._db_worker_thread is not None and self._db_worker_thread.is_alive():
+            self._db_queue.join()
+
+    def _submit_db_update(self, item):
+        # 只有训练线程提交；强制更新会立即 join，因此被丢弃的只可能是未写入的批次更新
+        while True:
+            try:
+                self._db_queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._db_queue.get_nowait()
+                    self._db_queue.task_done()
+                except queue.Empty:
+                    pass
 
-    def _execute_db_update(self, updates: dict, force_update: bool = False):
-        current_time = time.time()
-        if not force_update and (current_time - self.last_db_update_time_batch < self.db_update_interval):
-            # self.logger.debug(f"[Callback:{self.task_id}] Skipping DB update due to interval.") # Can be noisy
+    def _write_db_update(self, updates: dict, force_update: bool):
+        try:
+            session = self._get_session()
+            # 显式事务: 正常退出时提交，异常时自动回滚
+            with session.begin():
+                self._update_task_row(updates, session)
+            if self.logger.isEnabledFor(logging.INFO):
+                self.logger.info("[Callback:%s] DB successfully updated with keys: %s. Forced: %s",
+                                 self.task_id, list(updates.keys()), force_update)
+        except Exception as e:
+            self.logger.error(f"[Callback:{self.task_id}] Error updating task in DB: {e}", exc_info=True)
             return
+        if isinstance(updates.get("metrics_json"), dict):
+            self._write_metrics_cache(updates["metrics_json"])
 
-        session: Session = None
+    def _write_metrics_cache(self, metrics: dict):
+        tmp_path = self._metrics_cache_path + ".tmp"
         try:
-            session = self.db_session_maker()
-            self._get_and_update_task(updates, session)
-            session.commit()
-            self.logger.info(
-                f"[Callback:{self.task_id}] DB successfully updated with keys: {list(updates.keys())}. Forced: {force_update}")
+            with open(tmp_path, 'wb') as f:
+                f.write(dumps_bytes({"task_id": self.task_id, "metrics": metrics}))
+            os.replace(tmp_path, self._metrics_cache_path)  # 原子替换，读方不会看到半个文件
+        except (OSError, TypeError, ValueError) as e:
+            self.logger.warning(f"[Callback:{self.task_id}] Could not write metrics cache: {e}")
 
-            if not force_update:
-                self.last_db_update_time_batch = current_time
+    def _read_metrics_cache(self):
+        try:
+            with open(self._metrics_cache_path, 'rb') as f:
+                cached = loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if isinstance(cached, dict) and cached.get("task_id") == self.task_id and isinstance(cached.get("metrics"), dict):
+            return cached["metrics"]
+        return None
+
+    def _remove_metrics_cache(self):
+        try:
+            os.remove(self._metrics_cache_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.warning(f"[Callback:{self.task_id}] Could not remove metrics cache: {e}")
+
+    def _should_emit_metrics(self, now_ns: int) -> bool:
+        """批次指标的写库节流判断，on_train_batch_end 与 _execute_db_update 共用。now_ns 取自 time.monotonic_ns()。"""
+        return (self.last_db_update_time_batch == 0 or
+                now_ns - self.last_db_update_time_batch >= self._db_interval_ns)
+
+    def _retune_batch_update_every(self, now_ns: int):
+        """按两次上报之间的平均批次耗时调整 N，使约半个写库间隔读一次时钟。"""
+        if self.last_db_update_time_batch != 0:
+            batches = self._batch_counter - self._last_emit_batch_counter
+            elapsed_ns = now_ns - self.last_db_update_time_batch
+            if batches > 0 and elapsed_ns > 0:
+                avg_batch_ns = elapsed_ns / batches
+                self._batch_update_every = max(1, int(self._db_interval_ns / avg_batch_ns / 2))
+        self._last_emit_batch_counter = self._batch_counter
+
+    def _send_celery_state(self, celery_meta: dict):
+        try:
+            self.celery_task_update_state_func(state='PROGRESS', meta=celery_meta)
+        except Exception as e_celery:
+            self.logger.error(f"[Callback:{self.task_id}] Error sending batch progress to Celery: {e_celery}",
+                              exc_info=False)
+
+    def _execute_db_update(self, updates: dict, metrics_dict: dict = None, force_update: bool = False,
+                           celery_meta: dict = None):
+        """
+        提交任务更新。普通批次更新交给后台线程异步写入，训练线程不等待提交；
+        force_update 会等待写入完成。metrics_dict 为调用方持有的指标字典，
+        提交时直接缓存为 last_metrics_for_db。celery_meta 不为空时，写库后由同一线程上报给 Celery。
+        """
+        current_time = time.monotonic_ns()
+        if not force_update and not self._should_emit_metrics(current_time):
+            # self.logger.debug(f"[Callback:{self.task_id}] Skipping DB update due to interval.") # Can be noisy
+            return
 
-            if "metrics_json" in updates:
-                try:
-                    if isinstance(updates["metrics_json"], str):
-                        self.last_metrics_for_db = json.loads(updates["metrics_json"])
-                    elif isinstance(updates["metrics_json"], dict):
-                        self.last_metrics_for_db = updates["metrics_json"]
-                    else:
-                        self.logger.warning(
-                            f"[Callback:{self.task_id}] metrics_json in updates was neither string nor dict. Type: {type(updates['metrics_json'])}")
-                except json.JSONDecodeError as e:
-                    self.logger.error(
-                        f"[Callback:{self.task_id}] Failed to decode metrics_json for caching: {e}. Metrics string: {updates['metrics_json']}")
-                except TypeError as e:
-                    self.logger.error(
-                        f"[Callback:{self.task_id}] metrics_json for caching was not a string or dict: {e}. Value: {updates['metrics_json']}")
+        if not force_update:
+            self.last_db_update_time_batch = current_time
+        if metrics_dict is not None:
+            self.last_metrics_for_db = metrics_dict
+
+        progress_snapshot = None
+        if isinstance(updates.get("batch_progress_json"), dict):
+            # 训练线程会继续原地修改指标字典，只取批次进度字段做快照；编码留给写库线程
+            live_metrics = updates["batch_progress_json"]
+            progress_snapshot = {k: live_metrics[k] for k in _BATCH_PROGRESS_FIELDS if k in live_metrics}
+
+        worker = self._db_worker_thread
+        if worker is None or not worker.is_alive():
+            if progress_snapshot is not None:
+                updates["batch_progress_json"] = progress_snapshot
+            self._write_db_update(updates, force_update)
+            if celery_meta is not None:
+                self._send_celery_state(celery_meta)
+            return
+
+        self._db_submit_seq += 1
+        self._submit_db_update((self._db_submit_seq, updates, progress_snapshot, celery_meta, force_update))
+        if force_update:
+            self._flush_db_updates()
+
+    def _resolve_total_batches(self, trainer) -> int:
+        total_batches_in_epoch = 0
+        if hasattr(trainer, 'train_loader') and trainer.train_loader:
+            total_batches_in_epoch = len(trainer.train_loader)
+        elif hasattr(trainer, 'batches_per_epoch'):  # Fallback, might not be set early
+            total_batches_in_epoch = trainer.batches_per_epoch
+
+        if total_batches_in_epoch == 0 and hasattr(trainer, 'args') and hasattr(trainer.args,
+                                                                                'nbs'):  # nbs: nominal batch size (total batches in an epoch)
+            total_batches_in_epoch = getattr(trainer.args, 'nbs', 0)
+            if total_batches_in_epoch > 0:
+                self.logger.info(
+                    f"[Callback:{self.task_id}] Used trainer.args.nbs for total_batches_in_epoch: {total_batches_in_epoch}")
+        return total_batches_in_epoch
+
+    def _trainer_epoch(self, trainer) -> int:
+        """返回 0 起始的当前轮次；trainer 没有 epoch 属性时返回 -1。"""
+        getter = self._epoch_getter
+        if getter is None:
+            getter = self._epoch_getter = attrgetter('epoch') if hasattr(trainer, 'epoch') else False
+        return int(getter(trainer)) if getter else -1
+
+    def _resolve_total_epochs(self, trainer) -> int:
+        # 与 on_pretrain_routine_end 写库的逻辑一致: 都取不到时按 1 轮计
+        return int(getattr(trainer, 'epochs', 0) or self.initial_total_epochs or 1)
+
+    def _watch_cancel(self):
+        try:
+            for changes in watchfiles.watch(self.user_task_base_dir, stop_event=self._cancel_stop_evt,
+                                            recursive=False):
+                if any(os.path.basename(path) == ".cancel_signal" for _, path in changes):
+                    self._cancel_flag = os.path.exists(self.cancel_signal_file)
         except Exception as e:
-            self.logger.error(f"[Callback:{self.task_id}] Error updating task in DB: {e}", exc_info=True)
-            if session:
-                session.rollback()
-        finally:
-            if session:
-                session.close()
+            # 监听失败时退回 mtime 检查，不影响训练
+            self.logger.warning(f"[Callback:{self.task_id}] Cancel signal watcher stopped: {e}")
+            self._cancel_watcher = None
+
+    def _watch_cancel_inotify(self):
+        try:
+            with INotify() as inotify:
+                inotify.add_watch(self.user_task_base_dir, inotify_flags.CREATE | inotify_flags.MOVED_TO)
+                while not self._cancel_stop_evt.is_set():
+                    # 带超时读取，以便及时响应停止事件
+                    for event in inotify.read(timeout=1000):
+                        if event.name == ".cancel_signal":
+                            self._cancel_flag = True
+        except Exception as e:
+            self.logger.warning(f"[Callback:{self.task_id}] Cancel signal watcher stopped: {e}")
+            self._cancel_watcher = None
+
+    def _start_cancel_watcher(self):
+        self._cancel_flag = os.path.exists(self.cancel_signal_file)
+        if self._cancel_watcher is not None:
+            return
+        if watchfiles is not None:
+            target = self._watch_cancel
+        elif INotify is not None:
+            target = self._watch_cancel_inotify
+        else:
+            return
+        self._cancel_stop_evt.clear()
+        self._cancel_watcher = threading.Thread(target=target, daemon=True,
+                                                name=f"cancelwatch-{self.task_id[:8]}")
+        self._cancel_watcher.start()
+
+    def stop_cancel_watcher(self):
+        """停止取消信号监听线程并等待其退出。可重复调用。"""
+        self._cancel_stop_evt.set()
+        watcher = self._cancel_watcher
+        self._cancel_watcher = None
+        if watcher is not None and watcher is not threading.current_thread():
+            watcher.join(timeout=2)
+
+    def _cancel_signal_present(self) -> bool:
+        if self._cancel_event is not None and self._cancel_event.is_set():
+            return True
+        if self._cancel_watcher is not None:
+            return self._cancel_flag
+        # 无监听线程时，仅在任务目录 mtime 变化 (有文件增删) 时才检查信号文件
+        try:
+            mtime_ns = os.stat(self.user_task_base_dir).st_mtime_ns
+        except OSError:
+            return os.path.exists(self.cancel_signal_file)
+        if mtime_ns != self._task_dir_mtime_ns:
+            self._task_dir_mtime_ns = mtime_ns
+            self._cancel_flag = os.path.exists(self.cancel_signal_file)
+        return self._cancel_flag
 
     def _check_cancel_signal(self) -> bool:
         trainer_to_stop = self._trainer  # Use the stored trainer instance
-        if os.path.exists(self.cancel_signal_file):
+        if self._cancel_signal_present():
             self.logger.info(f"[Callback:{self.task_id}] Cancel signal detected. Attempting to stop training.")
             if trainer_to_stop:
                 trainer_to_stop.stop_training = True
@@ -109,60 +532,93 @@ class FinetuneProgressCallback:
             else:
                 self.logger.warning(
                     f"[Callback:{self.task_id}] Cancel signal detected, but self._trainer instance is not yet available in callback.")
-            updates = {
-                "status": 'cancelled',
-                "error_message": "任务被用户通过回调中的信号文件检测取消。",
-                "completed_at": db.func.now()
-            }
-            self._execute_db_update(updates, force_update=True)
-            try:
-                os.remove(self.cancel_signal_file)
-                self.logger.info(f"[Callback:{self.task_id}] Cancel signal file removed.")
-            except OSError as e:
-                self.logger.error(f"[Callback:{self.task_id}] Error removing cancel signal file: {e}")
+            self._execute_db_update(_CANCEL_UPDATES | {"completed_at": func.now()}, force_update=True)
+            self._remove_cancel_signal_file("cancel detected")
+            self._cancelled_by_signal = True
+            self._cancel_flag = False
+            if self._cancel_event is not None:
+                self._cancel_event.clear()
             return True
         return False
 
+    def _remove_cancel_signal_file(self, context: str):
+        # 直接删除，只有一次系统调用；文件已不存在 (或已被他处删除) 时静默返回
+        try:
+            os.remove(self.cancel_signal_file)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            self.logger.error(f"[Callback:{self.task_id}] Error removing cancel signal file ({context}): {e}")
+            return
+        self.logger.info(f"[Callback:{self.task_id}] Cancel signal file removed ({context}).")
+
     def on_pretrain_routine_start(self, trainer):
         self.logger.info(
             f"[Callback:{self.task_id}] on_pretrain_routine_start: Storing trainer instance as self._trainer.")
         self._trainer = trainer  # Store the trainer instance
         self.last_db_update_time_batch = 0
         self.last_metrics_for_db = {}
+        self._batch_scratch.clear()
+        self._batch_counter = 0
+        self._batch_update_every = _INITIAL_BATCH_UPDATE_EVERY
+        self._last_emit_batch_counter = 0
         self.manual_batch_counter_for_epoch = 0
         self.last_epoch_for_manual_counter = -1
+        self._total_batches_in_epoch = 0
+        self._total_epochs = 0
+        self._itps_source = None
+        self._itps_fn = None
+        self._extract_losses_fn = None
+        self._epoch_getter = None
+        self._last_sent_percent = -1.0
+        self._start_cancel_watcher()
+
+        # 在训练线程 (有应用上下文) 中创建写会话，写库线程之后直接复用
+        try:
+            self._get_session()
+        except Exception as e:
+            self.logger.error(f"[Callback:{self.task_id}] Could not create DB session: {e}")
+
+        # 缓存只在训练中断时保留 (正常完成会删除)，此时回调就是 metrics_json 的最后写入者
+        cached_metrics = self._read_metrics_cache()
+        if cached_metrics is not None:
+            self.last_metrics_for_db = cached_metrics
+            self.logger.info(f"[Callback:{self.task_id}] Loaded initial metrics from cache file.")
+            return
 
-        session: Session = None
         try:
-            session = self.db_session_maker()
-            task_record = session.query(FinetuneTask).filter_by(id=self.task_id, user_id=self.user_id).first()
-            if task_record and task_record.metrics_json:
-                try:
-                    self.last_metrics_for_db = json.loads(task_record.metrics_json)
-                    self.logger.info(
-                        f"[Callback:{self.task_id}] Loaded initial metrics from DB: {self.last_metrics_for_db if len(str(self.last_metrics_for_db)) < 200 else str(self.last_metrics_for_db)[:200] + '...'}")
-                except json.JSONDecodeError:
-                    self.logger.warning(
-                        f"[Callback:{self.task_id}] Failed to decode existing metrics_json from DB, starting fresh.")
-                    self.last_metrics_for_db = {}
+            if self.read_session_maker is not None:
+                # 读会话工厂返回上下文管理器 (Session 本身或 callback_db_session)，退出时保证关闭
+                with self.read_session_maker() as session:
+                    task_record = self._fetch_task_row(session, FinetuneTask.metrics_json)
+            else:
+                task_record = self._fetch_task_row(self._get_session(), FinetuneTask.metrics_json)
+            if task_record and isinstance(task_record.metrics_json, dict):
+                self.last_metrics_for_db = dict(task_record.metrics_json)
+                self.logger.info("[Callback:%s] Loaded initial metrics from DB: %s",
+                                 self.task_id, _Abbrev(self.last_metrics_for_db))
             else:
                 self.last_metrics_for_db = {}
         except Exception as e:
+            # _fetch_task_row 的 session.begin() 出错时已自动回滚
             self.logger.error(
                 f"[Callback:{self.task_id}] Error loading initial metrics_json in on_pretrain_routine_start: {e}")
             self.last_metrics_for_db = {}
-        finally:
-            if session: session.close()
 
     def on_pretrain_routine_end(self, trainer):
         self.logger.info(f"[Callback:{self.task_id}] on_pretrain_routine_end called.")
         if self._check_cancel_signal():
             self.logger.info(f"[Callback:{self.task_id}] Training stopped by cancel signal before first epoch.")
             return
+        # 此时 dataloader 已构建完成，缓存总轮次和每轮批次数
+        self._total_epochs = self._resolve_total_epochs(trainer)
+        self._total_batches_in_epoch = self._resolve_total_batches(trainer)
+        self._flush_db_updates()
         session: Session = None
         try:
-            session = self.db_session_maker()
-            task_record = session.query(FinetuneTask).filter_by(id=self.task_id, user_id=self.user_id).first()
+            session = self._get_session()
+            task_record = self._fetch_task_row(
+                session, FinetuneTask.status, FinetuneTask.total_epochs, FinetuneTask.started_at)
             if task_record:
                 actual_total_epochs = getattr(trainer, 'epochs', 0)
                 updates_for_db = {}
@@ -177,7 +633,7 @@ class FinetuneProgressCallback:
                 if task_record.status == 'queued' or task_record.status == 'pending':
                     updates_for_db["status"] = 'running'
                 if not task_record.started_at:
-                    updates_for_db["started_at"] = db.func.now()
+                    updates_for_db["started_at"] = func.now()
                 if updates_for_db:
                     self._execute_db_update(updates_for_db, force_update=True)
                     self.logger.info(
@@ -186,53 +642,52 @@ class FinetuneProgressCallback:
                 self.logger.error(f"[Callback:{self.task_id}] Task not found in DB during on_pretrain_routine_end.")
         except Exception as e:
             self.logger.error(f"[Callback:{self.task_id}] Error in on_pretrain_routine_end: {e}", exc_info=True)
-        finally:
-            if session: session.close()
+            if session: session.rollback()
 
     def on_train_batch_start(self, trainer):
         # self.logger.critical(f"!!!!!!!!!! [Callback:{self.task_id}] on_train_batch_start CALLED !!!!!!!!!!") # Keep for debugging if needed
         # self.logger.critical(f"[Callback:{self.task_id}] Trainer type (on_train_batch_start): {type(trainer)}")
 
         # Update manual batch counter
-        current_trainer_epoch = -1
-        if hasattr(trainer, 'epoch'):
-            current_trainer_epoch = int(trainer.epoch)  # 0-indexed
+        current_trainer_epoch = self._trainer_epoch(trainer)  # 0-indexed
 
         if current_trainer_epoch != self.last_epoch_for_manual_counter:
             self.manual_batch_counter_for_epoch = 0  # Reset for new epoch
             self.last_epoch_for_manual_counter = current_trainer_epoch
-            self.logger.info(
-                f"[Callback:{self.task_id}] New epoch {current_trainer_epoch + 1} started, batch counter reset.")
+            # 新一轮开始时使缓存失效，本轮首个批次结束时重新计算一次
+            self._total_batches_in_epoch = 0
+            self.logger.info("[Callback:%s] New epoch %d started, batch counter reset.",
+                             self.task_id, current_trainer_epoch + 1)
 
         self.manual_batch_counter_for_epoch += 1  # Increment for current batch (becomes 1-indexed)
         # self.logger.critical(f"[Callback:{self.task_id}] Manual batch counter for epoch {current_trainer_epoch + 1}: {self.manual_batch_counter_for_epoch}")
 
-        self.batch_start_time_manual = time.time()
+        self.batch_start_time_manual = time.monotonic()
 
     def on_fit_epoch_end(self, trainer):
-        current_epoch_0_indexed = int(trainer.epoch) if hasattr(trainer, 'epoch') else -1
+        current_epoch_0_indexed = self._trainer_epoch(trainer)
         current_epoch_display = current_epoch_0_indexed + 1
-        self.logger.info(f"[Callback:{self.task_id}] on_fit_epoch_end called for epoch {current_epoch_display}.")
-        self.logger.info(
-            f"[Callback:{self.task_id}] trainer.metrics at epoch end: {trainer.metrics if hasattr(trainer, 'metrics') else 'N/A'}")
+        self.logger.info("[Callback:%s] on_fit_epoch_end called for epoch %d.", self.task_id, current_epoch_display)
+        self.logger.info("[Callback:%s] trainer.metrics at epoch end: %s",
+                         self.task_id, getattr(trainer, 'metrics', 'N/A'))
 
         if self._check_cancel_signal():
             self.logger.info(
                 f"[Callback:{self.task_id}] Epoch {current_epoch_display}: Training stopped by cancel signal.")
             return
 
-        total_epochs_val = int(trainer.epochs) if hasattr(trainer, 'epochs') else self.initial_total_epochs
+        total_epochs_val = self._total_epochs or self._resolve_total_epochs(trainer)
 
         metrics_for_db = {}
         if hasattr(trainer, 'metrics') and trainer.metrics:
-            metrics_for_db = {k: (round(float(v), 5) if isinstance(v, (float, int)) else str(v))
-                              for k, v in trainer.metrics.items()}
+            metrics_for_db = self._normalize_trainer_metrics(trainer.metrics)
 
-        total_batches_in_this_epoch = 0
-        if hasattr(trainer, 'train_loader') and trainer.train_loader:
-            total_batches_in_this_epoch = len(trainer.train_loader)
-        elif hasattr(trainer, 'batches_per_epoch'):
-            total_batches_in_this_epoch = trainer.batches_per_epoch
+        total_batches_in_this_epoch = self._total_batches_in_epoch
+        if total_batches_in_this_epoch == 0:
+            if hasattr(trainer, 'train_loader') and trainer.train_loader:
+                total_batches_in_this_epoch = len(trainer.train_loader)
+            elif hasattr(trainer, 'batches_per_epoch'):
+                total_batches_in_this_epoch = trainer.batches_per_epoch
 
         if total_batches_in_this_epoch > 0:
             metrics_for_db['current_batch'] = total_batches_in_this_epoch
@@ -245,20 +700,25 @@ class FinetuneProgressCallback:
             for key_to_preserve in ["best_epoch", "best_fitness_val", "iterations_per_second_batch", "batch_loss"]:
                 if key_to_preserve in self.last_metrics_for_db and key_to_preserve not in metrics_for_db:
                     metrics_for_db[key_to_preserve] = self.last_metrics_for_db[key_to_preserve]
-
-        common_train_loss_keys = ['train/box_loss', 'train/cls_loss', 'train/dfl_loss']
-        missing_train_losses = [k for k in common_train_loss_keys if k not in metrics_for_db]
-        if missing_train_losses:
+        # 本轮最后一次上报的批次速度与损失优先于上一轮的值
+        for key_to_preserve in ("iterations_per_second_batch", "batch_loss"):
+            if key_to_preserve in self._batch_scratch:
+                metrics_for_db[key_to_preserve] = self._batch_scratch[key_to_preserve]
+        self._batch_scratch.clear()
+
+        if not _REQUIRED_TRAIN_LOSS_KEYS <= metrics_for_db.keys():
+            missing_train_losses = sorted(_REQUIRED_TRAIN_LOSS_KEYS - metrics_for_db.keys())
             self.logger.warning(
                 f"[Callback:{self.task_id}] Epoch {current_epoch_display}: trainer.metrics is missing common train loss keys: {missing_train_losses}. Content keys: {list(metrics_for_db.keys())}")
 
         updates = {
             "current_epoch": current_epoch_display,
-            "metrics_json": json.dumps(metrics_for_db)
+            "metrics_json": metrics_for_db,
+            "batch_progress_json": None  # 本轮进度已并入 metrics_json
         }
-        self._execute_db_update(updates, force_update=True)
-        self.logger.info(
-            f"[Callback:{self.task_id}] Epoch {current_epoch_display} progress saved to DB (forced). Metrics: {metrics_for_db if len(str(metrics_for_db)) < 200 else str(metrics_for_db)[:200] + '...'}")
+        self._execute_db_update(updates, metrics_dict=metrics_for_db, force_update=True)
+        self.logger.info("[Callback:%s] Epoch %s progress saved to DB (forced). Metrics: %s",
+                         self.task_id, current_epoch_display, _Abbrev(metrics_for_db))
 
         if self.celery_task_update_state_func:
             progress_percent = (current_epoch_display / total_epochs_val * 100) if total_epochs_val > 0 else 0
@@ -270,16 +730,147 @@ class FinetuneProgressCallback:
                 'status_message': f"Epoch {current_epoch_display}/{total_epochs_val} completed.",
                 'metrics': metrics_for_db
             }
+            self._last_sent_percent = progress_percent
+            self._discard_pending_celery()
             try:
                 self.celery_task_update_state_func(state='PROGRESS', meta=celery_meta)
             except Exception as e_celery:
                 self.logger.error(f"[Callback:{self.task_id}] Error sending epoch progress to Celery: {e_celery}",
                                   exc_info=False)
 
+    @staticmethod
+    def _itps_from_speed(trainer):
+        # trainer.speed: 各阶段耗时 (ms)
+        speed = getattr(trainer, 'speed', None)
+        if not speed or not isinstance(speed, dict):
+            return None
+        batch_time_sum_ms = 0.0
+        for key in _SPEED_KEYS:
+            value = speed.get(key)
+            if isinstance(value, (int, float)):
+                batch_time_sum_ms += value
+        return round(1000.0 / batch_time_sum_ms, 2) if batch_time_sum_ms > 0 else None
+
+    @staticmethod
+    def _itps_from_stats(trainer):
+        # trainer.stats 可能包含 'time/batch' (秒)
+        stats = getattr(trainer, 'stats', None)
+        if not isinstance(stats, dict):
+            return None
+        batch_time_s = stats.get('time/batch')
+        if isinstance(batch_time_s, (int, float)) and batch_time_s > 0:
+            return round(1.0 / batch_time_s, 2)
+        return None
+
+    @staticmethod
+    def _itps_from_dt(trainer):
+        # trainer.dt: [preprocess, inference, postprocess] 耗时 (秒)
+        dt = getattr(trainer, 'dt', None)
+        if not isinstance(dt, (list, tuple)) or not dt:
+            return None
+        total_dt_seconds = sum(t for t in dt if isinstance(t, (int, float)))
+        return round(1.0 / total_dt_seconds, 2) if total_dt_seconds > 0 else None
+
+    def _itps_from_ema(self, trainer):
+        # 手动计时的指数滑动平均，作为最后的回退
+        if self.batch_start_time_manual <= 0:
+            return None
+        current_batch_duration_manual = time.monotonic() - self.batch_start_time_manual
+        if current_batch_duration_manual <= 1e-3:
+            return None
+        if self.ema_batch_time_manual is None:
+            self.ema_batch_time_manual = current_batch_duration_manual
+        else:
+            self.ema_batch_time_manual = self.ema_alpha_manual * current_batch_duration_manual + \
+                                         (1 - self.ema_alpha_manual) * self.ema_batch_time_manual
+        if self.ema_batch_time_manual > 1e-3:
+            return round(1.0 / self.ema_batch_time_manual, 2)
+        return None
+
+    def _compute_itps(self, trainer):
+        if self._itps_fn is None:
+            for source, fn in (('speed', self._itps_from_speed),
+                               ('stats', self._itps_from_stats),
+                               ('dt', self._itps_from_dt)):
+                value = fn(trainer)
+                if value is not None:
+                    self._itps_source, self._itps_fn = source, fn
+                    self.logger.info(f"[Callback:{self.task_id}] Speed source detected: trainer.{source}")
+                    return value
+            self._itps_source, self._itps_fn = 'ema', self._itps_from_ema
+        value = self._itps_fn(trainer)
+        if value is None and self._itps_source != 'ema':
+            value = self._itps_from_ema(trainer)
+        return value
+
+    @staticmethod
+    def _losses_from_label_items(trainer) -> dict:
+        loss_items_dict = trainer.label_loss_items(_to_host(trainer.tloss), prefix="train")  # Adds "train/" prefix
+        if not loss_items_dict:
+            return {}
+        return _round_metrics(loss_items_dict, numeric_only=True)
+
+    @staticmethod
+    def _losses_from_loss_items(trainer) -> dict:
+        # loss_names are usually ('box_loss', 'cls_loss', 'dfl_loss')
+        loss_names = getattr(trainer, 'loss_names', ['box_loss', 'cls_loss', 'dfl_loss'])  # Default if not found
+        detached_loss_items = np.round(_to_host(trainer.loss_items).numpy().astype(np.float64), 5).tolist()
+        if len(detached_loss_items) != len(loss_names):
+            return {}
+        return {(name if name.startswith("train/") else f"train/{name}"): value
+                for name, value in zip(loss_names, detached_loss_items)}
+
+    @staticmethod
+    def _no_detailed_losses(trainer) -> dict:
+        return {}
+
+    def _select_loss_extractor(self, trainer):
+        if hasattr(trainer, 'label_loss_items') and getattr(trainer, 'tloss', None) is not None:
+            return self._losses_from_label_items
+        loss_items = getattr(trainer, 'loss_items', None)
+        if loss_items is not None and hasattr(loss_items, 'detach'):  # Fallback for some trainer versions
+            return self._losses_from_loss_items
+        self.logger.debug(f"[Callback:{self.task_id}] No detailed loss source found on trainer.")
+        return self._no_detailed_losses
+
+    def _normalize_trainer_metrics(self, metrics: dict) -> dict:
+        changed = {}
+        for k, v in metrics.items():
+            # 只有普通数值才能安全比较并复用；其他类型每次都重新转换
+            if type(v) not in (float, int) or self._raw_metrics_cache.get(k) != v:
+                changed[k] = v
+        if changed:
+            self._norm_metrics_cache.update(_round_metrics(changed))
+            self._raw_metrics_cache.update(changed)
+        return {k: self._norm_metrics_cache[k] for k in metrics}
+
+    def _extract_batch_losses(self, trainer) -> dict:
+        """读取当前批次的损失值。会触发设备同步，只应在通过节流判断后调用。"""
+        batch_specific_metrics = {}
+        loss = getattr(trainer, 'loss', None)
+        if loss is not None:  # This is total loss for the batch
+            try:
+                batch_specific_metrics['batch_loss'] = round(float(loss.item()), 5)
+            except Exception as e_loss:
+                self.logger.warning(f"[Callback:{self.task_id}] Could not get trainer.loss.item(): {e_loss}")
+
+        # Detailed losses (e.g., box_loss, cls_loss, dfl_loss)；提取方式在首次调用时确定
+        if not self._report_detailed_losses:
+            return batch_specific_metrics
+        if self._extract_losses_fn is None:
+            self._extract_losses_fn = self._select_loss_extractor(trainer)
+        try:
+            batch_specific_metrics.update(self._extract_losses_fn(trainer))
+        except Exception as e_loss_items:
+            self.logger.debug("[Callback:%s] Could not get detailed loss items: %s", self.task_id, e_loss_items)
+        return batch_specific_metrics
+
     def on_train_batch_end(self, trainer):
         # self.logger.critical(f"!!!!!!!!!! [Callback:{self.task_id}] on_train_batch_end CALLED !!!!!!!!!!") # Keep for debugging if needed
 
-        if self._check_cancel_signal():
+        # 有监听线程时检查只是读一个布尔值，可以每批次进行
+        if (self._cancel_watcher is not None or (self.manual_batch_counter_for_epoch & _CANCEL_CHECK_MASK) == 0) \
+                and self._check_cancel_signal():
             self.logger.info(f"[Callback:{self.task_id}] on_train_batch_end: Cancel signal detected, stopping.")
             return
 
@@ -292,35 +883,29 @@ class FinetuneProgressCallback:
                     f"[Callback:{self.task_id}] Critical: self._trainer is also None. Skipping batch update.")
                 return
 
-        current_time = time.time()
-        # Check if it's time to update DB based on interval (only if not forced)
-        if self.last_db_update_time_batch != 0 and (
-                current_time - self.last_db_update_time_batch < self.db_update_interval):
+        # Check if it's time to update DB based on interval (only if not forced).
+        # 先用整数计数过滤掉大部分批次，再读时钟；首次上报不受计数限制
+        self._batch_counter += 1
+        if self.last_db_update_time_batch != 0 and self._batch_counter % self._batch_update_every:
+            return
+        # 必须在读取 loss 之前判断: .item()/.cpu() 会触发 GPU 同步，只在确实要上报的批次上执行
+        now_ns = time.monotonic_ns()
+        if not self._should_emit_metrics(now_ns):
             return  # Not time yet
+        self._retune_batch_update_every(now_ns)
 
         try:
-            current_epoch_0_indexed = -1
-            if hasattr(trainer, 'epoch'):
-                current_epoch_0_indexed = int(trainer.epoch)
-            else:
+            current_epoch_0_indexed = self._trainer_epoch(trainer)
+            if current_epoch_0_indexed == -1:
                 self.logger.warning(
                     f"[Callback:{self.task_id}] trainer.epoch not found in on_train_batch_end. Using last known: {self.last_epoch_for_manual_counter}")
                 current_epoch_0_indexed = self.last_epoch_for_manual_counter  # Use the one updated by on_train_batch_start
 
             current_epoch_display = current_epoch_0_indexed + 1 if current_epoch_0_indexed != -1 else 1  # 1-indexed for display
 
-            total_batches_in_epoch = 0
-            if hasattr(trainer, 'train_loader') and trainer.train_loader:
-                total_batches_in_epoch = len(trainer.train_loader)
-            elif hasattr(trainer, 'batches_per_epoch'):  # Fallback, might not be set early
-                total_batches_in_epoch = trainer.batches_per_epoch
-
-            if total_batches_in_epoch == 0 and hasattr(trainer, 'args') and hasattr(trainer.args,
-                                                                                    'nbs'):  # nbs: nominal batch size (total batches in an epoch)
-                total_batches_in_epoch = getattr(trainer.args, 'nbs', 0)
-                if total_batches_in_epoch > 0:
-                    self.logger.info(
-                        f"[Callback:{self.task_id}] Used trainer.args.nbs for total_batches_in_epoch: {total_batches_in_epoch}")
+            if self._total_batches_in_epoch == 0:
+                self._total_batches_in_epoch = self._resolve_total_batches(trainer)
+            total_batches_in_epoch = self._total_batches_in_epoch
 
             if total_batches_in_epoch == 0:  # If still zero, log warning
                 self.logger.warning(
@@ -339,84 +924,16 @@ class FinetuneProgressCallback:
                 current_batch_idx_display = max(1, min(current_batch_idx_display, total_batches_in_epoch))
             # --- 结束获取批次索引 ---
 
-            iterations_per_second = None
-            # Try trainer.speed (usually in ms per component)
-            if hasattr(trainer, 'speed') and isinstance(trainer.speed, dict) and trainer.speed:
-                relevant_speed_keys = ['preprocess', 'inference', 'loss', 'postprocess', 'forward', 'backward']
-                batch_time_sum_ms = sum(trainer.speed.get(k, 0.0) for k in relevant_speed_keys if
-                                        isinstance(trainer.speed.get(k), (int, float)))
-                if batch_time_sum_ms > 0:
-                    iterations_per_second = round(1000.0 / batch_time_sum_ms, 2)
-
-            # Try trainer.stats (may contain 'time/batch' in seconds)
-            if iterations_per_second is None and hasattr(trainer, 'stats') and isinstance(trainer.stats, dict):
-                if 'time/batch' in trainer.stats:
-                    batch_time_s = trainer.stats['time/batch']
-                    if isinstance(batch_time_s, (int, float)) and batch_time_s > 0:
-                        iterations_per_second = round(1.0 / batch_time_s, 2)
-
-            # Try trainer.dt (list/tuple of [preprocess, inference, postprocess] times in seconds)
-            if iterations_per_second is None and hasattr(trainer, 'dt') and isinstance(trainer.dt, (list, tuple)):
-                if len(trainer.dt) > 0:
-                    total_dt_seconds = sum(t for t in trainer.dt if isinstance(t, (int, float)))
-                    if total_dt_seconds > 0:
-                        iterations_per_second = round(1.0 / total_dt_seconds, 2)
-
-            # Fallback to manual EMA calculation
-            if iterations_per_second is None and self.batch_start_time_manual > 0:
-                current_batch_duration_manual = time.time() - self.batch_start_time_manual
-                if current_batch_duration_manual > 1e-3:
-                    if self.ema_batch_time_manual is None:
-                        self.ema_batch_time_manual = current_batch_duration_manual
-                    else:
-                        self.ema_batch_time_manual = self.ema_alpha_manual * current_batch_duration_manual + \
-                                                     (1 - self.ema_alpha_manual) * self.ema_batch_time_manual
-                    if self.ema_batch_time_manual > 1e-3:
-                        iterations_per_second = round(1.0 / self.ema_batch_time_manual, 2)
-                        # self.logger.info(f"[Callback:{self.task_id}] Speed calculated manually (EMA): {iterations_per_second} it/s")
+            iterations_per_second = self._compute_itps(trainer)
 
             if iterations_per_second is None:
                 self.logger.warning(
                     f"[Callback:{self.task_id}] Could not determine iterations_per_second for batch {current_batch_idx_display}.")
 
-            batch_specific_metrics = {}
-            if hasattr(trainer, 'loss') and trainer.loss is not None:  # This is total loss for the batch
-                try:
-                    batch_specific_metrics['batch_loss'] = round(float(trainer.loss.item()), 5)
-                except Exception as e_loss:
-                    self.logger.warning(f"[Callback:{self.task_id}] Could not get trainer.loss.item(): {e_loss}")
+            batch_specific_metrics = self._extract_batch_losses(trainer)
 
-            # Detailed losses (e.g., box_loss, cls_loss, dfl_loss)
-            if hasattr(trainer, 'label_loss_items') and hasattr(trainer, 'tloss') and trainer.tloss is not None:
-                try:
-                    loss_items_dict = trainer.label_loss_items(trainer.tloss.detach().cpu(),
-                                                               prefix="train")  # Adds "train/" prefix
-                    if loss_items_dict:
-                        batch_specific_metrics.update(
-                            {k: round(float(v), 5) for k, v in loss_items_dict.items() if isinstance(v, (int, float))})
-                except Exception as e_loss_items:
-                    self.logger.debug(
-                        f"[Callback:{self.task_id}] Could not get detailed loss_items via label_loss_items: {e_loss_items}")
-            elif hasattr(trainer,
-                         'loss_items') and trainer.loss_items is not None:  # Fallback for some trainer versions
-                try:
-                    # loss_names are usually ('box_loss', 'cls_loss', 'dfl_loss')
-                    loss_names = getattr(trainer, 'loss_names',
-                                         ['box_loss', 'cls_loss', 'dfl_loss'])  # Default if not found
-                    if hasattr(trainer.loss_items, 'detach'):  # Ensure it's a tensor
-                        detached_loss_items = trainer.loss_items.detach().cpu().tolist()
-                        if len(detached_loss_items) == len(loss_names):
-                            for i, name in enumerate(loss_names):
-                                # Add "train/" prefix if not already there
-                                key_name = f"train/{name}" if not name.startswith("train/") else name
-                                batch_specific_metrics[key_name] = round(float(detached_loss_items[i]), 5)
-                except Exception as e_loss_items_alt:
-                    self.logger.debug(
-                        f"[Callback:{self.task_id}] Could not get detailed loss_items from trainer.loss_items: {e_loss_items_alt}")
-
-            metrics_for_db_update = {}
-            if isinstance(self.last_metrics_for_db, dict):  # Start with last known good epoch metrics
-                metrics_for_db_update = self.last_metrics_for_db.copy()
+            # 批次字段写入复用的 _batch_scratch，不复制也不改动上一轮的指标快照
+            metrics_for_db_update = self._batch_scratch
 
             metrics_for_db_update['current_batch'] = current_batch_idx_display
             metrics_for_db_update[
@@ -429,14 +946,11 @@ class FinetuneProgressCallback:
 
             metrics_for_db_update.update(batch_specific_metrics)  # Add/overwrite with current batch specifics
 
-            db_updates = {
-                "current_epoch": current_epoch_display,
-                "metrics_json": json.dumps(metrics_for_db_update)
-            }
-            self._execute_db_update(db_updates, force_update=False)  # This will update self.last_db_update_time_batch
-
+            celery_meta = None
             if self.celery_task_update_state_func:
-                total_epochs_val = int(trainer.epochs) if hasattr(trainer, 'epochs') else self.initial_total_epochs
+                if self._total_epochs == 0:
+                    self._total_epochs = self._resolve_total_epochs(trainer)
+                total_epochs_val = self._total_epochs
                 progress_percent = 0
                 if total_epochs_val > 0 and total_batches_in_epoch > 0 and current_epoch_0_indexed != -1:
                     # current_batch_idx_0_indexed is already 0-indexed
@@ -448,26 +962,31 @@ class FinetuneProgressCallback:
                                                         current_global_iteration_0_indexed + 1) / total_iterations) * 100  # +1 because we're reporting end of this batch
                         progress_percent = min(progress_percent, 100.0)
 
-                celery_meta = {
-                    'type': 'batch_progress',
-                    'epoch': current_epoch_display,
-                    'total_epochs': total_epochs_val,
-                    'batch': current_batch_idx_display,
-                    'total_batches_in_epoch': total_batches_in_epoch,
-                    'progress_percent': round(progress_percent, 2),
-                    'iterations_per_second': iterations_per_second,
-                    'batch_metrics': batch_specific_metrics,
-                    # Only send current batch metrics to Celery for this update
-                    'status_message': f"Epoch {current_epoch_display}/{total_epochs_val}, Batch {current_batch_idx_display}/{total_batches_in_epoch}"
-                }
-                if iterations_per_second is not None:
-                    celery_meta['status_message'] += f", Speed: {iterations_per_second} it/s"
+                # 每次 update_state 都是一次结果后端往返，进度变化小于 0.5% 时不发送
+                if abs(progress_percent - self._last_sent_percent) >= CELERY_PROGRESS_MIN_DELTA:
+                    self._last_sent_percent = progress_percent
+                    celery_meta = {
+                        'type': 'batch_progress',
+                        'epoch': current_epoch_display,
+                        'total_epochs': total_epochs_val,
+                        'batch': current_batch_idx_display,
+                        'total_batches_in_epoch': total_batches_in_epoch,
+                        'progress_percent': round(progress_percent, 2),
+                        'iterations_per_second': iterations_per_second,
+                        'batch_metrics': batch_specific_metrics,
+                        # Only send current batch metrics to Celery for this update
+                        'status_message': f"Epoch {current_epoch_display}/{total_epochs_val}, Batch {current_batch_idx_display}/{total_batches_in_epoch}"
+                    }
+                    if iterations_per_second is not None:
+                        celery_meta['status_message'] += f", Speed: {iterations_per_second} it/s"
 
-                try:
-                    self.celery_task_update_state_func(state='PROGRESS', meta=celery_meta)
-                except Exception as e_celery:
-                    self.logger.error(f"[Callback:{self.task_id}] Error sending batch progress to Celery: {e_celery}",
-                                      exc_info=False)
+            db_updates = {
+                "current_epoch": current_epoch_display,
+                "batch_progress_json": metrics_for_db_update
+            }
+            # 写库与 Celery 上报一并交给写库线程，训练线程不等待数据库和结果后端
+            self._execute_db_update(db_updates, force_update=False,
+                                    celery_meta=celery_meta)  # This will update self.last_db_update_time_batch
         except Exception as e:
             self.logger.error(f"[Callback:{self.task_id}] Error in on_train_batch_end: {e}", exc_info=True)
         finally:
@@ -501,40 +1020,38 @@ class FinetuneProgressCallback:
                         update_needed = True
 
                     if update_needed:
-                        db_updates = {"metrics_json": json.dumps(metrics_update_for_best)}
-                        self._execute_db_update(db_updates, force_update=True)
+                        db_updates = {"metrics_json": metrics_update_for_best}
+                        self._execute_db_update(db_updates, metrics_dict=metrics_update_for_best, force_update=True)
                         self.logger.info(
                             f"[Callback:{self.task_id}] Updated best_epoch to {new_best_epoch_1_indexed} and/or best_fitness_val to {fitness_of_saved_ckpt} in DB via on_model_save.")
                 else:
                     self.logger.debug(
-                        f"[Callback:{self.task_id}] on_model_save: ckpt fitness {fitness_of_saved_ckpt} does not match trainer.best_fitness {getattr(trainer, 'best_fitness', 'N/A')}. Not updating best_epoch from this save.")
+                        "[Callback:%s] on_model_save: ckpt fitness %s does not match trainer.best_fitness %s. Not updating best_epoch from this save.",
+                        self.task_id, fitness_of_saved_ckpt, getattr(trainer, 'best_fitness', 'N/A'))
             else:
-                self.logger.debug(f"[Callback:{self.task_id}] on_model_save: trainer.ckpt not available or not a dict.")
+                self.logger.debug("[Callback:%s] on_model_save: trainer.ckpt not available or not a dict.", self.task_id)
         except Exception as e:
             self.logger.error(f"[Callback:{self.task_id}] Error in on_model_save: {e}", exc_info=True)
 
     def on_train_end(self, trainer):
         self.logger.info(f"[Callback:{self.task_id}] on_train_end called.")
-        is_cancelled_by_signal = self._trainer and getattr(self._trainer, 'stop_training', False) and os.path.exists(
-            self.cancel_signal_file)
+        # 信号文件已在 _check_cancel_signal 中删除，这里只看内存中的标志，不再 stat
+        is_cancelled_by_signal = self._cancelled_by_signal and self._trainer is not None \
+            and getattr(self._trainer, 'stop_training', False)
 
         if is_cancelled_by_signal:
             self.logger.info(
                 f"[Callback:{self.task_id}] Training ended due to cancel signal. Final status should be 'cancelled'.")
-            if os.path.exists(self.cancel_signal_file):
-                try:
-                    os.remove(self.cancel_signal_file)
-                    self.logger.info(
-                        f"[Callback:{self.task_id}] Cleaned up cancel signal file in on_train_end (cancelled case).")
-                except OSError as e:
-                    self.logger.error(
-                        f"[Callback:{self.task_id}] Error removing cancel signal file in on_train_end (cancelled case): {e}")
+            self._remove_cancel_signal_file("on_train_end, cancelled case")
+            self.close_db_session()
+            self.stop_cancel_watcher()
             return
 
+        self._flush_db_updates()
         session: Session = None
         try:
-            session = self.db_session_maker()
-            task_record = session.query(FinetuneTask).filter_by(id=self.task_id, user_id=self.user_id).first()
+            session = self._get_session()
+            task_record = self._fetch_task_row(session, FinetuneTask.status)
             if not task_record:
                 self.logger.error(f"[Callback:{self.task_id}] Task not found in DB during on_train_end.")
                 return
@@ -542,8 +1059,7 @@ class FinetuneProgressCallback:
             if task_record.status == 'running':
                 final_trainer_metrics = {}
                 if hasattr(trainer, 'metrics') and trainer.metrics:
-                    final_trainer_metrics = {k: (round(float(v), 5) if isinstance(v, (float, int)) else str(v))
-                                             for k, v in trainer.metrics.items()}
+                    final_trainer_metrics = self._normalize_trainer_metrics(trainer.metrics)
 
                 merged_final_metrics = {}
                 if isinstance(self.last_metrics_for_db, dict):
@@ -560,21 +1076,22 @@ class FinetuneProgressCallback:
                         merged_final_metrics["best_model_path_abs"] = str(best_model_abs_path)
                     self.logger.info(f"[Callback:{self.task_id}] Best model path recorded: {best_model_abs_path}")
 
-                updates = {}
+                final_total_epochs = self._total_epochs or self._resolve_total_epochs(trainer)
+                updates = _COMPLETED_UPDATES | {
+                    "current_epoch": final_total_epochs,
+                    "total_epochs": final_total_epochs,
+                    "completed_at": func.now(),
+                }
                 if merged_final_metrics:
-                    updates["metrics_json"] = json.dumps(merged_final_metrics)
-
-                final_total_epochs = int(trainer.epochs) if hasattr(trainer, 'epochs') else self.initial_total_epochs
-                updates["current_epoch"] = final_total_epochs
-                updates["total_epochs"] = final_total_epochs
-                updates["status"] = 'completed'
-                updates["completed_at"] = db.func.now()
-                updates["error_message"] = None
+                    updates["metrics_json"] = merged_final_metrics
 
                 if updates:
-                    self._execute_db_update(updates, force_update=True)
+                    self._execute_db_update(updates, metrics_dict=merged_final_metrics or None, force_update=True)
                     self.logger.info(
-                        f"[Callback:{self.task_id}] Final metrics/info and status updated to 'completed' in DB from on_train_end. Final metrics: {merged_final_metrics if len(str(merged_final_metrics)) < 200 else str(merged_final_metrics)[:200] + '...'}")
+                        "[Callback:%s] Final metrics/info and status updated to 'completed' in DB from on_train_end. Final metrics: %s",
+                        self.task_id, _Abbrev(merged_final_metrics))
+                # 训练已正常完成，不再需要用于恢复的指标缓存
+                self._remove_metrics_cache()
 
                 if self.celery_task_update_state_func:
                     celery_meta = {
@@ -586,6 +1103,7 @@ class FinetuneProgressCallback:
                         'total_epochs': final_total_epochs,
                         'progress_percent': 100.0
                     }
+                    self._discard_pending_celery()
                     try:
                         self.celery_task_update_state_func(state='PROGRESS', meta=celery_meta)
                         self.logger.info(f"[Callback:{self.task_id}] Sent training completed signal to Celery.")
@@ -598,13 +1116,8 @@ class FinetuneProgressCallback:
                     f"[Callback:{self.task_id}] Training ended, but task status was '{task_record.status}'. No final metric/status update from callback.")
         except Exception as e:
             self.logger.error(f"[Callback:{self.task_id}] Error in on_train_end: {e}", exc_info=True)
+            if session: session.rollback()
         finally:
-            if session: session.close()
-            if os.path.exists(self.cancel_signal_file):
-                try:
-                    os.remove(self.cancel_signal_file)
-                    self.logger.info(
-                        f"[Callback:{self.task_id}] Cleaned up cancel signal file in on_train_end (final cleanup).")
-                except OSError as e:
-                    self.logger.error(
-                        f"[Callback:{self.task_id}] Error removing cancel signal file during final cleanup: {e}")
\ No newline at end of file
+            self.close_db_session()
+            self.stop_cancel_watcher()
+            self._remove_cancel_signal_file("on_train_end, final cleanup")
\ No newline at end of file
@@ -1,13 +1,160 @@
 # app/ultralyticsCust/training.py
 import os
+import copy
 import logging
+import functools
+import yaml
 from ultralytics import YOLO
 from typing import List, Dict, Any, Tuple, Callable
 
+try:
+    import psutil
+except ImportError:  # psutil 随 ultralytics 一起安装，这里仍按可选依赖处理
+    psutil = None
+
+# 训练集解码后的估算大小低于可用内存的这个比例时，默认把数据集缓存到内存，否则不缓存
+DATASET_RAM_CACHE_FRACTION = 0.5
+
+
+@functools.lru_cache(maxsize=4)
+def _load_base_model(model_path: str, mtime_ns: int, size: int) -> YOLO:
+    """
+    缓存已加载的基础模型，常驻 worker 中重复微调同一基础模型时不必重新读盘构建。
+    文件的 mtime/大小参与缓存键，同一路径的文件被替换后会重新加载。
+    缓存的实例只用于复制，不能直接训练或注册回调。
+    """
+    return YOLO(model_path)
+
+
+def _get_base_model_copy(model_path: str, source_model_path: str = None) -> YOLO:
+    """
+    返回 model_path 对应的可训练模型。给出 source_model_path (多个任务共用的预设模型) 时按其路径缓存并返回副本；
+    否则 (用户上传的一次性模型) 直接加载，不进入缓存。
+    """
+    if source_model_path is None:
+        return YOLO(model_path)
+    try:
+        real_path = os.path.realpath(source_model_path)
+        st = os.stat(real_path)
+    except OSError:
+        return YOLO(model_path)
+    return copy.deepcopy(_load_base_model(real_path, st.st_mtime_ns, st.st_size))
+
 
 # 假设 FinetuneProgressCallback 已经定义在 app.ultralyticsCust.callbacks
 # from .callbacks import FinetuneProgressCallback # 如果在同一个包内
 
+# 计入训练集的图片后缀 (与 Ultralytics 的 IMG_FORMATS 一致)
+_IMAGE_SUFFIXES = ('.bmp', '.dng', '.jpeg', '.jpg', '.mpo', '.png', '.tif', '.tiff', '.webp', '.pfm', '.heic')
+
+
+def _count_dir_images(root: str) -> int:
+    count = 0
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.lower().endswith(_IMAGE_SUFFIXES):
+                        count += 1
+        except OSError:
+            continue
+    return count
+
+
+def count_train_images(data_yaml_path: str) -> int:
+    """统计 data.yaml 中 train 图片的数量；无法解析时返回 -1。"""
+    try:
+        with open(data_yaml_path, 'r', encoding='utf-8') as f:
+            data_cfg = yaml.safe_load(f) or {}
+    except (OSError, yaml.YAMLError):
+        return -1
+    train_entries = data_cfg.get('train')
+    if not train_entries:
+        return -1
+    if isinstance(train_entries, str):
+        train_entries = [train_entries]
+
+    dataset_root = data_cfg.get('path') or os.path.dirname(os.path.abspath(data_yaml_path))
+    if not os.path.isabs(dataset_root):
+        dataset_root = os.path.join(os.path.dirname(os.path.abspath(data_yaml_path)), dataset_root)
+
+    count = 0
+    for entry in train_entries:
+        entry_path = entry if os.path.isabs(entry) else os.path.join(dataset_root, entry)
+        if os.path.isdir(entry_path):
+            count += _count_dir_images(entry_path)
+        elif os.path.isfile(entry_path):  # 图片列表 txt，每行一个路径
+            try:
+                with open(entry_path, 'r', encoding='utf-8') as f:
+                    count += sum(1 for line in f if line.strip())
+            except OSError:
+                return -1
+        else:
+            return -1
+    return count
+
+
+def estimated_dataset_bytes(data_yaml_path: str, imgsz=640) -> int:
+    """
+    估算 cache='ram' 时训练集占用的内存 (字节)；无法解析时返回 -1。
+    Ultralytics 在内存中缓存的是解码并缩放后的数组，每张约 imgsz * imgsz * 3 字节 (与其 check_cache_ram 的估算相同)，
+    通常是压缩后 JPEG/PNG 文件大小的数倍，因此按图片数量而不是文件大小估算。
+    """
+    count = count_train_images(data_yaml_path)
+    if count < 0:
+        return -1
+    if isinstance(imgsz, (list, tuple)):
+        imgsz = max(imgsz)
+    return count * int(imgsz) * int(imgsz) * 3
+
+
+def _choose_dataset_cache(yolo_train_args: Dict[str, Any], data_yaml_path: str, logger: logging.Logger):
+    """
+    用户未指定 cache 时，只有训练集解码后明显能放进可用内存才启用 cache='ram'，否则保持 Ultralytics 默认的不缓存。
+    cache='disk' 会在用户数据集目录中每张图片旁写入解码后的 .npy 文件，只在 training_params 显式指定时使用。
+    """
+    if 'cache' in yolo_train_args:
+        logger.info(f"使用用户指定的数据集缓存模式: cache={yolo_train_args['cache']}")
+        return
+    if psutil is None:
+        logger.info("psutil 不可用，无法确认可用内存，不启用数据集缓存。")
+        return
+    need = estimated_dataset_bytes(data_yaml_path, yolo_train_args.get('imgsz', 640))
+    if need < 0:
+        logger.info("无法估算训练集大小，不启用数据集缓存。")
+        return
+    available = psutil.virtual_memory().available
+    # 留出一半余量: Ultralytics 自身的内存检查 (含 50% 安全余量) 不通过时会静默放弃缓存
+    if need < DATASET_RAM_CACHE_FRACTION * available:
+        yolo_train_args['cache'] = 'ram'
+        logger.info(f"数据集缓存模式: cache=ram (训练集解码后约 {need / 1024 ** 2:.1f} MiB，"
+                    f"可用内存约 {available / 1024 ** 2:.1f} MiB)")
+    else:
+        logger.info(f"训练集解码后约 {need / 1024 ** 2:.1f} MiB，超出可用内存 ({available / 1024 ** 2:.1f} MiB) 的安全范围，"
+                    f"不启用数据集缓存。")
+
+
+def _choose_precision(yolo_train_args: Dict[str, Any], logger: logging.Logger):
+    """有 CUDA 设备时默认开启混合精度 (AMP)；用户显式传入的 amp 保持不变，CPU 训练不做改动。"""
+    device = str(yolo_train_args.get('device', '')).lower()
+    if device == 'cpu':
+        return
+    try:
+        import torch
+    except ImportError:
+        return
+    if not torch.cuda.is_available():
+        return
+    if 'amp' in yolo_train_args:
+        logger.info(f"使用用户指定的训练精度: amp={yolo_train_args['amp']}")
+        return
+    yolo_train_args['amp'] = True
+    logger.info("检测到 CUDA 设备，训练精度: AMP (FP16 混合精度)")
+
+
 def run_yolo_training(
         model_path: str,  # 基础模型路径 (e.g., 'yolov8n.pt' or path to a .pt file)
         data_yaml_path: str,  # 数据集配置文件路径 (data.yaml)
@@ -16,7 +163,8 @@ def run_yolo_training(
         training_params: Dict[str, Any],  # 包含 epochs, batch, device, patience, etc.
         callbacks_list: List[Callable] = None,  # 回调列表
         # log_file_path: str, # YOLOv8 会在 project_path/run_name 下自动生成日志，回调会处理日志
-        logger: logging.Logger = None
+        logger: logging.Logger = None,
+        source_model_path: str = None  # 暂存到任务目录前的预设模型路径，用于跨任务缓存已加载的模型
 ) -> Tuple[bool, str, Dict[str, Any]]:
     """
     执行 YOLO 模型微调训练。
@@ -28,6 +176,7 @@ def run_yolo_training(
     :param training_params: 训练参数字典。
     :param callbacks_list: YOLO训练回调列表。
     :param logger: 日志记录器。
+    :param source_model_path: 基础模型的共享来源 (预设模型)；为 None 时不缓存已加载的模型。
     :return: (success_flag, message_or_error, results_dict)
              results_dict 包含最终模型路径等信息。
     """
@@ -41,14 +190,14 @@ def run_yolo_training(
     logger.info(f"训练参数: {training_params}")
 
     try:
-        model = YOLO(model_path)
+        model = _get_base_model_copy(model_path, source_model_path)
 
         # Ultralytics YOLOv8 的 train 方法参数
         # 常见参数: data, epochs, batch, imgsz, device, project, name, patience, optimizer, lr0, lrf, etc.
-        # callbacks 会自动处理，无需显式传递给 train 方法，而是通过 model.add_callback()
+        # callbacks 会自动处理，无需显式传递给 train 方法；直接追加到副本的回调表 (等同 model.add_callback)
         if callbacks_list:
             for event, cb_func in callbacks_list:  # Ultralytics 回调注册方式
-                model.add_callback(event, cb_func)
+                model.callbacks.setdefault(event, []).append(cb_func)
 
         # 确保训练参数中的 device, epochs, batch 等被正确传递
         yolo_train_args = {
@@ -64,6 +213,9 @@ def run_yolo_training(
             yolo_train_args['epochs'] = 10  # 设置一个默认值以防万一
             logger.warning(f"训练参数中 epochs 无效或未提供，使用默认值: {yolo_train_args['epochs']}")
 
+        _choose_dataset_cache(yolo_train_args, data_yaml_path, logger)
+        _choose_precision(yolo_train_args, logger)
+
         logger.info(f"传递给 YOLO.train() 的参数: {yolo_train_args}")
 
         results = model.train(**yolo_train_args)
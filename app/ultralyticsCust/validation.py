@@ -1,10 +1,270 @@
 # app/ultralyticsCust/validation.py
 import os
 import json
+import shutil
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
 from ultralytics import YOLO
 from typing import Dict, Any, Tuple
 
+# 已加载模型的 LRU 缓存: (源模型真实路径, mtime_ns) -> YOLO，重复验证同一模型时不再重新读盘与构建。
+# 键取源模型 (预设模型或微调输出) 而不是暂存到任务目录中的副本，副本路径每个任务都不同
+_MODEL_CACHE: "OrderedDict[tuple, YOLO]" = OrderedDict()
+_MODEL_CACHE_MAX = 4
+_MODEL_CACHE_LOCK = threading.Lock()
+
+
+def _empty_cuda_cache():
+    try:
+        import torch
+    except ImportError:
+        return
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _get_cached_model(model_path: str, source_model_path: str = None) -> YOLO:
+    """
+    返回 model_path 对应的 YOLO 模型。给出 source_model_path (多个任务共用的源模型) 时按其路径和 mtime 缓存；
+    否则 (用户上传的一次性模型) 直接加载，不进入缓存。
+    """
+    if source_model_path is None:
+        return YOLO(model_path)
+    real_path = os.path.realpath(source_model_path)
+    key = (real_path, os.stat(real_path).st_mtime_ns)
+    with _MODEL_CACHE_LOCK:
+        model = _MODEL_CACHE.get(key)
+        if model is not None:
+            _MODEL_CACHE.move_to_end(key)
+            return model
+    model = YOLO(model_path)
+    evicted = False
+    with _MODEL_CACHE_LOCK:
+        # 同一路径的旧版本 (文件已被替换) 不会再命中，直接移除
+        for stale_key in [k for k in _MODEL_CACHE if k[0] == real_path and k != key]:
+            del _MODEL_CACHE[stale_key]
+            evicted = True
+        _MODEL_CACHE[key] = model
+        _MODEL_CACHE.move_to_end(key)
+        while len(_MODEL_CACHE) > _MODEL_CACHE_MAX:
+            _MODEL_CACHE.popitem(last=False)
+            evicted = True
+    if evicted:
+        _empty_cuda_cache()
+    return model
+
+
+def clear_model_cache(model_path: str = None):
+    """清空模型缓存；指定 model_path (源模型路径) 时只移除该文件对应的条目 (例如模型文件被删除后)。"""
+    with _MODEL_CACHE_LOCK:
+        if model_path is None:
+            _MODEL_CACHE.clear()
+        else:
+            real_path = os.path.realpath(model_path)
+            for key in [k for k in _MODEL_CACHE if k[0] == real_path]:
+                del _MODEL_CACHE[key]
+    _empty_cuda_cache()
+
+
+# 验证结果指标 -> metrics.box 上的属性名；同一指标有多个候选时按顺序取第一个可用的
+_BOX_METRIC_SPEC = (
+    ("mAP50-95(B)", ("map",)),
+    ("mAP50(B)", ("map50",)),
+    ("mAP75(B)", ("map75",)),
+    ("Precision(B)", ("mp", "p")),  # box.p 是按类别的列表，取第一个
+    ("Recall(B)", ("mr", "r")),
+)
+_SPEED_RESULT_KEYS = tuple((key, f"Speed_{key}_ms") for key in ('preprocess', 'inference', 'postprocess'))
+
+
+def _first_metric_value(obj, attrs):
+    for attr in attrs:
+        # getattr 带默认值: 一次查找，缺失时不抛异常
+        value = getattr(obj, attr, None)
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)) or getattr(value, 'ndim', 0) > 0:
+            if len(value) == 0:
+                continue
+            value = value[0]
+        if value is not None:
+            return round(float(value), 5)
+    return None
+
+
+def _extract_results_metrics(metrics, output_dir) -> Dict[str, Any]:
+    """一次遍历构造结果字典，缺失的指标直接跳过；metrics.box 与 metrics.speed 只取一次。"""
+    results_metrics = {}
+    box = getattr(metrics, 'box', None)
+    if box is not None:
+        for name, attrs in _BOX_METRIC_SPEC:
+            value = _first_metric_value(box, attrs)
+            if value is not None:
+                results_metrics[name] = value
+    fitness = _first_metric_value(metrics, ("fitness",))
+    if fitness is not None:
+        results_metrics["Fitness"] = fitness
+    speed = getattr(metrics, 'speed', None) or {}
+    for key, result_key in _SPEED_RESULT_KEYS:
+        value = speed.get(key)
+        if value is not None:
+            results_metrics[result_key] = value
+    results_metrics["output_directory"] = str(output_dir)
+    return results_metrics
+
+
+# 未指定 batch (或 batch 为 "auto"/空) 时依次尝试的批大小 (从大到小)，取第一个不会显存溢出的；
+# 无 CUDA 或探测失败时使用 _DEFAULT_VAL_BATCH
+_AUTOTUNE_BATCH_CANDIDATES = (64, 32, 16, 8, 4)
+_AUTOTUNE_FILE_NAME = 'autotune.json'
+_DEFAULT_VAL_BATCH = 32
+
+# validation_params['precision'] 可选值: 导出 TensorRT 引擎后再验证
+_EXPORT_PRECISIONS = ('fp16', 'int8')
+
+
+def _cuda_device_index(device) -> int:
+    """把 YOLO 的 device 参数解析为 CUDA 设备序号；CPU/MPS 或无法解析时返回 -1。"""
+    if device is None or device == '':
+        return 0
+    text = str(device).lower().replace('cuda:', '').strip()
+    first = text.split(',')[0].strip()
+    return int(first) if first.isdigit() else -1
+
+
+def _autotune_batch(model: YOLO, source_model_path: str, imgsz: int, device, cache_dir: str,
+                    logger: logging.Logger):
+    """
+    在 GPU 上用假输入做前向探测，返回不会显存溢出的最大批大小；无 CUDA 时返回 None。
+    有源模型和共享缓存目录时，结果按 (GPU 型号, 源模型路径与 mtime, imgsz) 记录在 cache_dir/autotune.json，
+    之后验证同一模型的任务直接复用；上传的一次性模型只探测不记录。
+    注意: 探测会把 (可能被缓存共享的) 模型移到目标 GPU 并切换为 eval 模式，与随后 val() 对模型做的处理相同；
+    autocast 不修改权重的数据类型。
+    """
+    try:
+        import torch
+    except ImportError:
+        return None
+    device_index = _cuda_device_index(device)
+    if device_index < 0 or not torch.cuda.is_available():
+        return None
+
+    gpu_name = torch.cuda.get_device_name(device_index)
+    key = autotune_path = None
+    autotune_cache = {}
+    if source_model_path and cache_dir:
+        key = f"{gpu_name}|{os.path.realpath(source_model_path)}|{os.stat(source_model_path).st_mtime_ns}|{imgsz}"
+        autotune_path = os.path.join(cache_dir, _AUTOTUNE_FILE_NAME)
+        try:
+            with open(autotune_path, 'r', encoding='utf-8') as f:
+                autotune_cache = json.load(f)
+        except (OSError, ValueError):
+            autotune_cache = {}
+        if isinstance(autotune_cache.get(key), int):
+            logger.info(f"复用已记录的验证批大小: batch={autotune_cache[key]}")
+            return autotune_cache[key]
+
+    torch_device = torch.device(f'cuda:{device_index}')
+    net = getattr(model, 'model', None)
+    if not isinstance(net, torch.nn.Module):  # 导出格式 (onnx/engine 等) 不做探测
+        return None
+    net = net.to(torch_device).eval()
+    chosen = None
+    for b in _AUTOTUNE_BATCH_CANDIDATES:
+        try:
+            with torch.no_grad(), torch.autocast('cuda'):
+                net(torch.zeros((b, 3, imgsz, imgsz), device=torch_device))
+            chosen = b
+            break
+        except torch.cuda.OutOfMemoryError:
+            logger.info(f"验证批大小 batch={b} 显存不足，尝试更小的批大小。")
+        except Exception as e:
+            # 探测只是优化，任何其他错误都不应影响验证本身
+            logger.warning(f"验证批大小探测失败，使用默认批大小: {e}")
+            return None
+        finally:
+            torch.cuda.empty_cache()
+    if chosen is None:
+        return None
+
+    if autotune_path:
+        autotune_cache[key] = chosen
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # 多个 worker 进程可能同时写入: 各自写临时文件再原子替换，最坏只丢失一条记录
+            tmp_path = f"{autotune_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(autotune_cache, f)
+            os.replace(tmp_path, autotune_path)
+        except OSError as e:
+            logger.warning(f"无法保存验证批大小探测结果: {e}")
+    logger.info(f"自动选择验证批大小: batch={chosen} (GPU: {gpu_name})")
+    return chosen
+
+
+def _engine_device_tag(device) -> str:
+    """TensorRT 引擎只能在构建它的 GPU 型号上使用，缓存键中带上 GPU 型号。"""
+    try:
+        import torch
+    except ImportError:
+        return 'cpu'
+    device_index = _cuda_device_index(device)
+    if device_index < 0 or not torch.cuda.is_available():
+        return 'cpu'
+    return torch.cuda.get_device_name(device_index)
+
+
+def _load_precision_model(model: YOLO, model_path: str, source_model_path: str, precision: str,
+                          data_yaml_path: str, project_path: str, cache_dir: str,
+                          val_args: Dict[str, Any], logger: logging.Logger):
+    """
+    按 precision 导出 (或复用已缓存的) TensorRT 引擎并加载，返回 (模型, 用完后应删除的引擎路径或 None)。
+    有源模型和共享缓存目录时，引擎缓存在 cache_dir/engines 下，键包含源模型路径与 mtime、GPU 型号、imgsz、batch 与精度，
+    验证同一模型的后续任务直接复用 (int8 的校准数据取首次导出时的数据集)；
+    上传的一次性模型导出到任务输出目录，验证结束后删除。
+    导出失败时回退到原模型，fp16 退化为 half=True。
+    """
+    imgsz = val_args.get('imgsz', 640)
+    batch = val_args.get('batch', 1)
+    if source_model_path and cache_dir:
+        st = os.stat(source_model_path)
+        key = (f"{os.path.realpath(source_model_path)}|{st.st_mtime_ns}|{_engine_device_tag(val_args.get('device'))}"
+               f"|{imgsz}|{batch}|{precision}")
+        engine_dir = os.path.join(cache_dir, 'engines')
+        engine_path = os.path.join(engine_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.engine')
+        temporary = False
+    else:
+        engine_dir = project_path
+        engine_path = os.path.join(engine_dir, f"_val_{precision}.engine")
+        temporary = True
+
+    if not temporary and os.path.exists(engine_path):
+        logger.info(f"复用已缓存的 {precision} TensorRT 引擎: {engine_path}")
+        return YOLO(engine_path, task=model.task), None
+
+    try:
+        logger.info(f"导出 {precision} TensorRT 引擎 (imgsz={imgsz}, batch={batch})，首次导出可能需要数分钟...")
+        exported_path = model.export(format='engine', half=(precision == 'fp16'), int8=(precision == 'int8'),
+                                     imgsz=imgsz, batch=batch, data=data_yaml_path,
+                                     device=val_args.get('device'))
+        os.makedirs(engine_dir, exist_ok=True)
+        # 先移到同目录的临时名再原子替换，并发导出同一引擎的 worker 不会读到写了一半的文件
+        tmp_path = f"{engine_path}.{os.getpid()}.tmp"
+        shutil.move(str(exported_path), tmp_path)
+        os.replace(tmp_path, engine_path)
+        logger.info(f"TensorRT 引擎已{'生成' if temporary else '缓存'}: {engine_path}")
+        return YOLO(engine_path, task=model.task), (engine_path if temporary else None)
+    except Exception as e:
+        logger.warning(f"导出 {precision} TensorRT 引擎失败，使用原模型验证: {e}")
+        if precision == 'fp16':
+            # half=True 时 AutoBackend 会就地 .half() 模型；缓存中的模型被其他任务共用，改用一份单独加载的副本
+            if source_model_path:
+                model = YOLO(model_path)
+            val_args.setdefault('half', True)
+        return model, None
+
 
 def run_yolo_validation(
         model_path: str,  # 待验证模型的路径
@@ -13,7 +273,9 @@ def run_yolo_validation(
         run_name: str,  # YOLO验证运行的名称
         validation_params: Dict[str, Any],  # 包含 batch, imgsz, conf, iou, device, etc.
         # log_file_path: str, # YOLOv8 会在 project_path/run_name 下自动生成日志
-        logger: logging.Logger = None
+        logger: logging.Logger = None,
+        source_model_path: str = None,  # model_path 暂存自的源模型 (预设/微调输出)；上传的模型为 None
+        cache_dir: str = None  # 各任务共享的缓存目录 (批大小探测结果、TensorRT 引擎)
 ) -> Tuple[bool, str, Dict[str, Any]]:
     """
     执行 YOLO 模型验证。
@@ -24,6 +286,8 @@ def run_yolo_validation(
     :param run_name: 本次验证的名称。
     :param validation_params: 验证参数字典。
     :param logger: 日志记录器。
+    :param source_model_path: 源模型路径，用作模型缓存的键；为 None 时不缓存。
+    :param cache_dir: 各任务共享的缓存目录；为 None 时不持久化探测结果。
     :return: (success_flag, message_or_error, results_metrics_dict)
     """
     if logger is None:
@@ -44,8 +308,13 @@ def run_yolo_validation(
         logger.error(msg)
         return False, msg, {}
 
+    temp_engine_path = None
     try:
-        model = YOLO(model_path)
+        model = _get_cached_model(model_path, source_model_path)
+
+        # precision 不是 YOLO.val() 的参数，取出后单独处理
+        validation_params = dict(validation_params)
+        precision = validation_params.pop('precision', None)
 
         # Ultralytics YOLOv8 的 val 方法参数
         # 常见参数: data, batch, imgsz, conf, iou, device, project, name, plots, save_json, save_hybrid
@@ -54,10 +323,23 @@ def run_yolo_validation(
             'project': project_path,
             'name': run_name,
             'save_json': True,  # 确保保存JSON格式的结果，方便解析
-            'plots': validation_params.get('plots', True),  # 通常需要绘图
+            'plots': validation_params.get('plots', False),  # matplotlib 绘图耗时数秒，只在调用方明确要求时生成
             **validation_params  # 解包用户传入的参数
         }
 
+        # 前端批大小输入框留空时提交空字符串，同样按自动处理
+        if yolo_val_args.get('batch') in (None, '', 'auto'):
+            tuned_batch = _autotune_batch(model, source_model_path, yolo_val_args.get('imgsz', 640),
+                                          yolo_val_args.get('device'), cache_dir, logger)
+            yolo_val_args['batch'] = tuned_batch if tuned_batch is not None else _DEFAULT_VAL_BATCH
+
+        if precision in _EXPORT_PRECISIONS:
+            model, temp_engine_path = _load_precision_model(model, model_path, source_model_path, precision,
+                                                            data_yaml_path, project_path, cache_dir,
+                                                            yolo_val_args, logger)
+        elif precision is not None:
+            logger.warning(f"不支持的验证精度 precision={precision}，按原模型精度验证。")
+
         logger.info(f"传递给 YOLO.val() 的参数: {yolo_val_args}")
 
         # 执行验证
@@ -75,24 +357,7 @@ def run_yolo_validation(
         # 或者 metrics.results_dict 包含这些信息
         # 我们直接使用 metrics 对象提取指标
 
-        results_metrics = {
-            "mAP50-95(B)": round(metrics.box.map, 5) if hasattr(metrics.box, 'map') else None,
-            "mAP50(B)": round(metrics.box.map50, 5) if hasattr(metrics.box, 'map50') else None,
-            "mAP75(B)": round(metrics.box.map75, 5) if hasattr(metrics.box, 'map75') else None,
-            "Precision(B)": round(metrics.box.mp, 5) if hasattr(metrics.box, 'mp') else (
-                round(metrics.box.p[0], 5) if hasattr(metrics.box, 'p') and metrics.box.p else None),
-            # metrics.box.p 是一个列表，通常取第一个
-            "Recall(B)": round(metrics.box.mr, 5) if hasattr(metrics.box, 'mr') else (
-                round(metrics.box.r[0], 5) if hasattr(metrics.box, 'r') and metrics.box.r else None),
-            # metrics.box.r 是一个列表
-            "Fitness": round(metrics.fitness, 5) if hasattr(metrics, 'fitness') else None,
-            "Speed_preprocess_ms": metrics.speed['preprocess'] if 'preprocess' in metrics.speed else None,
-            "Speed_inference_ms": metrics.speed['inference'] if 'inference' in metrics.speed else None,
-            "Speed_postprocess_ms": metrics.speed['postprocess'] if 'postprocess' in metrics.speed else None,
-            "output_directory": str(output_dir)
-        }
-        # 移除值为None的键，使结果更干净
-        results_metrics = {k: v for k, v in results_metrics.items() if v is not None}
+        results_metrics = _extract_results_metrics(metrics, output_dir)
 
         logger.info(f"验证成功完成。指标: {results_metrics}")
         logger.info(f"验证输出保存在: {output_dir}")
@@ -101,4 +366,10 @@ def run_yolo_validation(
 
     except Exception as e:
         logger.error(f"YOLO 验证过程中发生严重错误: {str(e)}", exc_info=True)
-        return False, f"YOLO 验证失败: {str(e)}", {}
\ No newline at end of file
+        return False, f"YOLO 验证失败: {str(e)}", {}
+    finally:
+        if temp_engine_path:
+            try:
+                os.remove(temp_engine_path)
+            except OSError:
+                pass
\ No newline at end of file
@@ -0,0 +1,124 @@
+# app/utils/archives.py
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# 解压时每次读写的块大小；zipfile 默认按 16 KB 复制，成千上万张图片时 write 调用过多
+EXTRACT_BUFFER_SIZE = 1 << 20
+
+# 本身已经压缩过的文件再 DEFLATE 几乎不会变小，打包时直接存储
+ALREADY_COMPRESSED_SUFFIXES = ('.png', '.jpg', '.jpeg', '.webp', '.zip', '.gz')
+# 其余文本类文件 (json/yaml/txt/csv) 用最低压缩级别，压缩率接近默认级别但快得多
+ARCHIVE_DEFLATE_LEVEL = 1
+
+
+def member_compression(filename):
+    """返回打包该文件时使用的 (compress_type, compresslevel)。"""
+    if filename.lower().endswith(ALREADY_COMPRESSED_SUFFIXES):
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, ARCHIVE_DEFLATE_LEVEL
+
+
+def _member_target_path(info, dest):
+    """
+    与 ZipFile.extract 相同的成员路径清洗: 去掉盘符、绝对路径前缀以及 '.'/'..' 组成部分，
+    保证解压结果一定落在 dest 目录下。
+    """
+    arcname = info.filename.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    parts = [p for p in arcname.split(os.path.sep) if p not in ('', os.path.curdir, os.path.pardir)]
+    if not parts:
+        return None
+    return os.path.join(dest, *parts)
+
+
+def _copy_member(zf, info, target, buf):
+    """用 readinto 填充复用的缓冲区，再直接 os.write 到文件描述符，不经过 Python 文件对象。"""
+    view = memoryview(buf)
+    fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        with zf.open(info) as src:
+            while True:
+                n = src.readinto(buf)
+                if not n:
+                    break
+                written = 0
+                while written < n:
+                    written += os.write(fd, view[written:n])
+    finally:
+        os.close(fd)
+
+
+def _extract_members(zip_path, members, bufsize):
+    # ZipFile 对象不能在线程间共享读取压缩成员，每个工作线程打开自己的句柄和缓冲区
+    buf = bytearray(bufsize)
+    with zipfile.ZipFile(zip_path, 'r') as zf:
+        for info, target in members:
+            _copy_member(zf, info, target, buf)
+
+
+def fast_extractall(zf, dest, bufsize=EXTRACT_BUFFER_SIZE, workers=1, sync=False):
+    """
+    ZipFile.extractall 的替代实现: 按 bufsize 大块复制每个成员，
+    并记住已创建过的目录，避免对同一目录重复 makedirs。
+    workers > 1 且 ZIP 来自磁盘文件时，先单线程创建全部目录，再把文件成员交错分给多个线程解压
+    (zlib 解压期间释放 GIL)；任一线程出错时抛出第一个异常。
+    单个文件不做 fsync；sync=True 时在全部成员解压完成后调用一次 os.sync() 统一刷盘。
+    """
+    created_dirs = set()
+    files = []
+    for info in zf.infolist():
+        target = _member_target_path(info, dest)
+        if target is None:
+            continue
+        directory = target if info.is_dir() else os.path.dirname(target)
+        if directory not in created_dirs:
+            os.makedirs(directory, exist_ok=True)
+            created_dirs.add(directory)
+        if not info.is_dir():
+            files.append((info, target))
+
+    workers = min(workers, len(files))
+    if workers <= 1 or not isinstance(zf.filename, str):
+        buf = bytearray(bufsize)
+        for info, target in files:
+            _copy_member(zf, info, target, buf)
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='unzip') as executor:
+            futures = [executor.submit(_extract_members, zf.filename, files[i::workers], bufsize)
+                       for i in range(workers)]
+            for future in as_completed(futures):
+                future.result()
+
+    if sync and hasattr(os, 'sync'):
+        os.sync()
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write_dir_to_zip(zf, src_dir, workers=4):
+    """
+    把 src_dir 下的全部文件按相对路径写入 zf。
+    文件内容由线程池预读 (读盘期间释放 GIL)，主线程按 os.walk 的顺序依次压缩写入，
+    归档内容与顺序和逐个 zf.write 完全一致；每次最多预读 workers * 4 个文件以限制内存占用。
+    """
+    entries = []
+    for root, _, files in os.walk(src_dir):
+        for file_item in files:
+            file_path = os.path.join(root, file_item)
+            entries.append((file_path, os.path.relpath(file_path, src_dir)))
+
+    window = max(1, workers) * 4
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='zipread') as executor:
+        for start in range(0, len(entries), window):
+            batch = entries[start:start + window]
+            for (file_path, arcname), data in zip(batch, executor.map(_read_file, [p for p, _ in batch])):
+                # ZipInfo.from_file 保留原文件的修改时间和权限位
+                zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+                compress_type, compresslevel = member_compression(arcname)
+                zf.writestr(zinfo, data, compress_type=compress_type, compresslevel=compresslevel)
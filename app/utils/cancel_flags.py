@@ -0,0 +1,53 @@
+# app/utils/cancel_flags.py
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 取消标记在 Redis 中的保留时间；任务结束时会主动删除，TTL 只是兜底
+CANCEL_FLAG_TTL_SECONDS = 3600
+_KEY_PREFIX = 'cancel:'
+
+
+def _redis_client(celery):
+    """Celery 结果后端为 Redis 时返回其 redis 客户端，否则返回 None (调用方回退到信号文件)。"""
+    if celery is None:
+        return None
+    try:
+        return getattr(celery.backend, 'client', None)
+    except Exception:  # pragma: no cover
+        return None
+
+
+def set_cancel_flag(celery, task_id, ttl=CANCEL_FLAG_TTL_SECONDS):
+    """写入 cancel:<task_id> 标记。成功返回 True；没有 Redis 后端或写入失败返回 False。"""
+    client = _redis_client(celery)
+    if client is None:
+        return False
+    try:
+        client.setex(f"{_KEY_PREFIX}{task_id}", ttl, 1)
+        return True
+    except Exception as e:
+        logger.warning(f"写入任务 {task_id} 的 Redis 取消标记失败: {e}")
+        return False
+
+
+def is_cancel_flagged(celery, task_id):
+    """一次 Redis EXISTS 查询；没有 Redis 后端或查询失败时返回 False。"""
+    client = _redis_client(celery)
+    if client is None:
+        return False
+    try:
+        return bool(client.exists(f"{_KEY_PREFIX}{task_id}"))
+    except Exception as e:
+        logger.warning(f"查询任务 {task_id} 的 Redis 取消标记失败: {e}")
+        return False
+
+
+def clear_cancel_flag(celery, task_id):
+    client = _redis_client(celery)
+    if client is None:
+        return
+    try:
+        client.delete(f"{_KEY_PREFIX}{task_id}")
+    except Exception:  # pragma: no cover
+        pass
@@ -1,19 +1,25 @@
 # app/utils/decorators.py
+import inspect
 from functools import wraps
-from flask import session, jsonify
+from flask import session, jsonify, g
 
 
 def login_required(f):
     """
     检查用户是否已登录的装饰器。
     如果未登录，返回 403 Forbidden。
+    已登录时把 user_id 放到 flask.g.user_id；视图函数声明了 user_id 参数时同时以关键字参数传入。
     """
+    # 是否需要注入 user_id 在装饰时判断一次，不必每个请求都检查
+    inject_user_id = 'user_id' in inspect.signature(f).parameters
+
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             return jsonify({"error": "您还未登录，请登录账号后再试。"}), 403
-        # 将 user_id 传递给被装饰的视图函数，方便使用
-        kwargs['user_id'] = session['user_id']
+        g.user_id = session['user_id']
+        if inject_user_id:
+            kwargs['user_id'] = g.user_id
         return f(*args, **kwargs)
 
-    return decorated_function
\ No newline at end of file
+    return decorated_function
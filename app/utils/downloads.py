@@ -0,0 +1,43 @@
+# app/utils/downloads.py
+import os
+from urllib.parse import quote
+from flask import current_app, send_from_directory, Response
+
+
+def send_archive(archive_path, download_name=None, mimetype='application/zip', stat_result=None):
+    """
+    发送打包好的输出归档。
+    配置了 X_ACCEL_REDIRECT_PREFIX 时只返回 X-Accel-Redirect 头，由 nginx 的 internal location
+    用 sendfile(2) 直接发送文件，不经过 Python；X_ACCEL_REDIRECT_ROOT 是该 location 对应的目录
+    (默认为 USER_MODEL_BASE_DIR)。未配置或文件不在该目录下时回退到 send_from_directory
+    (Flask 的 USE_X_SENDFILE 对 Apache mod_xsendfile 同样有效)。
+    调用方已经 os.stat 过文件时传入 stat_result，避免重复 stat。
+    """
+    download_name = download_name or os.path.basename(archive_path)
+    prefix = current_app.config.get('X_ACCEL_REDIRECT_PREFIX')
+    if prefix:
+        root = os.path.realpath(current_app.config.get('X_ACCEL_REDIRECT_ROOT')
+                                or current_app.config.get('USER_MODEL_BASE_DIR', ''))
+        real_path = os.path.realpath(archive_path)
+        if real_path.startswith(root + os.sep):
+            rel_path = os.path.relpath(real_path, root).replace(os.sep, '/')
+            response = Response(mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(rel_path)
+            response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(download_name)}"
+            return response
+        current_app.logger.warning(f"归档 {archive_path} 不在 X_ACCEL_REDIRECT_ROOT ({root}) 下，改由应用直接发送。")
+
+    # 条件请求: 带 ETag/Last-Modified，未变化时返回 304，支持 Range 断点续传 (206)；
+    # 文件体优先由 WSGI 服务器的 wsgi.file_wrapper (如 gunicorn 的 sendfile 实现) 发送
+    directory, filename = os.path.split(os.path.abspath(archive_path))
+    return send_from_directory(
+        directory,
+        filename,
+        as_attachment=True,
+        download_name=download_name,
+        mimetype=mimetype,
+        conditional=True,
+        etag=True,
+        last_modified=stat_result.st_mtime if stat_result is not None else os.path.getmtime(archive_path),
+        max_age=0
+    )
@@ -0,0 +1,86 @@
+# app/utils/fileops.py
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# 文件数少于这个值时直接串行删除，不值得启动线程池
+_PARALLEL_MIN_FILES = 64
+
+
+def write_file_bytes(path, data, mode=0o644):
+    """用一次 os.open + os.write 写入整个字节串 (覆盖已有文件)，不经过 Python 文件对象的缓冲层。"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def remove_if_exists(path):
+    """删除文件并返回 True；文件不存在时返回 False。只有一次 unlink 系统调用，不先 stat。其他 OSError 照常抛出。"""
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def stage_file(src, dst):
+    """
+    把只读的输入文件 (模型权重等) 放到任务目录下: 同一文件系统上优先建立硬链接，不复制任何数据；
+    跨文件系统或目标已存在时回退到 shutil.copyfile (Linux 上走 copy_file_range/sendfile，
+    不经过用户态缓冲区，也不复制元数据)。调用方不得原地修改 dst，否则会改到源文件。
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+    return dst
+
+
+def prefetch_file(path):
+    """
+    提示内核把整个文件异步读入页缓存 (posix_fadvise WILLNEED，立即返回，不阻塞等待读盘)，返回文件大小。
+    不支持 posix_fadvise 的平台上只做 stat。
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+    return size
+
+
+def parallel_rmtree(path, workers=8):
+    """
+    删除整个目录树，语义与 shutil.rmtree 相同 (符号链接本身被删除，不跟随)。
+    先用 os.scandir 非递归地收集全部文件，由线程池并发 unlink (成千上万张图片时 unlink 是主要耗时)，
+    再自底向上串行 rmdir。出错时抛出第一个 OSError。
+    """
+    files = []
+    dirs = [path]
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                    stack.append(entry.path)
+                else:
+                    files.append(entry.path)
+
+    if workers > 1 and len(files) >= _PARALLEL_MIN_FILES:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rmtree') as executor:
+            # list() 会在第一个失败的 unlink 处抛出异常
+            list(executor.map(os.unlink, files, chunksize=256))
+    else:
+        for file_path in files:
+            os.unlink(file_path)
+
+    # 父目录总是先于子目录被收集，倒序即为自底向上
+    for dir_path in reversed(dirs):
+        os.rmdir(dir_path)
@@ -0,0 +1,38 @@
+# app/utils/json_utils.py
+import json
+from flask import current_app, jsonify
+
+# 可选依赖: orjson 解析/序列化更快，未安装时回退到标准库 json 和 Flask 的 jsonify
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 两种实现下解析失败抛出的异常类型 (orjson.JSONDecodeError 是 json.JSONDecodeError 的子类)
+JSONDecodeError = json.JSONDecodeError
+
+
+def loads(data):
+    """解析请求中的 JSON 字符串或字节串。"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps_bytes(obj) -> bytes:
+    if orjson is None:
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+    # OPT_SERIALIZE_NUMPY: 训练回调的指标缓存中可能含有 numpy 标量/数组
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+def bytes_response(body: bytes, status=200):
+    """用已经序列化好的 JSON 字节串构造响应。"""
+    return current_app.response_class(body, mimetype='application/json'), status
+
+
+def json_response(obj, status=200):
+    """返回 JSON 响应；有 orjson 时直接生成字节串，适合任务列表/详情这类可能较大的响应体。"""
+    if orjson is None:
+        return jsonify(obj), status
+    return bytes_response(dumps_bytes(obj), status)
@@ -0,0 +1,38 @@
+# app/utils/logfiles.py
+import os
+
+_TAIL_BLOCK_SIZE = 8192
+# 未指定 tail 行数时最多返回日志末尾的这么多字节
+DEFAULT_LOG_MAX_BYTES = 1024 * 1024
+
+
+def tail_lines(path, n):
+    """与 tail -n 语义一致: 从文件末尾按 8 KB 分块向前读取，只读取最后 n 行所需的字节。"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        buf = b''
+        # 多读一个换行符，保证最前面那一行是完整的
+        while end > 0 and buf.count(b'\n') <= n:
+            read_size = min(_TAIL_BLOCK_SIZE, end)
+            end -= read_size
+            f.seek(end)
+            buf = f.read(read_size) + buf
+    lines = buf.splitlines(keepends=True)[-n:]
+    return b''.join(lines).decode('utf-8', 'replace')
+
+
+def read_tail_bytes(path, max_bytes=DEFAULT_LOG_MAX_BYTES):
+    """读取文件末尾最多 max_bytes 字节；被截断时丢弃开头不完整的一行。"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size <= max_bytes:
+            f.seek(0)
+            return f.read().decode('utf-8', 'replace')
+        f.seek(size - max_bytes)
+        data = f.read()
+    newline = data.find(b'\n')
+    if newline != -1:
+        data = data[newline + 1:]
+    return data.decode('utf-8', 'replace')
@@ -0,0 +1,28 @@
+# app/utils/sessions.py
+from flask.sessions import SessionInterface
+
+
+class StaticRequestFilteringSessionInterface(SessionInterface):
+    """
+    包装实际的会话接口 (Flask-Session)。路径以 skip_prefixes 开头的请求 (静态资源、favicon、健康检查)
+    直接得到空会话，不读取也不写回会话存储；其余请求原样交给内部接口处理。
+    Flask 对空会话不会调用 save_session，因此这些请求完全不访问会话文件。
+    """
+
+    def __init__(self, inner, skip_prefixes):
+        self.inner = inner
+        self.skip_prefixes = tuple(skip_prefixes)
+
+    def __getattr__(self, name):
+        # 其余属性 (serializer、key_prefix 等) 转发给内部接口
+        if name == 'inner':
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    def open_session(self, app, request):
+        if request.path.startswith(self.skip_prefixes):
+            return self.make_null_session(app)
+        return self.inner.open_session(app, request)
+
+    def save_session(self, app, session, response):
+        return self.inner.save_session(app, session, response)
@@ -1,46 +1,113 @@
 # app/validate/routes.py
 import os
-import json
+import time
+import uuid
+import threading
+from types import MappingProxyType, SimpleNamespace
 # from functools import wraps # No longer needed if using the shared decorator
-from flask import request, jsonify, current_app, session, send_file # Keep session for username if needed for logging
+from flask import request, jsonify, current_app, session, g # Keep session for username if needed for logging
 from werkzeug.utils import secure_filename
 from . import validate_bp
 from ..utils.decorators import login_required
+from ..utils.downloads import send_archive
+from ..utils import json_utils
+from ..utils.json_utils import json_response, bytes_response
 
 # ALLOWED_EXTENSIONS 保持不变
-ALLOWED_EXTENSIONS_MODEL = {'pt'}
-ALLOWED_EXTENSIONS_DATASET = {'zip'}
-ALLOWED_EXTENSIONS_YAML = {'yaml', 'yml'}
+ALLOWED_EXTENSIONS_MODEL = frozenset({'pt'})
+ALLOWED_EXTENSIONS_DATASET = frozenset({'zip'})
+ALLOWED_EXTENSIONS_YAML = frozenset({'yaml', 'yml'})
 
 
 def allowed_file(filename, allowed_extensions):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in allowed_extensions
+    # rfind 取扩展名，不像 rsplit 那样分配列表
+    i = filename.rfind('.')
+    return i != -1 and filename[i + 1:].lower() in allowed_extensions
+
+
+# 任务列表响应的短期缓存: user_id -> (生成时间, 序列化后的 JSON 字节串)；
+# 前端每 1-2 秒轮询一次，TTL 内的重复请求直接返回缓存。创建/取消/删除任务时失效
+_LIST_CACHE = {}
+_LIST_TTL = 1.0
+_LIST_CACHE_LOCK = threading.Lock()
+
+
+def _invalidate_task_list_cache(user_id):
+    with _LIST_CACHE_LOCK:
+        _LIST_CACHE.pop(user_id, None)
+
+
+MODEL_SOURCE_TYPES = ('upload', 'inference_model', 'finetune_output')
+DATASET_SOURCE_TYPES = ('upload', 'finetune_val_set', 'preset_dataset')
+
+# 创建验证任务表单中的可选字段及其默认值 (validation_params 是 JSON 字符串，单独解析)
+_CREATE_FORM_DEFAULTS = {
+    'task_name': None,
+    'validation_params': '{}',
+    'inference_model_name': None,
+    'finetune_task_id_for_model': None,
+    'finetune_model_type': 'best.pt',
+    'finetune_task_id_for_dataset': None,
+    'preset_dataset_name': None,
+}
+
+# 验证参数默认值，只读，每个请求复制一份后再合并用户参数。
+# 不设默认 batch: 未指定 (或 "auto") 时由 worker 在 GPU 上探测可用的最大批大小，无 GPU 时为 32
+_DEFAULT_VAL_PARAMS = MappingProxyType({
+    "imgsz": 640, "conf": 0.001, "iou": 0.6,
+    "save_json": True, "save_hybrid": False, "plots": False
+})
+
+
+def _parse_create_form(form):
+    """校验创建验证任务的表单字段，返回 (表单对象, 错误信息)，两者有且只有一个为 None。"""
+    data = form.to_dict()
+    if data.get('model_source_type') not in MODEL_SOURCE_TYPES:
+        return None, "Invalid or missing model_source_type. Expected 'upload', 'inference_model', or 'finetune_output'."
+    if data.get('dataset_source_type') not in DATASET_SOURCE_TYPES:
+        return None, "Invalid or missing dataset_source_type. Dataset is required."
+    fields = {name: data.get(name, default) for name, default in _CREATE_FORM_DEFAULTS.items()}
+    return SimpleNamespace(model_source_type=data['model_source_type'],
+                           dataset_source_type=data['dataset_source_type'], **fields), None
+
+
+def _safe_task_id(task_id):
+    """任务 ID 通常是 UUID，合法时直接使用其规范形式，否则再经 secure_filename 清洗。"""
+    try:
+        return str(uuid.UUID(task_id))
+    except ValueError:
+        return secure_filename(task_id)
 
 
 @validate_bp.route('/tasks', methods=['POST'])
-@login_required # 这个装饰器现在应该会注入 user_id
-def create_validation_task_route(user_id): # <--- 接收 user_id 参数
+@login_required # 登录用户的 user_id 由装饰器放在 g.user_id
+def create_validation_task_route():
+    user_id = g.user_id
     # username = session.get('username') # 仍然可以获取 username 用于日志等
 
     current_app.logger.info(f"用户ID '{user_id}' 正在尝试创建验证任务。")
 
-    # --- 1. 获取任务基本信息 ---
-    task_name = request.form.get('task_name', None)
-    validation_params_str = request.form.get('validation_params', '{}')
+    # --- 1. 校验表单字段，获取任务基本信息 ---
+    form, form_error = _parse_create_form(request.form)
+    if form_error:
+        current_app.logger.warning(f"用户ID '{user_id}' 提交的验证任务表单无效: {form_error}")
+        return jsonify({"error": form_error}), 400
+    task_name = form.task_name
+    validation_params_str = form.validation_params
     try:
-        validation_params_input = json.loads(validation_params_str)
+        validation_params_input = json_utils.loads(validation_params_str)
         if not isinstance(validation_params_input, dict):
             raise ValueError("validation_params must be a JSON object")
-    except json.JSONDecodeError:
-        current_app.logger.error(f"用户ID '{user_id}' 的 validation_params JSON无效: {validation_params_str}")
+    except json_utils.JSONDecodeError:
+        # 客户端输入错误属于预期情况，记 warning 且不带堆栈
+        current_app.logger.warning(f"用户ID '{user_id}' 的 validation_params JSON无效: {validation_params_str[:200]}")
         return jsonify({"error": "Invalid JSON in validation_params"}), 400
     except ValueError as e:
-        current_app.logger.error(f"用户ID '{user_id}' 的 validation_params 验证错误: {e}")
+        current_app.logger.warning(f"用户ID '{user_id}' 的 validation_params 验证错误: {e}")
         return jsonify({"error": str(e)}), 400
 
-    # --- 2. 处理模型来源 ---
-    model_source_type = request.form.get('model_source_type')
+    # --- 2. 处理模型来源 (来源类型已由表单校验限定) ---
+    model_source_type = form.model_source_type
     model_to_validate_fs = None
     model_identifier_for_service = None # 初始化
 
@@ -48,28 +115,27 @@ def create_validation_task_route(user_id): # <--- 接收 user_id 参数
         if 'model_file_upload' not in request.files:
             return jsonify({"error": "Missing model_file_upload for 'upload' source type"}), 400
         model_to_validate_fs = request.files['model_file_upload']
-        if not (model_to_validate_fs.filename and allowed_file(model_to_validate_fs.filename, ALLOWED_EXTENSIONS_MODEL)):
+        model_filename = model_to_validate_fs.filename
+        if not (model_filename and allowed_file(model_filename, ALLOWED_EXTENSIONS_MODEL)):
             return jsonify({"error": "Invalid model file type for validation model upload"}), 400
         # 为上传的模型设置一个标识符，例如使用安全的文件名
-        model_identifier_for_service = f"upload:{secure_filename(model_to_validate_fs.filename)}"
+        model_identifier_for_service = f"upload:{secure_filename(model_filename)}"
     elif model_source_type == 'inference_model':
-        inference_model_name = request.form.get('inference_model_name')
+        inference_model_name = form.inference_model_name
         if not inference_model_name:
             return jsonify({"error": "Missing inference_model_name for 'inference_model' source type"}), 400
         model_identifier_for_service = f"inference:{secure_filename(inference_model_name)}"
-    elif model_source_type == 'finetune_output':
-        finetune_task_id = request.form.get('finetune_task_id_for_model')
-        model_type = request.form.get('finetune_model_type', 'best.pt')
+    else:  # 'finetune_output'
+        finetune_task_id = form.finetune_task_id_for_model
+        model_type = form.finetune_model_type
         if not finetune_task_id:
             return jsonify({"error": "Missing finetune_task_id_for_model for 'finetune_output' source type"}), 400
-        model_identifier_for_service = f"finetune:{secure_filename(finetune_task_id)}:{secure_filename(model_type)}"
-    else:
-        return jsonify({"error": "Invalid or missing model_source_type. Expected 'upload', 'inference_model', or 'finetune_output'."}), 400
+        model_identifier_for_service = f"finetune:{_safe_task_id(finetune_task_id)}:{secure_filename(model_type)}"
 
     # --- 3. 处理数据集来源 ---
-    dataset_source_type = request.form.get('dataset_source_type')
+    dataset_source_type = form.dataset_source_type
     dataset_zip_file_storage = None
-    dataset_yaml_content = None
+    dataset_yaml_file = None
     dataset_identifier_for_service = None
 
     if dataset_source_type == 'upload':
@@ -81,35 +147,22 @@ def create_validation_task_route(user_id): # <--- 接收 user_id 参数
             return jsonify({"error": "Invalid dataset zip file type for validation"}), 400
         if not (dataset_yaml_file.filename and allowed_file(dataset_yaml_file.filename, ALLOWED_EXTENSIONS_YAML)):
             return jsonify({"error": "Invalid dataset config file type for validation"}), 400
-        try:
-            dataset_yaml_content = dataset_yaml_file.read().decode('utf-8')
-        except Exception as e:
-            current_app.logger.error(f"读取 dataset_yaml_upload 文件失败，用户ID '{user_id}': {e}")
-            return jsonify({"error": f"Could not read dataset_yaml for validation: {str(e)}"}), 400
+        # 不在路由中读入内存，服务层直接用 FileStorage.save() 分块写入任务目录
         dataset_identifier_for_service = "upload"
     elif dataset_source_type == 'finetune_val_set':
-        finetune_task_id_for_dataset = request.form.get('finetune_task_id_for_dataset')
+        finetune_task_id_for_dataset = form.finetune_task_id_for_dataset
         if not finetune_task_id_for_dataset:
             return jsonify({"error": "Missing finetune_task_id_for_dataset for 'finetune_val_set' dataset type"}), 400
-        dataset_identifier_for_service = f"finetune_val:{secure_filename(finetune_task_id_for_dataset)}"
-    elif dataset_source_type == 'preset_dataset':
-        preset_dataset_name = request.form.get('preset_dataset_name')
+        dataset_identifier_for_service = f"finetune_val:{_safe_task_id(finetune_task_id_for_dataset)}"
+    else:  # 'preset_dataset'
+        preset_dataset_name = form.preset_dataset_name
         if not preset_dataset_name:
             return jsonify({"error": "Missing preset_dataset_name for 'preset_dataset' type"}), 400
         dataset_identifier_for_service = f"preset_ds:{secure_filename(preset_dataset_name)}"
-    # else: # 如果数据集是可选的，这里可能不需要报错
-    #    dataset_identifier_for_service = None # 或其他表示可选的标记
-
-    if not dataset_identifier_for_service and model_source_type != 'some_type_with_builtin_data': # 明确要求数据集来源
-        return jsonify({"error": "Invalid or missing dataset_source_type. Dataset is required."}), 400
-
 
     # --- 4. 合并验证参数 ---
-    default_validation_params = {
-        "imgsz": 640, "batch": 32, "conf": 0.001, "iou": 0.6,
-        "save_json": True, "save_hybrid": False, "plots": True
-    }
-    final_validation_params = {**default_validation_params, **validation_params_input}
+    final_validation_params = dict(_DEFAULT_VAL_PARAMS)
+    final_validation_params.update(validation_params_input)
 
     # --- 5. 调用服务层 ---
     validate_service = current_app.validate_service
@@ -121,18 +174,21 @@ def create_validation_task_route(user_id): # <--- 接收 user_id 参数
             model_file_storage_if_upload=model_to_validate_fs, # 仅当 model_source_type=='upload' 时有值
             dataset_identifier=dataset_identifier_for_service, # 服务层会根据这个解析
             dataset_zip_file_storage_if_upload=dataset_zip_file_storage, # 仅当 dataset_source_type=='upload' 时有值
-            dataset_yaml_content_if_upload=dataset_yaml_content, # 仅当 dataset_source_type=='upload' 时有值
+            dataset_yaml_file_storage_if_upload=dataset_yaml_file, # 仅当 dataset_source_type=='upload' 时有值
             validation_params=final_validation_params
         )
 
         if task_id_result:
+            _invalidate_task_list_cache(user_id)
             current_app.logger.info(f"验证任务 '{task_id_result}' 已为用户ID '{user_id}' 成功创建。")
-            return jsonify({"message": message, "task_id": task_id_result}), 201
+            # 数据集准备在 Celery 任务中进行，客户端通过任务详情轮询状态
+            return jsonify({"message": message, "task_id": task_id_result}), 202
         else:
-            current_app.logger.error(f"为用户ID '{user_id}' 创建验证任务失败: {message}")
             status_code = 500
             if "未找到" in message.lower() or "无效" in message.lower() or "缺失" in message.lower():
                 status_code = 400
+            log = current_app.logger.error if status_code == 500 else current_app.logger.warning
+            log(f"为用户ID '{user_id}' 创建验证任务失败: {message}")
             return jsonify({"error": message}), status_code
     except Exception as e:
         current_app.logger.error(f"用户ID '{user_id}' 创建验证任务期间发生异常: {str(e)}", exc_info=True)
@@ -141,28 +197,42 @@ def create_validation_task_route(user_id): # <--- 接收 user_id 参数
 
 @validate_bp.route('/tasks', methods=['GET'])
 @login_required
-def get_validation_tasks_list_route(user_id): # <--- 接收 user_id 参数
+def get_validation_tasks_list_route():
+    user_id = g.user_id
+    now = time.monotonic()
+    entry = _LIST_CACHE.get(user_id)
+    if entry is not None and now - entry[0] < _LIST_TTL:
+        return bytes_response(entry[1], 200)
+
     validate_service = current_app.validate_service
     tasks = validate_service.get_user_tasks(user_id) # <--- 传递 user_id
-    return jsonify(tasks), 200
+    body = json_utils.dumps_bytes(tasks)
+    with _LIST_CACHE_LOCK:
+        _LIST_CACHE[user_id] = (now, body)
+    return bytes_response(body, 200)
 
 
 @validate_bp.route('/tasks/<task_id>', methods=['GET'])
 @login_required
-def get_validation_task_details_route(user_id, task_id): # <--- 接收 user_id 参数
+def get_validation_task_details_route(task_id):
+    user_id = g.user_id
     validate_service = current_app.validate_service
-    task_details = validate_service.get_task_details(user_id, task_id) # <--- 传递 user_id
+    # 可选的 ?fields=status,progress 只返回指定字段，轮询时不必解码完整的 results_json
+    fields_param = request.args.get('fields')
+    fields = frozenset(f.strip() for f in fields_param.split(',') if f.strip()) if fields_param else None
+    task_details = validate_service.get_task_details(user_id, task_id, fields=fields) # <--- 传递 user_id
     if task_details:
         if task_details.get("error"): # 服务层通常不返回 error key，而是 None
-             return jsonify(task_details), 404 # 假设 error 表示未找到
-        return jsonify(task_details), 200
+             return json_response(task_details, 404) # 假设 error 表示未找到
+        return json_response(task_details, 200)
     else:
         return jsonify({"error": "验证任务未找到或访问被拒绝"}), 404
 
 
 @validate_bp.route('/tasks/<task_id>/logs', methods=['GET'])
 @login_required
-def get_validation_task_logs_route(user_id, task_id): # <--- 接收 user_id 参数
+def get_validation_task_logs_route(task_id):
+    user_id = g.user_id
     tail_str = request.args.get('tail', None)
     tail_lines = None
     if tail_str:
@@ -188,7 +258,8 @@ def get_validation_task_logs_route(user_id, task_id): # <--- 接收 user_id 参
 
 @validate_bp.route('/tasks/<task_id>/output', methods=['GET'])
 @login_required
-def download_validation_task_output_route(user_id, task_id): # <--- 接收 user_id 参数
+def download_validation_task_output_route(task_id):
+    user_id = g.user_id
     validate_service = current_app.validate_service
     archive_path, error_msg = validate_service.get_task_output_archive_path(user_id, task_id) # <--- 传递 user_id
 
@@ -196,29 +267,28 @@ def download_validation_task_output_route(user_id, task_id): # <--- 接收 user_
         status_code = 404 if "未找到" in error_msg or "尚不可用" in error_msg else 500
         return jsonify({"error": error_msg}), status_code
 
-    if archive_path and os.path.exists(archive_path):
-        try:
-            return send_file(
-                archive_path,
-                as_attachment=True,
-                download_name=os.path.basename(archive_path),
-                mimetype='application/zip'
-            )
-        except Exception as e:
-            current_app.logger.error(f"为用户ID '{user_id}' 的验证任务 '{task_id}' 发送输出归档 {archive_path} 时出错: {e}")
-            return jsonify({"error": "无法发送验证归档文件。"}), 500
-    else:
+    # 一次 os.stat 同时确认文件存在并取得 mtime，不再单独 os.path.exists
+    try:
+        archive_stat = os.stat(archive_path)
+    except (TypeError, OSError):
         return jsonify({"error": "验证输出归档未找到或无法创建。"}), 404
+    try:
+        return send_archive(archive_path, stat_result=archive_stat)
+    except Exception as e:
+        current_app.logger.error(f"为用户ID '{user_id}' 的验证任务 '{task_id}' 发送输出归档 {archive_path} 时出错: {e}")
+        return jsonify({"error": "无法发送验证归档文件。"}), 500
 
 
 @validate_bp.route('/tasks/<task_id>/cancel', methods=['POST'])
 @login_required
-def cancel_validation_task_route(user_id, task_id):
+def cancel_validation_task_route(task_id):
+    user_id = g.user_id
     validate_service = current_app.validate_service
     current_app.logger.info(f"用户ID '{user_id}' 正在尝试取消验证任务 '{task_id}'。")
     try:
         success, message = validate_service.cancel_validate_task(user_id, task_id) # <--- 传递 user_id
         if success:
+            _invalidate_task_list_cache(user_id)
             current_app.logger.info(f"用户ID '{user_id}' 的验证任务 '{task_id}' 取消请求已处理。")
             return jsonify({"message": message, "task_id": task_id}), 200
         else:
@@ -236,12 +306,14 @@ def cancel_validation_task_route(user_id, task_id):
 
 @validate_bp.route('/tasks/<task_id>/delete', methods=['DELETE'])
 @login_required
-def delete_validation_task_route(user_id, task_id): # <--- 接收 user_id 参数
+def delete_validation_task_route(task_id):
+    user_id = g.user_id
     validate_service = current_app.validate_service
     current_app.logger.info(f"用户ID '{user_id}' 正在尝试删除验证任务 '{task_id}'。")
     try:
         success, message = validate_service.delete_validate_task(user_id, task_id) # <--- 传递 user_id
         if success:
+            _invalidate_task_list_cache(user_id)
             current_app.logger.info(f"用户ID '{user_id}' 的验证任务 '{task_id}' 已成功删除。")
             return jsonify({"message": message, "task_id": task_id}), 200
         else:
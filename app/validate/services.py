@@ -1,32 +1,116 @@
 # app/validate/services.py
 import os
+import functools
 import uuid
-import json
-import shutil
 import zipfile
+from types import SimpleNamespace
 import yaml  # PyYAML
+from sqlalchemy import case, func
+from sqlalchemy.orm import defer
 from werkzeug.utils import secure_filename
 from flask import current_app
 
 from ..models import ValidateTask, User, FinetuneTask  # 如果需要引用，则导入 FinetuneTask
+from ..config import PROJECT_ROOT
 from ..database import db
+from ..utils.cancel_flags import set_cancel_flag
+from ..utils.archives import fast_extractall, write_dir_to_zip
+from ..utils.fileops import parallel_rmtree, write_file_bytes
+from ..utils.logfiles import tail_lines as tail_log_lines, read_tail_bytes
+
+# PyYAML 编译了 libyaml 时使用 C 实现的解析/输出器，否则回退到纯 Python 实现
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
 
 # 假设这些全局变量已定义或在此处的辅助函数需要时导入
-ALLOWED_EXTENSIONS_MODEL = {'pt', '.onnx'}  # .onnx 也可能对验证有效
-ALLOWED_EXTENSIONS_DATASET = {'zip'}
-ALLOWED_EXTENSIONS_YAML = {'yaml', 'yml'}
+# 扩展名统一为不带点的小写形式 (frozenset 可哈希，allowed_file 可以直接缓存)
+ALLOWED_EXTENSIONS_MODEL = frozenset({'pt', 'onnx'})  # onnx 也可能对验证有效
+ALLOWED_EXTENSIONS_DATASET = frozenset({'zip'})
+ALLOWED_EXTENSIONS_YAML = frozenset({'yaml', 'yml'})
+# 创建任务时只解析用户 YAML 的前这么多字节做快速校验，完整解析留给 Celery 任务
+YAML_HEADER_CHECK_BYTES = 8192
+# FileStorage.save 默认按 16 KB 复制，数据集 ZIP 可能有数 GB
+UPLOAD_SAVE_BUFFER_SIZE = 1024 * 1024  # 1 MiB
 
 
+@functools.lru_cache(maxsize=256)
 def allowed_file(filename, allowed_extensions):
     """
     检查文件扩展名是否在允许的扩展名集合中。
 
     :param filename: 文件名。
-    :param allowed_extensions: 允许的扩展名集合。
+    :param allowed_extensions: 允许的扩展名集合 (frozenset)。
     :return: 如果文件扩展名被允许，则返回 True，否则返回 False。
     """
-    return '.' in filename and \
-        filename.rsplit('.', 1)[1].lower() in allowed_extensions
+    _, dot, ext = filename.rpartition('.')
+    return bool(dot) and ext.lower() in allowed_extensions
+
+
+def _quick_validate_yaml_header(content):
+    """
+    只解析用户 YAML 的开头部分做快速校验，返回 (是否通过, 错误信息)。
+    文件比 YAML_HEADER_CHECK_BYTES 大、且开头部分解析失败或尚未出现 'val'/'test' 时
+    (可能只是被截断)，再回退到完整解析。
+    """
+    truncated = len(content) > YAML_HEADER_CHECK_BYTES
+    if truncated:
+        # 截到最后一个完整行，避免把多字节字符或标量切成两半
+        head = content[:YAML_HEADER_CHECK_BYTES]
+        head = head[:head.rfind(b'\n') + 1] or head
+    else:
+        head = content
+    try:
+        data = yaml.load(head, Loader=SafeLoader)
+    except yaml.YAMLError as e:
+        if not truncated:
+            return False, f"验证数据集YAML文件无效: {str(e)}"
+        data = None
+    if isinstance(data, dict) and ('val' in data or 'test' in data):
+        return True, ""
+    if truncated:
+        try:
+            data = yaml.load(content, Loader=SafeLoader)
+        except yaml.YAMLError as e:
+            return False, f"验证数据集YAML文件无效: {str(e)}"
+    if not isinstance(data, dict):
+        return False, "用户上传的验证数据集配置文件格式无效（不是字典）。"
+    if 'val' not in data and 'test' not in data:
+        return False, "验证数据集配置文件无效: 缺少 'val' 或 'test' 字段。"
+    return True, ""
+
+
+@functools.lru_cache(maxsize=1024)
+def _val_task_base_dir(user_model_base_dir, user_id, task_id):
+    # 轮询详情/日志/下载都要算一遍任务目录，缓存 secure_filename 与 join 的结果
+    return os.path.join(user_model_base_dir, secure_filename(str(user_id)), 'val', secure_filename(str(task_id)))
+
+
+def _missing_dataset_paths(config, zip_names):
+    """
+    返回 config 的 val/test 中引用、但 ZIP 里不存在的相对路径。
+    'path' 会被改写为解压目录，因此相对路径都以 ZIP 根目录为基准；绝对路径无法核对，跳过。
+    """
+    names = set()
+    for name in zip_names:
+        name = name.rstrip('/')
+        names.add(name)
+        # 有些 ZIP 不含目录条目，补上所有上级目录
+        while '/' in name:
+            name = name.rsplit('/', 1)[0]
+            names.add(name)
+
+    missing = []
+    for key in ('val', 'test'):
+        value = config.get(key)
+        for rel in (value if isinstance(value, list) else [value]):
+            if not isinstance(rel, str) or not rel or os.path.isabs(rel):
+                continue
+            normalized = rel.replace('\\', '/').strip('/')
+            while normalized.startswith('./'):
+                normalized = normalized[2:]
+            if normalized and normalized != '.' and normalized not in names:
+                missing.append(rel)
+    return missing
 
 
 class ValidateService:
@@ -41,8 +125,11 @@ class ValidateService:
         self.app = app
         self.user_model_base_dir = app.config.get('USER_MODEL_BASE_DIR', 'user_models')
         if not os.path.isabs(self.user_model_base_dir):
-            # 假设 app.root_path 是 'app' 目录的父目录（项目根目录）
-            self.user_model_base_dir = os.path.join(app.root_path, '..', self.user_model_base_dir)
+            self.user_model_base_dir = os.path.join(PROJECT_ROOT, self.user_model_base_dir)
+        # 解压数据集的并行线程数；数据集放在机械硬盘上时可通过 VAL_EXTRACT_WORKERS 调小
+        self.extract_workers = app.config.get('VAL_EXTRACT_WORKERS') or min(16, os.cpu_count() or 1)
+        # 为 True 时在解压完成后统一调用一次 os.sync()，而不是逐个文件刷盘
+        self.extract_sync = bool(app.config.get('VAL_EXTRACT_SYNC', False))
 
         # 确保基础目录存在（FinetuneService 中已处理，但此处亦是良好实践）
         if not os.path.exists(self.user_model_base_dir):
@@ -59,9 +146,7 @@ class ValidateService:
         """获取特定用户特定验证任务的基础存储目录。
         目录结构: USER_MODEL_BASE_DIR / str(user_id) / val / task_id /
         """
-        safe_user_id_str = secure_filename(str(user_id))
-        safe_task_id = secure_filename(str(task_id))
-        return os.path.join(self.user_model_base_dir, safe_user_id_str, 'val', safe_task_id)
+        return _val_task_base_dir(self.user_model_base_dir, user_id, task_id)
 
     def _get_val_task_input_dir(self, user_val_task_base_dir):
         """获取验证任务的输入目录路径。"""
@@ -79,45 +164,50 @@ class ValidateService:
         """获取验证任务输出目录下的日志子目录路径。"""
         return os.path.join(val_task_output_dir, 'logs')
 
+    def _task_paths(self, user_id, task_id):
+        """一次算出验证任务的全部目录 (base/input/dataset/output/logs)，secure_filename 只调用一次。"""
+        base = self._get_user_val_task_base_dir(user_id, task_id)
+        output = os.path.join(base, 'output')
+        return SimpleNamespace(
+            base=base,
+            input=os.path.join(base, 'input'),
+            dataset=os.path.join(base, 'dataset'),
+            output=output,
+            logs=os.path.join(output, 'logs'),
+        )
+
     def _cleanup_val_task_dirs_on_error(self, user_val_task_base_dir):
         """当验证任务发生错误时，清理相关的任务目录。"""
         if os.path.exists(user_val_task_base_dir):
             try:
-                shutil.rmtree(user_val_task_base_dir)
+                parallel_rmtree(user_val_task_base_dir)
                 self.app.logger.info(f"验证任务错误发生，已清理任务目录: {user_val_task_base_dir}")
             except OSError as e:
                 self.app.logger.error(f"清理验证任务目录 {user_val_task_base_dir} 时出错: {e}")
 
     def _prepare_uploaded_dataset_for_validation(self, task_id, user_id,
                                                  val_task_input_dir, val_task_dataset_dir,
-                                                 original_dataset_zip_filename, original_dataset_yaml_filename):
+                                                 original_dataset_zip_filename, original_dataset_yaml_filename,
+                                                 user_config_data=None):
         """
         解压上传的数据集并生成供验证使用的 data.yaml。
         此方法类似于 FinetuneService._prepare_dataset_and_config。
+        user_config_data 是创建任务时已解析好的用户 YAML，传入时不再从磁盘重新读取解析。
 
         :return: (生成的配置文件名, 错误信息)
         """
         self.app.logger.info(f"验证任务 {task_id} (用户 {user_id}): 开始准备上传的数据集和配置文件。")
 
-        dataset_zip_path = os.path.join(val_task_input_dir, original_dataset_zip_filename)
-        try:
-            with zipfile.ZipFile(dataset_zip_path, 'r') as zip_ref:
-                zip_ref.extractall(val_task_dataset_dir)
-            self.app.logger.info(
-                f"验证任务 {task_id}: 数据集 '{original_dataset_zip_filename}' 已成功解压到 '{val_task_dataset_dir}'。")
-        except Exception as e:
-            self.app.logger.error(f"验证任务 {task_id}: 解压数据集 '{dataset_zip_path}' 失败: {e}", exc_info=True)
-            return None, f"解压验证数据集失败: {str(e)}"
-
-        user_yaml_path = os.path.join(val_task_input_dir, original_dataset_yaml_filename)
-        try:
-            with open(user_yaml_path, 'r', encoding='utf-8') as f:
-                user_config_data = yaml.safe_load(f)
-            if not isinstance(user_config_data, dict):
-                return None, "用户上传的验证数据集配置文件格式无效（不是字典）。"
-        except Exception as e:
-            self.app.logger.error(f"验证任务 {task_id}: 读取用户 YAML '{user_yaml_path}' 失败: {e}", exc_info=True)
-            return None, f"读取用户上传的验证数据集配置文件失败: {str(e)}"
+        if user_config_data is None:
+            user_yaml_path = os.path.join(val_task_input_dir, original_dataset_yaml_filename)
+            try:
+                with open(user_yaml_path, 'r', encoding='utf-8') as f:
+                    user_config_data = yaml.load(f, Loader=SafeLoader)
+                if not isinstance(user_config_data, dict):
+                    return None, "用户上传的验证数据集配置文件格式无效（不是字典）。"
+            except Exception as e:
+                self.app.logger.error(f"验证任务 {task_id}: 读取用户 YAML '{user_yaml_path}' 失败: {e}", exc_info=True)
+                return None, f"读取用户上传的验证数据集配置文件失败: {str(e)}"
 
         val_config_data = user_config_data.copy()
         # 关键: 修改路径以指向解压后的 val_task_dataset_dir
@@ -133,11 +223,30 @@ class ValidateService:
             self.app.logger.warning(f"验证任务 {task_id}: 用户配置中缺少 'names' 字段。")
             # 可以考虑使其可选: return None, "验证数据集配置文件缺少 'names' 字段。"
 
+        # 解压前先用 ZIP 的中央目录核对 val/test 指向的路径是否存在 (只读目录，不读文件内容)，
+        # 不匹配时直接报错，省去一次完整解压
+        dataset_zip_path = os.path.join(val_task_input_dir, original_dataset_zip_filename)
+        try:
+            with zipfile.ZipFile(dataset_zip_path, 'r') as zip_ref:
+                missing = _missing_dataset_paths(val_config_data, zip_ref.namelist())
+                if missing:
+                    self.app.logger.warning(f"验证任务 {task_id}: 数据集 ZIP 中缺少配置引用的路径: {missing}")
+                    return None, f"验证数据集ZIP中缺少配置文件引用的路径: {', '.join(missing)}"
+                fast_extractall(zip_ref, val_task_dataset_dir, workers=self.extract_workers,
+                                sync=self.extract_sync)
+            self.app.logger.info(
+                f"验证任务 {task_id}: 数据集 '{original_dataset_zip_filename}' 已成功解压到 '{val_task_dataset_dir}'。")
+        except Exception as e:
+            self.app.logger.error(f"验证任务 {task_id}: 解压数据集 '{dataset_zip_path}' 失败: {e}", exc_info=True)
+            return None, f"解压验证数据集失败: {str(e)}"
+
         generated_yaml_name = "data_for_validation.yaml"
         generated_yaml_path = os.path.join(val_task_input_dir, generated_yaml_name)
         try:
-            with open(generated_yaml_path, 'w', encoding='utf-8') as f:
-                yaml.dump(val_config_data, f, sort_keys=False, default_flow_style=False)
+            # 先整体输出为字节串再一次写入，而不是由 Dumper 对文件做许多次小 write
+            yaml_out = yaml.dump(val_config_data, Dumper=SafeDumper, sort_keys=False,
+                                 default_flow_style=False, allow_unicode=True, encoding='utf-8')
+            write_file_bytes(generated_yaml_path, yaml_out)
             self.app.logger.info(
                 f"验证任务 {task_id}: 已生成验证配置文件 '{generated_yaml_name}' 到 '{generated_yaml_path}'。")
         except Exception as e:
@@ -146,10 +255,59 @@ class ValidateService:
             return None, f"保存生成的验证配置文件失败: {str(e)}"
         return generated_yaml_name, None
 
+    def _stage_dataset_config(self, task_id, src_yaml_path, dst_yaml_path):
+        """
+        把已有的数据集配置 (微调任务生成的或预设的 data.yaml) 放到验证任务目录下。
+        Ultralytics 对没有 'path' 的配置以 YAML 所在目录为数据集根目录，复制后该目录就变了，
+        因此把根目录写成绝对路径，并把 train/val/test 中的相对路径展开；
+        同时核对 val/test 指向的路径是否存在，不存在时在加载模型之前就报错。
+
+        :return: (是否成功, 错误信息)
+        """
+        try:
+            with open(src_yaml_path, 'rb') as f:
+                config = yaml.load(f, Loader=SafeLoader)
+        except Exception as e:
+            self.app.logger.error(f"验证任务 {task_id}: 读取数据集配置 '{src_yaml_path}' 失败: {e}", exc_info=True)
+            return False, f"读取数据集配置文件失败: {str(e)}"
+        if not isinstance(config, dict):
+            return False, "数据集配置文件格式无效（不是字典）。"
+        if 'val' not in config and 'test' not in config:
+            return False, "数据集配置文件缺少 'val' 或 'test' 字段。"
+
+        base = config.get('path')
+        if not base:
+            base = os.path.dirname(os.path.abspath(src_yaml_path))
+            config['path'] = base
+        # 相对的 'path' 由 Ultralytics 按其 DATASETS_DIR 解析，与 YAML 位置无关，保持原样
+        if os.path.isabs(base):
+            missing = []
+            for key in ('train', 'val', 'test'):
+                value = config.get(key)
+                if value is None:
+                    continue
+                paths = [p if not isinstance(p, str) or os.path.isabs(p) else os.path.join(base, p)
+                         for p in (value if isinstance(value, list) else [value])]
+                config[key] = paths if isinstance(value, list) else paths[0]
+                if key != 'train':
+                    missing.extend(p for p in paths if isinstance(p, str) and not os.path.exists(p))
+            if missing:
+                self.app.logger.warning(f"验证任务 {task_id}: 数据集配置引用的路径不存在: {missing}")
+                return False, f"数据集配置文件引用的路径不存在: {', '.join(missing)}"
+
+        try:
+            yaml_out = yaml.dump(config, Dumper=SafeDumper, sort_keys=False,
+                                 default_flow_style=False, allow_unicode=True, encoding='utf-8')
+            write_file_bytes(dst_yaml_path, yaml_out)
+        except Exception as e:
+            self.app.logger.error(f"验证任务 {task_id}: 写入数据集配置 '{dst_yaml_path}' 失败: {e}", exc_info=True)
+            return False, f"保存验证数据集配置文件失败: {str(e)}"
+        return True, ""
+
     def create_validate_task(self, user_id, task_name,
                              model_identifier, model_file_storage_if_upload,
                              dataset_identifier, dataset_zip_file_storage_if_upload,
-                             dataset_yaml_content_if_upload,
+                             dataset_yaml_file_storage_if_upload,
                              validation_params):
         """
         创建新的验证任务，处理文件存储，并将任务提交到 Celery 队列。
@@ -162,14 +320,23 @@ class ValidateService:
             self.app.logger.error(f"创建验证任务时未找到ID为 '{user_id}' 的用户。")
             return None, "用户未找到。"
 
+        # 上传的 YAML 在保存任何文件之前先做快速校验，格式错误的请求不会写盘
+        yaml_bytes = None
+        if dataset_identifier == "upload" and dataset_yaml_file_storage_if_upload:
+            yaml_bytes = dataset_yaml_file_storage_if_upload.read()
+            yaml_ok, yaml_error = _quick_validate_yaml_header(yaml_bytes)
+            if not yaml_ok:
+                return None, yaml_error
+
         task_id = str(uuid.uuid4())
         self.app.logger.info(f"为用户ID '{user_id}' (用户名: {user.username}) 生成验证任务 task_id: {task_id}")
 
-        user_val_task_base_dir = self._get_user_val_task_base_dir(user_id, task_id)
-        val_task_input_dir = self._get_val_task_input_dir(user_val_task_base_dir)
-        # val_task_dataset_dir 会在需要时由 Celery 任务或 _prepare_uploaded_dataset_for_validation 创建
-        val_task_output_dir = self._get_val_task_output_dir(user_val_task_base_dir)
-        val_task_output_logs_dir = self._get_val_task_output_logs_dir(val_task_output_dir)
+        paths = self._task_paths(user_id, task_id)
+        user_val_task_base_dir = paths.base
+        val_task_input_dir = paths.input
+        # 数据集目录 paths.dataset 由 Celery 任务解压上传的数据集时创建
+        val_task_output_dir = paths.output
+        val_task_output_logs_dir = paths.logs
 
         try:
             os.makedirs(val_task_input_dir, exist_ok=True)
@@ -188,7 +355,6 @@ class ValidateService:
         db_input_model_name_val = None
         db_input_dataset_zip_name_val = None
         db_input_dataset_yaml_name_val = None
-        db_generated_config_yaml_name_val = None
 
         # --- 同步文件处理（仅限上传的情况） ---
         if model_file_storage_if_upload:  # 当模型来源类型为 'upload' 时
@@ -199,7 +365,7 @@ class ValidateService:
             db_input_model_name_val = model_filename
             model_save_path = os.path.join(val_task_input_dir, db_input_model_name_val)
             try:
-                model_file_storage_if_upload.save(model_save_path)
+                model_file_storage_if_upload.save(model_save_path, buffer_size=UPLOAD_SAVE_BUFFER_SIZE)
                 self.app.logger.info(f"验证任务 {task_id}: 已保存上传的模型 '{db_input_model_name_val}'。")
             except Exception as e:  # pragma: no cover
                 self.app.logger.error(f"验证任务 {task_id}: 保存上传模型失败: {e}")
@@ -207,18 +373,16 @@ class ValidateService:
                 return None, "保存待验证模型文件失败。"
 
         if dataset_identifier == "upload":
-            if not dataset_zip_file_storage_if_upload or not dataset_yaml_content_if_upload:
+            if not dataset_zip_file_storage_if_upload or not dataset_yaml_file_storage_if_upload:
                 self._cleanup_val_task_dirs_on_error(user_val_task_base_dir)
                 return None, "选择上传数据集但缺少ZIP或YAML文件。"
 
-            val_task_dataset_dir = self._get_val_task_dataset_dir(user_val_task_base_dir)  # 现在创建该目录
-            os.makedirs(val_task_dataset_dir, exist_ok=True)
-
             db_dataset_zip_name_val = secure_filename(dataset_zip_file_storage_if_upload.filename)
             db_input_dataset_zip_name_val = db_dataset_zip_name_val
             dataset_zip_save_path = os.path.join(val_task_input_dir, db_input_dataset_zip_name_val)
             try:
-                dataset_zip_file_storage_if_upload.save(dataset_zip_save_path)
+                # 解压在 Celery 任务中进行，那时上传流早已关闭，因此 ZIP 仍需先落盘
+                dataset_zip_file_storage_if_upload.save(dataset_zip_save_path, buffer_size=UPLOAD_SAVE_BUFFER_SIZE)
             except Exception as e:  # pragma: no cover
                 self._cleanup_val_task_dirs_on_error(user_val_task_base_dir)
                 return None, f"保存验证数据集ZIP文件失败: {str(e)}"
@@ -226,23 +390,15 @@ class ValidateService:
             db_dataset_yaml_name_val = "user_config_val.yaml"
             db_input_dataset_yaml_name_val = db_dataset_yaml_name_val
             dataset_yaml_save_path = os.path.join(val_task_input_dir, db_input_dataset_yaml_name_val)
+            # 已在开头读入并校验过，原样写盘存档
             try:
-                with open(dataset_yaml_save_path, 'w', encoding='utf-8') as f:
-                    f.write(dataset_yaml_content_if_upload)
+                write_file_bytes(dataset_yaml_save_path, yaml_bytes)
             except Exception as e:  # pragma: no cover
                 self._cleanup_val_task_dirs_on_error(user_val_task_base_dir)
                 return None, f"保存验证数据集YAML文件失败: {str(e)}"
 
-            generated_yaml, prep_error = self._prepare_uploaded_dataset_for_validation(
-                task_id, user_id, val_task_input_dir, val_task_dataset_dir,
-                db_input_dataset_zip_name_val, db_input_dataset_yaml_name_val
-            )
-            if prep_error:
-                self._cleanup_val_task_dirs_on_error(user_val_task_base_dir)
-                return None, prep_error
-            db_generated_config_yaml_name_val = generated_yaml
-
-        # --- 创建数据库记录 ---
+        # --- 创建数据库记录 (queued)；上传数据集的解压与配置生成由 Celery 验证任务在开始时完成，
+        # 请求线程只落盘原始文件 ---
         new_task = ValidateTask(
             id=task_id, user_id=user.id,
             task_name=task_name if task_name else f"验证任务 {task_id[:8]}",
@@ -251,12 +407,12 @@ class ValidateService:
             dataset_identifier=db_dataset_identifier,
             dataset_zip_name_val=db_dataset_zip_name_val,
             dataset_yaml_name_val=db_dataset_yaml_name_val,
-            validation_params_json=json.dumps(validation_params) if validation_params else '{}',
+            validation_params_json=validation_params if validation_params else {},
             task_dir_name_val=task_id,
             input_model_name_val=db_input_model_name_val,
             input_dataset_zip_name_val=db_input_dataset_zip_name_val,
             input_dataset_yaml_name_val=db_input_dataset_yaml_name_val,
-            generated_config_yaml_name_val=db_generated_config_yaml_name_val
+            generated_config_yaml_name_val=None
         )
         try:
             db.session.add(new_task)
@@ -268,7 +424,8 @@ class ValidateService:
             self._cleanup_val_task_dirs_on_error(user_val_task_base_dir)
             return None, "服务器错误：无法将验证任务详情保存到数据库。"
 
-        # --- 发送任务到 Celery 队列 ---
+        # --- 发送任务到 Celery 队列 (send_task 只投递消息，不会阻塞请求)；在提交数据库记录之后同步发送，
+        # 不留下已提交却没有发送的 queued 任务 ---
         try:
             if current_app.celery:
                 celery_task_instance = current_app.celery.send_task(
@@ -278,22 +435,38 @@ class ValidateService:
                 self.app.logger.info(f"验证任务 {task_id} 已发送到 Celery 队列。Celery Task ID: {celery_task_instance.id}")
             else:  # pragma: no cover
                 self.app.logger.error(f"验证任务 {task_id} 创建成功，但 Celery 未初始化，无法发送到队列。")
-                # 考虑将任务状态更新为错误
-                new_task.status = 'failed'
-                new_task.error_message = "Celery服务未初始化，无法处理任务。"
-                db.session.commit()
+                self._mark_task_failed(new_task, "Celery服务未初始化，无法处理任务。")
                 return None, "任务创建成功但无法提交到处理队列：Celery服务不可用。"
         except Exception as e:  # pragma: no cover
             self.app.logger.error(f"发送验证任务 {task_id} 到 Celery 队列失败: {e}", exc_info=True)
-            new_task.status = 'failed'
-            new_task.error_message = f"发送到处理队列失败: {str(e)}"
-            db.session.commit()
+            self._mark_task_failed(new_task, f"发送到处理队列失败: {str(e)}")
             return None, f"任务创建成功但无法提交到处理队列: {str(e)}"
 
         message = f"验证任务 '{new_task.task_name}' (ID: {task_id}) 已创建并提交到处理队列。"
         return task_id, message
 
+    def _mark_task_failed(self, task, error_message):
+        task.status = 'failed'
+        task.error_message = error_message
+        try:
+            db.session.commit()
+        except Exception as e:  # pragma: no cover
+            db.session.rollback()
+            self.app.logger.error(f"验证任务 {task.id}: 标记为失败时数据库出错: {e}", exc_info=True)
+
     # --- GET, DELETE 等方法（类似于 FinetuneService，但针对 ValidateTask） ---
+    def list_user_tasks(self, user_id, status=None, limit=50, offset=0):
+        """按 (user_id, status, created_at) 索引查询用户的验证任务，limit 为 None 时不分页。"""
+        query = ValidateTask.query.filter_by(user_id=user_id)
+        if status:
+            query = query.filter_by(status=status)
+        query = query.order_by(ValidateTask.created_at.desc())
+        if offset:
+            query = query.offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
     def get_user_tasks(self, user_id):
         """
         获取指定用户的所有验证任务列表。
@@ -302,7 +475,7 @@ class ValidateService:
         user = User.query.get(user_id)
         if not user:
             return []
-        tasks = ValidateTask.query.filter_by(user_id=user.id).order_by(ValidateTask.created_at.desc()).all()
+        tasks = self.list_user_tasks(user.id, limit=None)
         return [{
             "task_id": task.id, "task_name": task.task_name, "status": task.status,
             "created_at": task.created_at.isoformat() if task.created_at else None,
@@ -310,16 +483,24 @@ class ValidateService:
             "dataset_identifier": task.dataset_identifier
         } for task in tasks]
 
-    def get_task_details(self, user_id, task_id):
-        """获取特定验证任务的详细信息。"""
-        task = ValidateTask.query.filter_by(id=task_id, user_id=user_id).first()
+    def get_task_details(self, user_id, task_id, fields=None):
+        """
+        获取特定验证任务的详细信息。
+        fields 为需要返回的字段名集合 (task_id、status 及 sub_status 总会返回)；前端轮询只要 status/progress 时，
+        不请求 results_json 就不会从数据库加载和解码这一可能很大的 JSON 列。
+        """
+        query = ValidateTask.query.filter_by(id=task_id, user_id=user_id)
+        want_results = fields is None or 'results_json' in fields
+        if not want_results:
+            query = query.options(defer(ValidateTask.results_json))
+        task = query.first()
         if not task:
             self.app.logger.warning(f"未找到用户ID '{user_id}' 的验证任务 '{task_id}'。")
             return None
 
         # 从 results_json 中提取可能的进度或速度信息（如果验证过程中有更新的话）
         # 或者，如果为 ValidateTask 模型添加了专门的进度字段，则从那里读取
-        results = json.loads(task.results_json) if task.results_json else {}
+        results = dict(task.results_json) if want_results and task.results_json else {}
 
         details = {
             "task_id": task.id,
@@ -333,7 +514,7 @@ class ValidateService:
             "dataset_identifier": task.dataset_identifier,
             "dataset_zip_name_val": task.dataset_zip_name_val,
             "dataset_yaml_name_val": task.dataset_yaml_name_val,
-            "validation_params": json.loads(task.validation_params_json) if task.validation_params_json else {},
+            "validation_params": dict(task.validation_params_json) if task.validation_params_json else {},
             "task_dir_name_val": task.task_dir_name_val,
             "input_model_name_val": task.input_model_name_val,
             "input_dataset_zip_name_val": task.input_dataset_zip_name_val,
@@ -365,6 +546,11 @@ class ValidateService:
             elif progress_text is None and current_prog is not None:
                 progress_text = f"已处理 {current_prog}"
 
+            # 上传的数据集还没有生成验证配置，说明 Celery 任务仍在解压/准备数据集
+            if task.dataset_identifier == "upload" and not task.generated_config_yaml_name_val:
+                details["sub_status"] = "preparing"
+                progress_text = progress_text or "正在准备数据集..."
+
             progress_info = {
                 "current_progress": current_prog,
                 "total_progress": total_prog,
@@ -373,24 +559,17 @@ class ValidateService:
             }
             details["progress"] = progress_info
 
-        elif task.status == 'queued':
-            all_queued_tasks_of_type = ValidateTask.query.filter(
-                ValidateTask.status == 'queued'
-            ).order_by(ValidateTask.created_at.asc()).all()
+        elif task.status == 'queued' and task.created_at is not None:
+            # 在数据库中聚合: 一次查询同时得到排队总数和排在本任务之前的数量，
+            # 走 (status, created_at) 索引，不再取回全部排队任务逐行比较
+            total_queued_globally, ahead = db.session.query(
+                func.count(ValidateTask.id),
+                func.count(case((ValidateTask.created_at < task.created_at, ValidateTask.id)))
+            ).filter(ValidateTask.status == 'queued').one()
 
-            total_queued_globally = len(all_queued_tasks_of_type)
-            current_task_global_position = 0
-            found_in_global_queue = False
-
-            for i, queued_task_global in enumerate(all_queued_tasks_of_type):
-                if queued_task_global.id == task_id:
-                    current_task_global_position = i + 1
-                    found_in_global_queue = True
-                    break
-
-            if found_in_global_queue:
+            if total_queued_globally:
                 details["queue_position"] = {
-                    "position": current_task_global_position,
+                    "position": ahead + 1,
                     "total": total_queued_globally
                 }
 
@@ -398,6 +577,9 @@ class ValidateService:
         # 前端主要依赖 status 和 error_message/error_code 或固定的完成/取消信息。
         # results_json 字段在 'completed' 状态下包含了所有详细的验证指标。
 
+        if fields is not None:
+            return {key: value for key, value in details.items()
+                    if key in fields or key in ('task_id', 'status', 'sub_status')}
         return details
 
     def get_task_log_path(self, user_id, task_id, ensure_exists=False):
@@ -416,9 +598,7 @@ class ValidateService:
         if not task.log_file_name_val:
             return None, f"验证任务 {task_id} 的日志配置不完整。"
 
-        user_val_task_base_dir = self._get_user_val_task_base_dir(user_id, task_id)
-        val_task_output_dir = self._get_val_task_output_dir(user_val_task_base_dir)
-        val_task_output_logs_dir = self._get_val_task_output_logs_dir(val_task_output_dir)
+        val_task_output_logs_dir = self._task_paths(user_id, task_id).logs
         # 使用带有 _val 后缀的数据库字段
         log_file_path = os.path.join(val_task_output_logs_dir, task.log_file_name_val)
 
@@ -440,13 +620,14 @@ class ValidateService:
         log_file_path, error = self.get_task_log_path(user_id, task_id)  # 使用已重命名的辅助函数
         if error:
             return "", error
-        if not log_file_path or not os.path.exists(log_file_path) or not os.path.isfile(log_file_path):
+        # isfile 对不存在的路径也返回 False，一次 stat 即可
+        if not log_file_path or not os.path.isfile(log_file_path):
             return "", f"验证任务 {task_id} 的日志文件未找到或尚未创建。"
         try:
-            with open(log_file_path, 'r', encoding='utf-8') as f:
-                if tail_lines and isinstance(tail_lines, int) and tail_lines > 0:
-                    return "".join(f.readlines()[-tail_lines:]), None
-                return f.read(), None
+            # 只从文件末尾读取需要的部分，不把整个日志读入内存
+            if tail_lines and isinstance(tail_lines, int) and tail_lines > 0:
+                return tail_log_lines(log_file_path, tail_lines), None
+            return read_tail_bytes(log_file_path), None
         except Exception as e:
             return "", f"读取验证日志文件错误：{str(e)}"
 
@@ -461,24 +642,22 @@ class ValidateService:
         if task.status != 'completed':
             return None, "验证任务输出尚不可用（任务未完成）。"
 
-        user_val_task_base_dir = self._get_user_val_task_base_dir(user_id, task_id)
-        val_task_output_dir = self._get_val_task_output_dir(user_val_task_base_dir)
+        val_task_output_dir = self._task_paths(user_id, task_id).output
 
         # 对于验证，输出可能更简单：一个 results.json、图表和可能的日志文件。
         # Ultralytics 验证模式会将图表和 results.json 保存在 'runs/val/exp*' 目录中。
         # 我们需要找到这个目录。
 
         # 在输出中搜索最新的 'exp*'、'val*' 或 'run*' 目录
-        run_dirs = [d for d in os.listdir(val_task_output_dir) if
-                    os.path.isdir(os.path.join(val_task_output_dir, d)) and
-                    (d.startswith('exp') or d.startswith('val') or d.startswith('run'))]
-        # YOLO 验证模式可能使用 'val' 或 'exp' 作为目录名
+        # YOLO 验证模式可能使用 'val' 或 'exp' 作为目录名；
+        # scandir 一次遍历即可得到目录项类型，DirEntry.stat() 的结果也会被缓存
+        with os.scandir(val_task_output_dir) as it:
+            run_dirs = [e for e in it if e.is_dir() and e.name.startswith(('exp', 'val', 'run'))]
 
         if not run_dirs:
             return None, "未找到验证任务的输出运行目录。"
 
-        run_dirs.sort(key=lambda x: os.path.getmtime(os.path.join(val_task_output_dir, x)), reverse=True)
-        latest_run_dir_path = os.path.join(val_task_output_dir, run_dirs[0])
+        latest_run_dir_path = max(run_dirs, key=lambda e: e.stat().st_mtime).path
 
         # 需要归档的项目是此最新运行目录的内容
         # 例如：results.json, confusion_matrix.png, PR_curve.png 等。
@@ -491,12 +670,8 @@ class ValidateService:
 
         try:
             with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-                for root, _, files in os.walk(latest_run_dir_path):
-                    for file_item in files:
-                        file_path = os.path.join(root, file_item)
-                        # 将文件添加到 zip 包，并保持其在 run_dir 中的相对结构
-                        arcname = os.path.relpath(file_path, latest_run_dir_path)
-                        zf.write(file_path, arcname)
+                # 保持文件在 run_dir 中的相对结构；图表 PNG 直接存储，results.json 等用低压缩级别
+                write_dir_to_zip(zf, latest_run_dir_path, workers=self.extract_workers)
             self.app.logger.info(f"已为验证任务 {task_id} 创建输出归档 {archive_path} 从目录 {latest_run_dir_path}")
             return archive_path, None
         except Exception as e:
@@ -523,6 +698,9 @@ class ValidateService:
                 f"用户ID '{user_id}' 的验证任务 '{task_id}' 在数据库中标记为 '已取消' (原状态: {original_status})。")
 
             if original_status == 'running':
+                # Redis 标记让 worker 用一次 EXISTS 检查取消；信号文件保留，作为非 Redis 后端时的回退
+                if set_cancel_flag(current_app.celery, task_id):
+                    self.app.logger.info(f"已为验证任务 {task_id} 写入 Redis 取消标记。")
                 # 为正在运行的任务创建取消信号文件
                 user_val_task_base_dir = self._get_user_val_task_base_dir(user_id, task_id)
                 cancel_signal_path = os.path.join(user_val_task_base_dir, ".cancel_signal_val") # 使用不同名称以区分
@@ -553,7 +731,7 @@ class ValidateService:
             db.session.delete(task)
             if os.path.exists(user_val_task_base_dir):
                 try:
-                    shutil.rmtree(user_val_task_base_dir)
+                    parallel_rmtree(user_val_task_base_dir)
                 except OSError as e:
                     # 即使目录删除失败，也提交数据库记录的删除
                     db.session.commit()
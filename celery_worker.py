@@ -1,16 +1,28 @@
 # celery_worker.py
 import os
+import atexit
 import logging
-import json
-import shutil
+import queue
+import functools
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from contextlib import contextmanager
 
 from app import create_app
 from app.celery_utils import make_celery
-from app.config import Config
+from app.config import load_config, DEFAULT_CONFIG_PATH, PROJECT_ROOT
 from flask import current_app
+from celery.signals import worker_init
 from app.models import FinetuneTask, ValidateTask
-from app.database import db
-from sqlalchemy.orm import sessionmaker, Session as SQLAlchemySession
+from app.database import db, JSON_ENGINE_OPTIONS, sqlite_engine_options
+from app.utils.fileops import remove_if_exists, stage_file
+from app.utils.cancel_flags import is_cancel_flagged, clear_cancel_flag
+from sqlalchemy import create_engine, func, update
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import DBAPIError, InvalidRequestError
+from sqlalchemy.orm import load_only, sessionmaker, Session as SQLAlchemySession
 
 # --- 从 app.ultralyticsCust 导入相关函数和回调 ---
 from app.ultralyticsCust.callbacks import FinetuneProgressCallback
@@ -18,11 +30,10 @@ from app.ultralyticsCust.training import run_yolo_training
 from app.ultralyticsCust.validation import run_yolo_validation
 
 # --- 配置加载 ---
-base_dir = os.path.dirname(os.path.abspath(__file__))
-config_path = os.path.join(base_dir, 'config.yaml')
+config_path = DEFAULT_CONFIG_PATH
 
 try:
-    cfg = Config(config_path)
+    cfg = load_config(config_path)
     print(f"Celery Worker: 从 {config_path} 加载配置...")
 except FileNotFoundError:
     print(f"Celery Worker 错误: 配置文件 {config_path} 未找到！")
@@ -33,26 +44,230 @@ except Exception as e:
 
 # --- 创建临时的 Flask 应用实例 ---
 flask_app, _ = create_app(cfg)
-flask_app.app_context().push()
+# 不在模块级 push 应用上下文: make_celery 的 ContextTask 为每次任务调用单独进入/退出上下文，
+# 退出时 Flask-SQLAlchemy 会移除该上下文的 db.session，任务之间不共享会话
+
+# 主引擎的连接池参数来自 create_app 合并的 pool_engine_options (可由 SQLALCHEMY_ENGINE_OPTIONS 覆盖)，
+# 启动时记录一次，便于确认 worker 并发与连接池大小匹配
+with flask_app.app_context():
+    try:
+        flask_app.logger.info(f"Celery Worker: 数据库连接池 {type(db.engine.pool).__name__}: {db.engine.pool.status()}")
+    except Exception as e:  # pragma: no cover
+        flask_app.logger.warning(f"Celery Worker: 无法获取数据库连接池状态: {e}")
 
 # --- 创建 Celery 实例 ---
 celery_app = make_celery(flask_app)
 print(f"Celery Worker: Celery 应用已创建，Broker: {celery_app.conf.broker_url}")
 
 
+@worker_init.connect
+def _warn_on_green_thread_pool(sender=None, **kwargs):
+    """
+    训练在单独线程中运行，回调的写库/取消监视也依赖后台线程。eventlet/gevent 池下这些都是绿色线程，
+    CPU/GPU 密集的训练不会让出执行权，取消轮询和进度写入要等训练结束才会执行，因此要求使用 prefork 或 solo 池。
+    """
+    pool_cls = getattr(sender, 'pool_cls', None)
+    pool_name = getattr(pool_cls, '__module__', None) or str(pool_cls or '')
+    if 'eventlet' in pool_name or 'gevent' in pool_name:
+        flask_app.logger.warning(
+            f"Celery Worker: 当前使用 {pool_name} 池，训练期间无法及时响应取消请求或写入进度；"
+            f"请改用 -P prefork (默认) 或 -P solo 启动 worker。")
+
+
+# 任务准备阶段的文件复制 (模型权重、数据集配置) 提交到这个进程内共享的线程池，
+# 线程在任务之间复用，不随每个任务创建和销毁
+_io_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='stage-io')
+
+# 微调任务开始时加载的列 (主键总会加载)
+_FINETUNE_TASK_LOAD_COLUMNS = (
+    FinetuneTask.status,
+    FinetuneTask.training_params_json,
+    FinetuneTask.total_epochs,
+    FinetuneTask.input_base_model_name,
+    FinetuneTask.generated_config_yaml_name,
+    FinetuneTask.log_file_name,
+)
+
+# 训练结束后回调可能改写过、且任务随后会读取的列
+_POST_TRAIN_REFRESH_ATTRS = ('status', 'error_message', 'metrics_json')
+
+
 # --- 辅助函数：为回调创建新的数据库会话 ---
+# 回调写库专用引擎: 单连接 (pool_size=1, max_overflow=0)，保证本进程只有一个写入者，
+# 不与 Web/Celery 主引擎争用 SQLite 写锁；读取仍走主引擎
+_callback_write_engine = None
+# 会话工厂在首次使用时创建一次，之后每个回调事件只需实例化会话
+_WriteSessionLocal = None
+_ReadSessionLocal = None
+_session_lock = threading.Lock()
+
+
+def _get_callback_write_engine():
+    global _callback_write_engine
+    if _callback_write_engine is None:
+        url = db.engine.url
+        engine_options = dict(JSON_ENGINE_OPTIONS)
+        engine_options.update(sqlite_engine_options(str(url)))
+        _callback_write_engine = create_engine(url, poolclass=QueuePool, pool_size=1, max_overflow=0,
+                                               **engine_options)
+    return _callback_write_engine
+
+
+def _get_write_sessionmaker():
+    global _WriteSessionLocal
+    if _WriteSessionLocal is None:
+        with _session_lock:
+            if _WriteSessionLocal is None:
+                engine = _get_callback_write_engine()
+                if not engine:
+                    current_app.logger.error("DB engine not available for creating new session in callback.")
+                    raise RuntimeError("DB engine not available for creating new session for callback.")
+                # 回调只发出按主键的 UPDATE/SELECT，并自行用 session.begin() 划定事务边界
+                _WriteSessionLocal = sessionmaker(autoflush=False, expire_on_commit=False, bind=engine)
+    return _WriteSessionLocal
+
+
 def get_new_db_session_for_callback() -> SQLAlchemySession:
     """
-    为回调创建一个新的、独立的 SQLAlchemy 会话。
+    为回调创建一个新的、独立的 SQLAlchemy 写会话 (绑定单连接的写库引擎)。
+    """
+    return _get_write_sessionmaker()()
+
+
+def get_read_db_session_for_callback() -> SQLAlchemySession:
+    """
+    为回调的一次性读取创建会话，使用主引擎的连接池。
+    """
+    global _ReadSessionLocal
+    if _ReadSessionLocal is None:
+        with _session_lock:
+            if _ReadSessionLocal is None:
+                _ReadSessionLocal = sessionmaker(autoflush=False, expire_on_commit=False, bind=db.engine)
+    return _ReadSessionLocal()
+
+
+@contextmanager
+def callback_db_session():
+    """
+    回调一次性读取使用的会话上下文: 出错时回滚，退出时无论如何都关闭会话，连接归还连接池。
     """
-    engine = db.engine  # current_app.extensions['sqlalchemy'].engine
-    if not engine:
-        current_app.logger.error("DB engine not available for creating new session in callback.")
-        raise RuntimeError("DB engine not available for creating new session for callback.")
+    session = get_read_db_session_for_callback()
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+# 回调写库引擎由 db.engine 派生 (需要应用上下文)，启动时预先创建，
+# 回调的后台写库线程没有应用上下文也能直接获取会话
+with flask_app.app_context():
+    _get_write_sessionmaker()
+
 
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    session = SessionLocal()
-    return session
+# 本进程内正在执行的任务的取消事件 (按业务 task_id)。Web 进程通过 Redis 取消标记 (或信号文件) 跨进程通知，
+# worker 内部的轮询线程、训练回调和验证检查点只检查这个内存中的事件，置位后不再有任何系统调用
+_cancel_events = {}
+_cancel_events_lock = threading.Lock()
+
+
+def _register_cancel_event(task_id):
+    with _cancel_events_lock:
+        return _cancel_events.setdefault(task_id, threading.Event())
+
+
+def _release_cancel_event(task_id):
+    with _cancel_events_lock:
+        _cancel_events.pop(task_id, None)
+
+
+def _run_with_cancel_polling(fn, task_id, cancel_event, poll_interval, **kwargs):
+    """
+    在单独的线程中 (带应用上下文) 执行 fn(**kwargs) 并返回其结果。
+    当前线程每隔 poll_interval 秒检查一次 Redis 取消标记，发现后置位 cancel_event，
+    由训练回调在下一个批次停止训练；当前线程因异常 (如 Celery 软超时) 提前退出时同样置位。
+    """
+    def target():
+        with flask_app.app_context():
+            return fn(**kwargs)
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"train-{task_id[:8]}")
+    future = executor.submit(target)
+    cancel_sent = False
+    try:
+        while True:
+            try:
+                return future.result(timeout=poll_interval)
+            except FuturesTimeoutError:
+                if not cancel_sent and is_cancel_flagged(celery_app, task_id):
+                    current_app.logger.info(f"任务 {task_id}: 检测到 Redis 取消标记，通知训练回调停止训练。")
+                    cancel_event.set()
+                    cancel_sent = True
+    except BaseException:
+        cancel_event.set()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+
+
+# 训练回调日志的队列处理器 (每个进程一份): 回调线程只做一次入队，
+# 格式化以及 StreamHandler 的 write/flush 都在 QueueListener 的后台线程中完成
+_callback_log_handler = None
+_callback_log_pid = None
+_callback_log_lock = threading.Lock()
+
+
+def _get_callback_log_handler():
+    """
+    返回本进程共用的回调日志 QueueHandler，首次调用时启动对应的 QueueListener。
+    prefork 子进程不会继承父进程的监听线程，因此按 pid 判断是否需要在当前进程重新创建。
+    """
+    global _callback_log_handler, _callback_log_pid
+    with _callback_log_lock:
+        if _callback_log_pid != os.getpid():
+            stream_handler = logging.StreamHandler()
+            stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+            log_queue = queue.SimpleQueue()
+            listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            _callback_log_handler = QueueHandler(log_queue)
+            _callback_log_pid = os.getpid()
+        return _callback_log_handler
+
+
+# 失败时写入数据库的错误信息最大长度，避免把整段堆栈写进 UPDATE
+_ERROR_MESSAGE_MAX_LEN = 1024
+_MARK_FAILED_ATTEMPTS = 3
+
+
+def _mark_task_failed(model, task_id, error_message, keep_statuses=('completed', 'cancelled')):
+    """
+    用一条 UPDATE ... WHERE id=? 把任务标记为失败，不经过 ORM 的加载和刷新；
+    状态已是 keep_statuses 之一的任务不会被覆盖。数据库连接断开等 DBAPIError 时回滚并重试，
+    最多 _MARK_FAILED_ATTEMPTS 次 (指数退避)，仍失败时只记录日志，不掩盖原始异常。
+    """
+    stmt = update(model).where(model.id == task_id)
+    if keep_statuses:
+        stmt = stmt.where(model.status.notin_(keep_statuses))
+    stmt = stmt.values(status='failed', error_message=(error_message or '')[:_ERROR_MESSAGE_MAX_LEN],
+                       completed_at=func.now()).execution_options(synchronize_session=False)
+    for attempt in range(_MARK_FAILED_ATTEMPTS):
+        # 原始异常可能来自数据库，会话处于需要回滚的状态；回滚只丢弃本任务未提交的修改
+        db.session.rollback()
+        try:
+            db.session.execute(stmt)
+            db.session.commit()
+            return True
+        except DBAPIError as e:
+            if attempt + 1 == _MARK_FAILED_ATTEMPTS:
+                current_app.logger.error(f"任务 {task_id}: 写入失败状态时数据库出错，已放弃: {e}", exc_info=True)
+                db.session.rollback()
+                return False
+            time.sleep(0.1 * (2 ** attempt))
+    return False
 
 
 # --- 定义 Celery 任务 ---
@@ -66,149 +281,144 @@ def run_finetune_training_task(self, task_id: str, user_id: int):
 
     task_db_record = None
     user_task_base_dir = None  # 定义在try外部，确保finally中可用
+    cancel_signal_file = None
     try:
         # 1. 获取任务记录并初步检查
-        task_db_record = FinetuneTask.query.filter_by(id=task_id, user_id=user_id).first()
+        # 只取任务实际读取的列；metrics_json/batch_progress_json/error_message 等大字段不在此加载
+        task_db_record = FinetuneTask.query.options(load_only(*_FINETUNE_TASK_LOAD_COLUMNS)) \
+            .filter_by(id=task_id, user_id=user_id).first()
         if not task_db_record:
             current_app.logger.error(f"[CeleryTask:{self.request.id}] 任务 {task_id} 在数据库中未找到。")
             raise ValueError(f"任务 {task_id} 未找到。")
 
-        user_task_base_dir = current_app.finetune_service._get_user_task_base_dir(user_id, task_id)
+        finetune_service = current_app.finetune_service
+        user_task_base_dir = finetune_service._get_user_task_base_dir(user_id, task_id)
+        cancel_signal_file = os.path.join(user_task_base_dir, ".cancel_signal")
 
         # 检查任务是否在排队时已被取消
         if task_db_record.status == 'cancelled':
             current_app.logger.info(f"[CeleryTask:{self.request.id}] 任务 {task_id} 在开始执行前已被标记为取消。")
             # 清理可能的取消信号文件
-            cancel_signal_file = os.path.join(user_task_base_dir, ".cancel_signal")
-            if os.path.exists(cancel_signal_file):
-                try:
-                    os.remove(cancel_signal_file)
-                except OSError:
-                    pass
+            try:
+                remove_if_exists(cancel_signal_file)
+            except OSError:
+                pass
             return {"status": "cancelled", "message": "任务在开始执行前已被取消。"}
 
-        # 更新数据库中任务状态为 'running'
+        training_params_dict = {}
+        if task_db_record.training_params_json:
+            if not isinstance(task_db_record.training_params_json, dict):
+                current_app.logger.error(
+                    f"[CeleryTask:{self.request.id}] 任务 {task_id}: training_params_json 不是字典: '{task_db_record.training_params_json}'")
+                raise ValueError("解析训练参数失败: training_params_json 不是 JSON 对象")
+            training_params_dict = dict(task_db_record.training_params_json)
+        # 不是 YOLO.train() 的参数，取出后交给回调: 为 false 时批次进度只记录总损失，省去分项损失的设备同步
+        report_detailed_losses = bool(training_params_dict.pop('report_detailed_losses', True))
+
+        # 确保 epochs 参数存在并传递给回调用于初始化
+        initial_total_epochs = training_params_dict.get('epochs', 0)  # 默认0，回调会尝试从trainer获取
+        if task_db_record.total_epochs and task_db_record.total_epochs > 0:  # 如果数据库已有值
+            initial_total_epochs = task_db_record.total_epochs
+        elif initial_total_epochs > 0:
+            task_db_record.total_epochs = initial_total_epochs  # 与 running 状态一起提交
+
+        # 更新数据库中任务状态为 'running' (与 total_epochs 一次提交)
         task_db_record.status = 'running'
         task_db_record.started_at = db.func.now()
         db.session.commit()
         current_app.logger.info(f"[CeleryTask:{self.request.id}] 任务 {task_id} 状态更新为 'running'。")
 
         # 2. 准备训练所需路径和参数
-        task_input_dir = current_app.finetune_service._get_task_input_dir(user_task_base_dir)
+        # 每个路径只计算一次，后续日志与回调都复用这些局部变量
+        task_input_dir = finetune_service._get_task_input_dir(user_task_base_dir)
         base_model_path = os.path.join(task_input_dir, task_db_record.input_base_model_name)
         generated_yaml_path = os.path.join(task_input_dir, task_db_record.generated_config_yaml_name)
-        output_dir_project = current_app.finetune_service._get_task_output_dir(user_task_base_dir)  # 这是YOLO的project目录
+        # 预设模型在各任务间共用，把其原始路径交给训练函数作为已加载模型的缓存键 (上传的模型不缓存)
+        base_model_source_path = None
+        base_model_identifier = task_db_record.base_model_identifier or ''
+        if base_model_identifier.startswith('preset:'):
+            base_model_source_path = finetune_service._get_preset_model_path(base_model_identifier[len('preset:'):])
+        output_dir_project = finetune_service._get_task_output_dir(user_task_base_dir)  # 这是YOLO的project目录
         yolo_run_name = "train_run"  # 或者从参数配置
 
-        log_file_path, log_dir = current_app.finetune_service.get_task_log_path(user_id, task_id, ensure_exists=True)
+        log_file_path, log_dir = finetune_service.get_task_log_path(user_id, task_id, ensure_exists=True,
+                                                                    task=task_db_record)
         # 注意: run_yolo_training 会在 output_dir_project/yolo_run_name 下创建自己的日志。
         # FinetuneService.get_task_log_path 返回的路径可能需要与YOLO的日志输出机制协调。
         # 一个简单的方法是让 get_task_log_path 返回 project/name/logs/log.txt 这样的路径。
         # 或者，回调可以将日志写入此 log_file_path。
         # 为简单起见，我们假设回调和YOLO本身会记录到其标准位置，而此 log_file_path 用于Celery任务的额外日志或摘要。
 
-        current_app.logger.info(f"[CeleryTask:{self.request.id}] 任务 {task_id} - 基础模型: {base_model_path}")
-        current_app.logger.info(f"[CeleryTask:{self.request.id}] 任务 {task_id} - 数据配置: {generated_yaml_path}")
-        current_app.logger.info(f"[CeleryTask:{self.request.id}] 任务 {task_id} - 输出项目目录: {output_dir_project}")
-        current_app.logger.info(f"[CeleryTask:{self.request.id}] 任务 {task_id} - YOLO运行名称: {yolo_run_name}")
-        current_app.logger.info(f"[CeleryTask:{self.request.id}] 任务 {task_id} - Celery日志文件: {log_file_path}")
-
-        training_params_dict = {}
-        if task_db_record.training_params_json:
-            try:
-                training_params_dict = json.loads(task_db_record.training_params_json)
-            except json.JSONDecodeError as e:
-                current_app.logger.error(
-                    f"[CeleryTask:{self.request.id}] 任务 {task_id}: 解析 training_params_json 失败: {e}. 内容: '{task_db_record.training_params_json}'")
-                # 可以选择使用默认参数或抛出错误
-                raise ValueError(f"解析训练参数失败: {e}")
-
-        # 确保 epochs 参数存在并传递给回调用于初始化
-        initial_total_epochs = training_params_dict.get('epochs', 0)  # 默认0，回调会尝试从trainer获取
-        if task_db_record.total_epochs and task_db_record.total_epochs > 0:  # 如果数据库已有值
-            initial_total_epochs = task_db_record.total_epochs
-        elif initial_total_epochs > 0:
-            task_db_record.total_epochs = initial_total_epochs  # 更新到数据库
-            db.session.commit()
+        # 每个阶段只输出一条日志记录，路径同时以结构化字段 (extra['paths']) 附带，便于日志采集端检索
+        setup_paths = {'model': base_model_path, 'data': generated_yaml_path, 'project': output_dir_project,
+                       'run': yolo_run_name, 'log': log_file_path}
+        current_app.logger.info("[CeleryTask:%s] 任务 %s phase=setup paths=%s",
+                                self.request.id, task_id, setup_paths, extra={'paths': setup_paths})
 
         # 3. 实例化并准备回调
         # 回调日志可以与Celery任务日志分开，或使用同一个logger但加前缀
         callback_logger = logging.getLogger(f"FinetuneCallback.{task_id}")
-        # 你可能需要为 callback_logger 配置 handler 和 formatter，如果它还没有
+        # 回调在训练线程中按批次/轮次记录日志，经队列交给后台线程输出
         if not callback_logger.handlers:
-            # 简单配置，实际项目中你可能会有更复杂的日志配置
-            handler = logging.StreamHandler()
-            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-            handler.setFormatter(formatter)
-            callback_logger.addHandler(handler)
+            callback_logger.addHandler(_get_callback_log_handler())
             callback_logger.setLevel(logging.INFO)  # 或 current_app.logger.level
 
+        # 训练在单独线程中运行，本线程轮询取消标记后通过该事件通知回调
+        cancel_event = _register_cancel_event(task_id)
         finetune_callback_instance = FinetuneProgressCallback(
             task_id=task_id,
             user_id=user_id,
             db_session_maker=get_new_db_session_for_callback,  # 传递会话工厂
+            read_session_maker=callback_db_session,
             user_task_base_dir=user_task_base_dir,
             logger=callback_logger,  # 使用专门的或共享的logger
             total_epochs_from_task=initial_total_epochs,
-            celery_task_update_state_func=self.update_state  # 传递Celery任务的update_state方法
+            # 批次进度在内存中按"后写覆盖"合并，每隔这么多秒才写一次库；轮次结束等事件强制写入
+            db_update_interval_seconds=current_app.config.get('CALLBACK_DB_UPDATE_INTERVAL', 5),
+            # 回调会在后台写库线程中上报进度，而 self.request 是线程局部的，因此显式绑定 task_id
+            celery_task_update_state_func=functools.partial(self.update_state, task_id=self.request.id),
+            cancel_event=cancel_event,
+            report_detailed_losses=report_detailed_losses
         )
 
-        # Ultralytics YOLOv8 通过 model.add_callback(event_name, callback_function) 注册回调
-        # 所以 run_yolo_training 需要接收一个回调实例列表或一个配置好的YOLO模型实例
-        # 这里我们假设 run_yolo_training 内部会处理回调的注册
-        # Ultralytics 的回调是基于事件的，所以我们需要将回调的方法映射到事件名称
-        # 例如: [('on_fit_epoch_end', finetune_callback_instance.on_fit_epoch_end), ...]
-        # 或者，如果 FinetuneProgressCallback 遵循 Ultralytics 的回调基类，可以直接传递实例。
-        # 假设 FinetuneProgressCallback 实例可以直接传递，并且 run_yolo_training 知道如何使用它。
-        # 或者更简单，run_yolo_training 接收一个回调对象列表，它自己去调用 add_callback。
-        # 为了符合 FinetuneProgressCallback 的设计，它本身就是一个完整的对象，
-        # run_yolo_training 应该能够直接使用它。
-        # Ultralytics 的 model.train() 方法有一个 callbacks 参数。
-        # 我们的 run_yolo_training 应该将 finetune_callback_instance 放入一个列表中传递给 model.train()
-
-        # Ultralytics 回调注册方式是 model.add_callback(hook_name, callback_method)
-        # 所以，run_yolo_training 应该接收一个回调对象，并在内部调用 add_callback
-        # 或者，我们在这里准备好回调列表给 run_yolo_training
-        yolo_callbacks_for_train_func = [
-            ('on_pretrain_routine_start', finetune_callback_instance.on_pretrain_routine_start),
-            ('on_pretrain_routine_end', finetune_callback_instance.on_pretrain_routine_end),
-            ('on_train_batch_start', finetune_callback_instance.on_train_batch_start), # <-- 确保这一行被添加
-            ('on_fit_epoch_end', finetune_callback_instance.on_fit_epoch_end),
-            ('on_train_batch_end', finetune_callback_instance.on_train_batch_end),
-            ('on_model_save', finetune_callback_instance.on_model_save), # 也建议添加 on_model_save
-            ('on_train_end', finetune_callback_instance.on_train_end),
-            # 你可以添加更多YOLOv8支持的回调事件
-        ]
+        # Ultralytics 通过 model.add_callback(event_name, callback_function) 注册回调，
+        # run_yolo_training 接收 (事件名, 回调方法) 列表并在内部逐个注册
+        yolo_callbacks_for_train_func = finetune_callback_instance.as_yolo_hooks()
 
         # 4. 执行实际的YOLO微调训练
         current_app.logger.info(f"[CeleryTask:{self.request.id}] 任务 {task_id}: 调用 run_yolo_training...")
 
-        success, message, results_data = run_yolo_training(
+        success, message, results_data = _run_with_cancel_polling(
+            run_yolo_training, task_id, cancel_event,
+            current_app.config.get('TRAIN_CANCEL_POLL_INTERVAL', 2.0),
             model_path=base_model_path,
             data_yaml_path=generated_yaml_path,
             project_path=output_dir_project,
             run_name=yolo_run_name,
             training_params=training_params_dict,
             callbacks_list=yolo_callbacks_for_train_func,  # 传递回调方法列表
-            logger=current_app.logger  # 将Celery任务的logger传递给训练函数
+            logger=current_app.logger,  # 将Celery任务的logger传递给训练函数
+            source_model_path=base_model_source_path
         )
+        # 训练异常退出时 on_train_end 不会被调用，这里兜底关闭回调持有的会话
+        finetune_callback_instance.close_db_session()
+        finetune_callback_instance.stop_cancel_watcher()
 
         # 5. 处理训练结果
-        # 重新从数据库获取记录，因为回调可能已经更新了它
-        task_db_record = FinetuneTask.query.filter_by(id=task_id, user_id=user_id).first()
-        if not task_db_record:  # 理论上不应发生
+        # 回调通过自己的会话更新了这一行，只刷新后续会读取的列 (一次按主键的小 SELECT)，不重新构造对象
+        try:
+            db.session.refresh(task_db_record, attribute_names=_POST_TRAIN_REFRESH_ATTRS)
+        except InvalidRequestError:  # 行已被删除，理论上不应发生
             current_app.logger.error(f"[CeleryTask:{self.request.id}] 任务 {task_id} 在训练后无法从数据库重新获取。")
             raise ValueError(f"任务 {task_id} 训练后丢失。")
 
         if task_db_record.status == 'cancelled':  # 如果回调检测到取消并已更新状态
             current_app.logger.info(f"[CeleryTask:{self.request.id}] 任务 {task_id} 在训练期间被取消 (由回调处理)。")
             # 清理取消信号文件（如果回调没有清理）
-            cancel_signal_file = os.path.join(user_task_base_dir, ".cancel_signal")
-            if os.path.exists(cancel_signal_file):
-                try:
-                    os.remove(cancel_signal_file)
-                except OSError:
-                    pass  # pragma: no cover
+            try:
+                remove_if_exists(cancel_signal_file)
+            except OSError:
+                pass  # pragma: no cover
             return {"status": "cancelled", "task_id": task_id,
                     "message": task_db_record.error_message or "训练被用户取消。"}
 
@@ -218,12 +428,10 @@ def run_finetune_training_task(self, task_id: str, user_id: int):
             task_db_record.error_message = None  # 清空错误信息
 
             # 更新 metrics_json 和其他输出信息
-            final_metrics = {}
-            if task_db_record.metrics_json:
-                try:
-                    final_metrics = json.loads(task_db_record.metrics_json)
-                except json.JSONDecodeError:
-                    pass
+            # metrics_json 是 MutableDict: 原地 update 即被会话追踪，不必复制整份指标再整体赋值
+            if task_db_record.metrics_json is None:
+                task_db_record.metrics_json = {}
+            final_metrics = task_db_record.metrics_json
 
             if results_data:
                 final_metrics.update(results_data.get("final_metrics", {}))
@@ -248,8 +456,6 @@ def run_finetune_training_task(self, task_id: str, user_id: int):
                     except Exception as e_relpath:
                         current_app.logger.warning(f"无法计算模型相对路径: {e_relpath}")
 
-            task_db_record.metrics_json = json.dumps(final_metrics)
-
             db.session.commit()
             current_app.logger.info(f"[CeleryTask:{self.request.id}] 微调任务 {task_id} 成功完成。")
             return {"status": "completed", "task_id": task_id, "message": message, "results": final_metrics}
@@ -268,22 +474,19 @@ def run_finetune_training_task(self, task_id: str, user_id: int):
     except Exception as e:
         current_app.logger.error(f"[CeleryTask:{self.request.id}] 执行微调任务 {task_id} 时发生严重错误: {str(e)}",
                                  exc_info=True)
-        if task_db_record and task_db_record.status not in ['completed', 'cancelled']:  # 避免覆盖已取消的状态
-            task_db_record.status = 'failed'
-            task_db_record.error_message = str(e)
-            task_db_record.completed_at = db.func.now()
-            db.session.commit()
+        if task_db_record:  # 已完成/已取消的状态不会被覆盖
+            _mark_task_failed(FinetuneTask, task_id, str(e))
         raise  # 重新抛出异常，Celery会处理
     finally:
+        _release_cancel_event(task_id)
+        clear_cancel_flag(celery_app, task_id)
         # 清理取消信号文件（如果因任何原因仍然存在）
-        if user_task_base_dir:
-            cancel_signal_file = os.path.join(user_task_base_dir, ".cancel_signal")
-            if os.path.exists(cancel_signal_file):
-                try:
-                    os.remove(cancel_signal_file)
-                    current_app.logger.info(f"[CeleryTask:{self.request.id}] 清理取消信号文件: {cancel_signal_file}")
-                except OSError:  # pragma: no cover
-                    pass
+        if cancel_signal_file:
+            try:
+                if remove_if_exists(cancel_signal_file):
+                    current_app.logger.info("[CeleryTask:%s] 清理取消信号文件: %s", self.request.id, cancel_signal_file)
+            except OSError:  # pragma: no cover
+                pass
 
 
 @celery_app.task(bind=True, name='app.validate.run_validation')
@@ -295,6 +498,7 @@ def run_validation_task(self, task_id: str, user_id: int):
 
     task_db_record = None
     user_val_task_base_dir = None
+    cancel_signal_file = None
     try:
         task_db_record = ValidateTask.query.filter_by(id=task_id, user_id=user_id).first()
         if not task_db_record:
@@ -304,13 +508,23 @@ def run_validation_task(self, task_id: str, user_id: int):
         user_val_task_base_dir = current_app.validate_service._get_user_val_task_base_dir(user_id, task_id)
         cancel_signal_file = os.path.join(user_val_task_base_dir, ".cancel_signal_val")
 
+        cancel_event = _register_cancel_event(task_id)
+
+        def cancel_requested():
+            # 进程内事件已置位时直接返回；否则查询 Redis 取消标记 (一次 EXISTS)，结果后端不是 Redis 时回退到信号文件
+            if cancel_event.is_set():
+                return True
+            if is_cancel_flagged(celery_app, task_id) or os.path.lexists(cancel_signal_file):
+                cancel_event.set()
+                return True
+            return False
+
         if task_db_record.status == 'cancelled':
             current_app.logger.info(f"[CeleryTask:{self.request.id}] 验证任务 {task_id} 在开始执行前已被标记为取消。")
-            if os.path.exists(cancel_signal_file):
-                try:
-                    os.remove(cancel_signal_file)
-                except OSError:
-                    pass
+            try:
+                remove_if_exists(cancel_signal_file)
+            except OSError:
+                pass
             return {"status": "cancelled", "message": "任务在开始执行前已被取消."}
 
         task_db_record.status = 'running'
@@ -320,13 +534,13 @@ def run_validation_task(self, task_id: str, user_id: int):
         self.update_state(state='PROGRESS', meta={'status': '准备验证环境...'})
 
         # --- 检查取消信号 (在耗时操作之前) ---
-        if os.path.exists(cancel_signal_file):
+        if cancel_requested():
             current_app.logger.info(f"[CeleryTask:{self.request.id}] 验证任务 {task_id}: 检测到取消信号。")
             task_db_record.status = 'cancelled'
             task_db_record.error_message = "任务在实际开始前被用户取消。"
             task_db_record.completed_at = db.func.now()
             db.session.commit()
-            os.remove(cancel_signal_file)
+            remove_if_exists(cancel_signal_file)
             return {"status": "cancelled", "task_id": task_id, "message": "验证在开始前被用户取消。"}
 
         # --- 准备验证所需的模型和数据 ---
@@ -335,6 +549,10 @@ def run_validation_task(self, task_id: str, user_id: int):
         # --- 1. 模型准备 ---
         model_identifier = task_db_record.model_to_validate_identifier
         model_for_validation_path = None
+        # 暂存前的源模型路径 (预设/微调输出)，多个验证任务共用，作为模型缓存的键；上传的模型为 None
+        model_source_path = None
+        # 预设/微调模型的复制在 _io_pool 中进行，与下面的数据集准备 (解压、改写配置) 重叠
+        staging_futures = []
 
         if not model_identifier:
             raise ValueError("model_to_validate_identifier 未在任务中设置。")
@@ -357,8 +575,8 @@ def run_validation_task(self, task_id: str, user_id: int):
         elif model_type == "inference":
             # 从预设推理模型库复制
             # PRESET_MODELS_DIR 来自 config.yaml -> cfg.PRESET_MODELS_DIR
-            preset_models_dir = current_app.config.get('PRESET_MODELS_DIR',
-                                                       os.path.join(current_app.root_path, '..', 'models'))
+            # 相对路径相对于项目根目录解析 (与 FinetuneService 一致)；绝对路径由 os.path.join 原样保留
+            preset_models_dir = os.path.join(PROJECT_ROOT, current_app.config.get('PRESET_MODELS_DIR', 'models'))
             src_model_path = os.path.join(preset_models_dir, model_specifier)  # model_specifier 是模型文件名，如 yolov8n.pt
             if not os.path.exists(src_model_path):
                 raise FileNotFoundError(f"预设推理模型 {src_model_path} 未找到。")
@@ -366,9 +584,9 @@ def run_validation_task(self, task_id: str, user_id: int):
             # 确保 val_task_input_dir 存在
             os.makedirs(val_task_input_dir, exist_ok=True)
             model_for_validation_path = os.path.join(val_task_input_dir, os.path.basename(src_model_path))
-            shutil.copy2(src_model_path, model_for_validation_path)
+            staging_futures.append(_io_pool.submit(stage_file, src_model_path, model_for_validation_path))
+            model_source_path = src_model_path
             task_db_record.input_model_name_val = os.path.basename(model_for_validation_path)  # 记录复制后的名称
-            db.session.commit()
 
         elif model_type == "finetune":
             # 从微调任务输出复制，格式 "finetune:source_task_id:model_filename.pt"
@@ -405,14 +623,12 @@ def run_validation_task(self, task_id: str, user_id: int):
             os.makedirs(val_task_input_dir, exist_ok=True)
             model_for_validation_path = os.path.join(val_task_input_dir,
                                                      f"ft_{source_finetune_task_id}_{os.path.basename(src_model_path)}")
-            shutil.copy2(src_model_path, model_for_validation_path)
+            staging_futures.append(_io_pool.submit(stage_file, src_model_path, model_for_validation_path))
+            model_source_path = src_model_path
             task_db_record.input_model_name_val = os.path.basename(model_for_validation_path)
-            db.session.commit()
         else:
             raise NotImplementedError(f"不支持的模型类型: {model_type}")
 
-        current_app.logger.info(f"[CeleryTask:{self.request.id}] 待验证模型准备完成: {model_for_validation_path}")
-
         # --- 2. 数据集配置文件准备 ---
         dataset_identifier = task_db_record.dataset_identifier
         data_yaml_for_validation_path = None
@@ -427,9 +643,17 @@ def run_validation_task(self, task_id: str, user_id: int):
         current_app.logger.info(f"[CeleryTask:{self.request.id}] 准备数据集: 类型='{ds_type}', 标识符='{ds_specifier}'")
 
         if ds_type == "upload":
-            # 假设上传的数据集配置文件已由服务层处理并命名为 generated_config_yaml_name_val
+            # 上传的 ZIP/YAML 已由服务层原样保存；解压与生成验证配置在这里完成，不占用 Web 进程
             if not task_db_record.generated_config_yaml_name_val:
-                raise ValueError("上传数据集类型，但 generated_config_yaml_name_val 未设置。")
+                self.update_state(state='PROGRESS', meta={'status': '准备数据集...'})
+                generated_yaml, prep_error = current_app.validate_service._prepare_uploaded_dataset_for_validation(
+                    task_id, user_id, val_task_input_dir,
+                    current_app.validate_service._get_val_task_dataset_dir(user_val_task_base_dir),
+                    task_db_record.input_dataset_zip_name_val, task_db_record.input_dataset_yaml_name_val
+                )
+                if prep_error:
+                    raise ValueError(prep_error)
+                task_db_record.generated_config_yaml_name_val = generated_yaml
             data_yaml_for_validation_path = os.path.join(val_task_input_dir,
                                                          task_db_record.generated_config_yaml_name_val)
             if not os.path.exists(data_yaml_for_validation_path):
@@ -455,22 +679,14 @@ def run_validation_task(self, task_id: str, user_id: int):
                 raise FileNotFoundError(f"源微调任务的数据集配置文件 {src_data_yaml_path} 未找到。")
 
             os.makedirs(val_task_input_dir, exist_ok=True)
-            # 需要注意：原始的 data.yaml 路径是相对于其原始位置的。复制后可能需要调整路径。
-            # 简单复制，假设 ValidateService 在创建此任务时已确保yaml内容适用或会调整它。
-            # 或者，ValidateService 应该生成一个新的yaml文件，其路径指向原始数据位置。
-            # 这里我们先简单复制，并假设 ValidateService 已经处理了路径问题，或者数据本身就在共享位置。
             data_yaml_for_validation_path = os.path.join(val_task_input_dir,
                                                          f"data_from_ft_{source_finetune_task_id_for_ds}.yaml")
-            shutil.copy2(src_data_yaml_path, data_yaml_for_validation_path)
-            # TODO: 可能需要解析复制的yaml，并将其中的相对路径（如 train, val, test 图片目录）调整为绝对路径，
-            # 或者相对于验证任务的工作目录。这取决于原始yaml的结构和数据的实际存储位置。
-            # 为避免复杂性，此处假设 ValidateService 已经提供了可以直接使用的yaml，或者原始yaml中的路径是全局可访问的。
+            # 复制时把数据集根目录和 train/val/test 改写为绝对路径，并核对路径存在，避免在 YOLO 加载模型后才失败
+            staged, config_error = current_app.validate_service._stage_dataset_config(
+                task_id, src_data_yaml_path, data_yaml_for_validation_path)
+            if not staged:
+                raise ValueError(config_error)
             task_db_record.generated_config_yaml_name_val = os.path.basename(data_yaml_for_validation_path)
-            db.session.commit()
-            current_app.logger.warning(
-                f"[CeleryTask:{self.request.id}] 数据集配置文件 {src_data_yaml_path} 已复制到 {data_yaml_for_validation_path}. "
-                "请确保其内部路径对于验证任务是有效的。")
-
 
         elif ds_type == "preset_ds":
             # 使用预设数据集，ds_specifier 是预设数据集的名称
@@ -485,51 +701,50 @@ def run_validation_task(self, task_id: str, user_id: int):
 
             os.makedirs(val_task_input_dir, exist_ok=True)
             data_yaml_for_validation_path = os.path.join(val_task_input_dir, f"preset_{ds_specifier}.yaml")
-            shutil.copy2(src_data_yaml_path, data_yaml_for_validation_path)
-            # 同样，需要确保此yaml中的路径是有效的。
+            staged, config_error = current_app.validate_service._stage_dataset_config(
+                task_id, src_data_yaml_path, data_yaml_for_validation_path)
+            if not staged:
+                raise ValueError(config_error)
             task_db_record.generated_config_yaml_name_val = os.path.basename(data_yaml_for_validation_path)
-            db.session.commit()
-            current_app.logger.warning(
-                f"[CeleryTask:{self.request.id}] 预设数据集配置文件 {src_data_yaml_path} 已复制到 {data_yaml_for_validation_path}. "
-                "请确保其内部路径对于验证任务是有效的。")
         else:
             raise NotImplementedError(f"不支持的数据集类型: {ds_type}")
 
-        current_app.logger.info(f"[CeleryTask:{self.request.id}] 数据集配置准备完成: {data_yaml_for_validation_path}")
+        for future in staging_futures:
+            future.result()
+        current_app.logger.info(f"[CeleryTask:{self.request.id}] 验证任务 {task_id}: 模型与数据集配置准备完成。")
+        # 模型/数据集准备阶段对记录的修改 (input_model_name_val、generated_config_yaml_name_val) 在此一次提交
+        db.session.commit()
 
         # --- 其他路径和参数 ---
         val_output_dir_project = current_app.validate_service._get_val_task_output_dir(user_val_task_base_dir)
         yolo_val_run_name = "val_run"  # 或从参数配置
         val_log_file_path, _ = current_app.validate_service.get_task_log_path(user_id, task_id, ensure_exists=True)
 
-        current_app.logger.info(
-            f"[CeleryTask:{self.request.id}] 验证任务 {task_id} - 输出项目目录: {val_output_dir_project}")
-        current_app.logger.info(
-            f"[CeleryTask:{self.request.id}] 验证任务 {task_id} - YOLO运行名称: {yolo_val_run_name}")
-        current_app.logger.info(
-            f"[CeleryTask:{self.request.id}] 验证任务 {task_id} - Celery日志文件: {val_log_file_path}")
+        setup_paths = {'model': model_for_validation_path, 'data': data_yaml_for_validation_path,
+                       'project': val_output_dir_project, 'run': yolo_val_run_name, 'log': val_log_file_path}
+        current_app.logger.info("[CeleryTask:%s] 验证任务 %s phase=setup paths=%s",
+                                self.request.id, task_id, setup_paths, extra={'paths': setup_paths})
 
         validation_params_dict = {}
         if task_db_record.validation_params_json:
-            try:
-                validation_params_dict = json.loads(task_db_record.validation_params_json)
-            except json.JSONDecodeError as e:
+            if isinstance(task_db_record.validation_params_json, dict):
+                validation_params_dict = dict(task_db_record.validation_params_json)
+            else:
                 current_app.logger.error(
-                    f"[CeleryTask:{self.request.id}] 验证任务 {task_id}: 解析 validation_params_json 失败: {e}.")
-                # 可以选择使用默认参数或抛出错误
+                    f"[CeleryTask:{self.request.id}] 验证任务 {task_id}: validation_params_json 不是字典，使用默认参数。")
 
         # --- 执行实际的YOLO验证 ---
         current_app.logger.info(f"[CeleryTask:{self.request.id}] 任务 {task_id}: 调用 run_yolo_validation...")
         self.update_state(state='PROGRESS', meta={'status': '模型验证进行中...'})
 
         # 在调用验证前再次检查取消信号
-        if os.path.exists(cancel_signal_file):
+        if cancel_requested():
             current_app.logger.info(f"[CeleryTask:{self.request.id}] 验证任务 {task_id}: 在执行前检测到取消信号。")
             task_db_record.status = 'cancelled'
             task_db_record.error_message = "任务在验证执行前被用户取消。"
             task_db_record.completed_at = db.func.now()
             db.session.commit()
-            os.remove(cancel_signal_file)
+            remove_if_exists(cancel_signal_file)
             return {"status": "cancelled", "task_id": task_id, "message": "验证在执行前被用户取消。"}
 
         success, message, results_metrics = run_yolo_validation(
@@ -538,14 +753,17 @@ def run_validation_task(self, task_id: str, user_id: int):
             project_path=val_output_dir_project,
             run_name=yolo_val_run_name,
             validation_params=validation_params_dict,
-            logger=current_app.logger  # 将Celery任务的logger传递给验证函数
+            logger=current_app.logger,  # 将Celery任务的logger传递给验证函数
+            source_model_path=model_source_path,
+            # 与任务目录无关的共享缓存 (批大小探测结果等)，放在用户模型根目录下
+            cache_dir=os.path.join(current_app.validate_service.user_model_base_dir, '_val_cache')
         )
 
         # --- 处理验证结果 ---
         if success:
             task_db_record.status = 'completed'
             task_db_record.completed_at = db.func.now()
-            task_db_record.results_json = json.dumps(results_metrics)
+            task_db_record.results_json = results_metrics
             task_db_record.error_message = None
             db.session.commit()
             current_app.logger.info(
@@ -563,36 +781,27 @@ def run_validation_task(self, task_id: str, user_id: int):
         current_app.logger.error(
             f"[CeleryTask:{self.request.id}] 执行验证任务 {task_id} 因功能未实现而失败: {str(nie)}", exc_info=True)
         if task_db_record:
-            task_db_record.status = 'failed'
-            task_db_record.error_message = f"任务配置不完整或功能未实现: {str(nie)}"
-            task_db_record.completed_at = db.func.now()
-            db.session.commit()
+            _mark_task_failed(ValidateTask, task_id, f"任务配置不完整或功能未实现: {str(nie)}", keep_statuses=())
         raise
     except FileNotFoundError as fnfe:
         current_app.logger.error(
             f"[CeleryTask:{self.request.id}] 执行验证任务 {task_id} 因文件未找到而失败: {str(fnfe)}", exc_info=True)
         if task_db_record:
-            task_db_record.status = 'failed'
-            task_db_record.error_message = f"必要文件未找到: {str(fnfe)}"
-            task_db_record.completed_at = db.func.now()
-            db.session.commit()
+            _mark_task_failed(ValidateTask, task_id, f"必要文件未找到: {str(fnfe)}", keep_statuses=())
         raise
     except Exception as e:
         current_app.logger.error(f"[CeleryTask:{self.request.id}] 执行验证任务 {task_id} 时发生严重错误: {str(e)}",
                                  exc_info=True)
-        if task_db_record and task_db_record.status not in ['completed', 'cancelled']:
-            task_db_record.status = 'failed'
-            task_db_record.error_message = str(e)
-            task_db_record.completed_at = db.func.now()
-            db.session.commit()
+        if task_db_record:
+            _mark_task_failed(ValidateTask, task_id, str(e))
         raise
     finally:
-        if user_val_task_base_dir:
-            cancel_signal_file = os.path.join(user_val_task_base_dir, ".cancel_signal_val")
-            if os.path.exists(cancel_signal_file):
-                try:
-                    os.remove(cancel_signal_file)
-                    current_app.logger.info(
-                        f"[CeleryTask:{self.request.id}] 清理验证取消信号文件: {cancel_signal_file}")
-                except OSError:  # pragma: no cover
-                    pass
\ No newline at end of file
+        _release_cancel_event(task_id)
+        clear_cancel_flag(celery_app, task_id)
+        if cancel_signal_file:
+            try:
+                if remove_if_exists(cancel_signal_file):
+                    current_app.logger.info("[CeleryTask:%s] 清理验证取消信号文件: %s",
+                                            self.request.id, cancel_signal_file)
+            except OSError:  # pragma: no cover
+                pass
\ No newline at end of file
@@ -1,47 +1,95 @@
 import os
-from waitress import serve
-from app import create_app
-from app.config import Config
-import traceback
-
-# --- 检查 waitress 是否支持 SSL ---
-# Waitress 需要 pyOpenSSL 来直接处理 SSL
-try:
-    # 尝试导入 pyOpenSSL 来判断是否安装
-    import OpenSSL
-    waitress_can_handle_ssl = True
-except ImportError:
-    waitress_can_handle_ssl = False
-    print("警告: 未找到 pyOpenSSL。Waitress 将无法直接处理 HTTPS。")
-    print("如果需要 HTTPS，请运行 'pip install pyopenssl' 或 'pip install waitress[ssl]'。")
-    print("或者，您可以使用 Nginx 等反向代理来处理 SSL。")
+import sys
+import time
+import atexit
+import errno
+import socket
+from app.config import load_config, DEFAULT_CONFIG_PATH, PROJECT_ROOT
+from app.utils.fileops import remove_if_exists
+
+# TLS 不在 Waitress 进程内处理 (Waitress 本身不支持 TLS)：由 nginx/HAProxy 等反向代理终止 TLS，
+# 再以 HTTP 转发到本服务，握手与对称加密都走代理的原生 OpenSSL 实现 (会话复用、AES-NI)。
+# 配置 TRUSTED_PROXY 后，Waitress 会信任该代理的 X-Forwarded-* 头，Flask 仍能看到 https 的 request.scheme。
+TRUSTED_PROXY_HEADERS = {'x-forwarded-for', 'x-forwarded-proto', 'x-forwarded-host', 'x-forwarded-port'}
+
+
+def compute_waitress_threads(config):
+    """
+    Waitress 工作线程数: 显式配置 WAITRESS_THREADS 时直接使用；否则按 CPU 核数和 WAITRESS_WORKLOAD 估算。
+    io_bound (默认): 请求线程大多在等待磁盘、数据库或推理线程池，取 max(8, 4 * CPU)；
+    cpu_bound: 请求线程本身在做计算，取 CPU + 1，避免线程过多互相抢占。
+    """
+    threads = config.get('WAITRESS_THREADS')
+    if threads:
+        return int(threads)
+    cpu = os.cpu_count() or 1
+    if config.get('WAITRESS_WORKLOAD', 'io_bound') == 'cpu_bound':
+        return cpu + 1
+    return max(8, 4 * cpu)
+
+
+def _startup_excepthook(exc_type, exc, tb):
+    """启动过程中未捕获的异常统一在这里输出 (一行说明 + 完整堆栈)，解释器随后以退出码 1 结束。"""
+    if issubclass(exc_type, KeyboardInterrupt):
+        sys.__excepthook__(exc_type, exc, tb)
+        return
+    import traceback
+    print(f"启动失败: {exc}", file=sys.stderr)
+    traceback.print_exception(exc_type, exc, tb)
+
+
+def write_pid_file(pid_file):
+    """写入当前进程 PID，退出时删除；供 py-spy、bpftrace 等外部工具按 PID 附加到本服务。"""
+    with open(pid_file, 'w', encoding='utf-8') as f:
+        f.write(f"{os.getpid()}\n")
+    atexit.register(remove_if_exists, pid_file)
+
+
+def create_reuseport_sockets(host, port):
+    """
+    自行创建并绑定监听套接字 (设置 SO_REUSEPORT)，交给 Waitress 的 sockets 参数。
+    多个服务实例 (例如滚动重启时的新旧进程) 可以同时绑定同一端口，由内核在它们之间分配新连接。
+    """
+    bind_host = None if host in ('0.0.0.0', '*') else host
+    sockets = []
+    for family, socktype, proto, _, sockaddr in socket.getaddrinfo(
+            bind_host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_PASSIVE):
+        sock = socket.socket(family, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.bind(sockaddr)
+        sockets.append(sock)
+    return sockets
+
 
 if __name__ == "__main__":
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    config_path = os.path.join(base_dir, 'config.yaml')
+    sys.excepthook = _startup_excepthook
+    startup_begin = time.perf_counter()
+    # 只在作为服务器启动时导入 Waitress；仅导入本模块使用 compute_waitress_threads 等辅助函数时不加载它
+    from waitress import serve
+    from app import create_app
+
+    config_path = DEFAULT_CONFIG_PATH
 
     # --- 配置加载 ---
     try:
         # 假设 Config 类在初始化时会加载配置，但可能不强制检查 SSL 文件存在性
-        cfg = Config(config_path)
+        cfg = load_config(config_path)
         print(f"从 {config_path} 加载配置...")
     except FileNotFoundError:
         print(f"错误: 配置文件 {config_path} 未找到！")
         exit(1)
-    except Exception as e:
-        # 捕获其他可能的配置加载错误
-        print(f"加载配置时出错: {e}")
-        traceback.print_exc()
-        exit(1)
 
     # --- 创建 Flask 应用 ---
-    try:
-        app, app_config = create_app(cfg) # 使用加载的配置对象创建 app
-        print("Flask 应用实例已创建。")
-    except Exception as e:
-        print(f"创建 Flask 应用时出错: {e}")
-        traceback.print_exc()
-        exit(1)
+    app, app_config = create_app(cfg) # 使用加载的配置对象创建 app
+    print("Flask 应用实例已创建。")
+
+    # --- 预读模型权重 (在开始接受请求之前) ---
+    preload_paths = app.config.get('PRELOAD_MODEL_PATHS')
+    if preload_paths and getattr(app, 'inference_service', None):
+        app.inference_service.preload_models(preload_paths)
 
     # --- 获取监听地址和端口 ---
     host_config = app_config.SERVER_HOST # 从配置对象获取
@@ -49,55 +97,57 @@ if __name__ == "__main__":
     listen_host = "*" if host_config == "0.0.0.0" else host_config
     listen_str = f"{listen_host}:{port}"
 
-    # --- 检查 HTTPS 配置 ---
-    use_https = False
-    cert_file_rel = app_config.CERT_FILE # 从配置对象获取证书相对路径
-    key_file_rel = app_config.KEY_FILE   # 从配置对象获取密钥相对路径
-    cert_file_abs = None
-    key_file_abs = None
-
-    if cert_file_rel and key_file_rel:
-        cert_file_abs = os.path.join(base_dir, cert_file_rel)
-        key_file_abs = os.path.join(base_dir, key_file_rel)
-        print(f"检查 HTTPS 证书文件: {cert_file_abs}")
-        print(f"检查 HTTPS 密钥文件: {key_file_abs}")
-        if os.path.exists(cert_file_abs) and os.path.exists(key_file_abs):
-            if waitress_can_handle_ssl:
-                use_https = True
-                print("找到有效的证书和密钥文件，且 pyOpenSSL 可用。将尝试启动 HTTPS 服务器。")
-            else:
-                print("找到有效的证书和密钥文件，但 pyOpenSSL 不可用。无法直接启动 HTTPS，将回退到 HTTP。")
-        else:
-            print("警告: 配置了证书或密钥文件，但文件不存在。将启动 HTTP 服务器。")
-            if not os.path.exists(cert_file_abs): print(f"  - 文件未找到: {cert_file_abs}")
-            if not os.path.exists(key_file_abs): print(f"  - 文件未找到: {key_file_abs}")
-    else:
-        print("未配置证书和密钥文件。将启动 HTTP 服务器。")
-
     # --- 准备 Waitress 参数 ---
+    threads = compute_waitress_threads(app.config)
     serve_args = {
         "app": app,
         "listen": listen_str,
-        "threads": app.config.get('WAITRESS_THREADS', 4) # 可以从配置读取线程数，提供默认值
+        "threads": threads,
+        # 同时保持的连接上限、监听队列长度与空闲连接超时，超载时限制资源占用
+        # (与 Apache prefork 的 MaxClients 同理: 队列太小会拒绝突发请求，太大则在超载时拖慢所有请求)
+        "connection_limit": int(app.config.get('WAITRESS_CONNECTION_LIMIT', max(256, threads * 32))),
+        "backlog": int(app.config.get('WAITRESS_BACKLOG', 128)),
+        # 典型客户端是发出一批请求后即断开的脚本，空闲 keep-alive 连接 20s 后关闭，每 10s 清理一次
+        "channel_timeout": int(app.config.get('WAITRESS_CHANNEL_TIMEOUT', 20)),
+        "cleanup_interval": int(app.config.get('WAITRESS_CLEANUP_INTERVAL', 10)),
+        "asyncore_loop_timeout": 1,
+        # 响应头 Server 字段
+        "ident": app.config.get('WAITRESS_IDENT', 'yolo-toolkit'),
     }
 
+    # --- 反向代理 (TLS 终止) 配置 ---
     protocol = "http"
-    if use_https:
-        protocol = "https"
-        serve_args['ssl_certificate'] = cert_file_abs
-        serve_args['ssl_private_key'] = key_file_abs
-        # Waitress 默认 url_scheme 是 http，当提供 ssl_* 参数时，
-        # 它通常能正确处理，但明确设置可能更清晰（虽然文档没明确要求）
-        # serve_args['url_scheme'] = 'https' # 一般不需要显式设置
+    trusted_proxy = app.config.get('TRUSTED_PROXY')
+    if trusted_proxy:
+        protocol = "https (经反向代理)"
+        serve_args['trusted_proxy'] = trusted_proxy
+        serve_args['trusted_proxy_headers'] = TRUSTED_PROXY_HEADERS
+        # 丢弃来自非受信来源的 X-Forwarded-* 头，防止客户端伪造
+        serve_args['clear_untrusted_proxy_headers'] = True
+        print(f"信任反向代理 {trusted_proxy} 的 X-Forwarded-* 头，TLS 由代理终止。")
+    elif app_config.CERT_FILE and app_config.KEY_FILE:
+        print(f"已配置证书 {app_config.CERT_FILE}，但 Waitress 只提供 HTTP。"
+              "请在 nginx 等反向代理上使用该证书终止 TLS，并设置 TRUSTED_PROXY (见 README)。")
+
+    # --- SO_REUSEPORT (可选) ---
+    # 注意: 推理服务在进程内存中保存每个用户已加载的模型和上传文件列表，且内核按连接而不是按用户分配，
+    # 因此不要让多个实例长期同时服务同一端口；此选项用于滚动重启时新旧进程短暂共存
+    reuse_port = bool(app.config.get('WAITRESS_REUSE_PORT', False))
+    if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+        print("警告: 当前平台不支持 SO_REUSEPORT，忽略 WAITRESS_REUSE_PORT。")
+        reuse_port = False
 
     # --- 打印启动信息 ---
     print("-" * 30)
     print(f"启动服务器，监听 {protocol}://{host_config}:{port} (Waitress 使用: {listen_str})")
-    print(f"工作线程数: {serve_args['threads']}")
+    print(f"工作线程数: {serve_args['threads']} (CPU: {os.cpu_count()}, 负载类型: {app.config.get('WAITRESS_WORKLOAD', 'io_bound')})")
+    print(f"连接上限: {serve_args['connection_limit']}, backlog: {serve_args['backlog']}, "
+          f"空闲连接超时: {serve_args['channel_timeout']}s (每 {serve_args['cleanup_interval']}s 清理)")
     print(f"Session 类型: {app_config.SESSION_TYPE}") # 从配置对象获取
     if app_config.SESSION_TYPE == 'filesystem':
+        print("警告: 多线程并发时 filesystem Session 的文件读写会成为瓶颈，建议在 config.yaml 中设置 REDIS_URL 改用 Redis 存储。")
         session_dir_rel = app_config.SESSION_FILE_DIR # 从配置对象获取
-        session_dir_abs = os.path.join(base_dir, session_dir_rel)
+        session_dir_abs = os.path.join(PROJECT_ROOT, session_dir_rel)
         if not os.path.exists(session_dir_abs):
              try:
                  os.makedirs(session_dir_abs)
@@ -105,25 +155,28 @@ if __name__ == "__main__":
              except OSError as e:
                  print(f"警告：无法创建 Session 目录 {session_dir_abs}: {e}")
         print(f"Session 目录: {session_dir_abs}")
+    pid_file = app.config.get('PID_FILE')
+    if pid_file:
+        try:
+            write_pid_file(pid_file)
+            print(f"PID {os.getpid()} 已写入 {pid_file}")
+        except OSError as e:
+            print(f"警告: 无法写入 PID 文件 {pid_file}: {e}")
+    print(f"启动耗时 (加载配置、创建应用、预读模型): {time.perf_counter() - startup_begin:.2f}s")
     print("-" * 30)
 
     # --- 使用 Waitress 启动服务器 ---
     try:
+        if reuse_port:
+            # 提供 sockets 时不能再传 listen，Waitress 直接在这些套接字上 listen(backlog)
+            serve_args['sockets'] = create_reuseport_sockets(host_config, port)
+            del serve_args['listen']
+            print(f"监听套接字已设置 SO_REUSEPORT ({len(serve_args['sockets'])} 个)。")
         serve(**serve_args) # 使用解包的参数字典启动 serve
-    except ImportError as e:
-         # 捕获可能的 OpenSSL 导入错误（虽然前面检查过，以防万一）
-         print(f"启动 Waitress 时发生导入错误（可能是缺少 pyOpenSSL）: {e}")
-         traceback.print_exc()
-         exit(1)
     except OSError as e:
          # 捕获端口占用等 OS 错误
-         if "Address already in use" in str(e):
+         # 按 errno 判断，不依赖 (可能被本地化的) 错误信息文本
+         if e.errno == errno.EADDRINUSE:
              print(f"错误: 端口 {port} 已被占用。请检查是否有其他程序在使用该端口。")
-         else:
-             print(f"启动 Waitress 时发生 OS 错误: {e}")
-             traceback.print_exc()
-         exit(1)
-    except Exception as e:
-        print(f"启动 Waitress 服务器失败: {e}")
-        traceback.print_exc()
-        exit(1)
\ No newline at end of file
+             exit(1)
+         raise  # 其他 OS 错误交给 _startup_excepthook 输出
\ No newline at end of file